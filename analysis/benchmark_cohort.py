@@ -0,0 +1,710 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import time
+
+import numpy as np
+
+from compiled_study import load_compiled_study
+from expressions import parse_expression
+from study_graph import DERIVED_QUERY_TYPES
+from vaccine_registry import PRODUCT_IDS, SARS_COV_2
+
+# BENCHMARK THE STUDY DEFINITION ON A SYNTHETIC DATABASE
+# builds a SQLite database of synthetic patients with the tables (and
+# columns) the TPP backend reads for the variables in analysis/*.py, then
+# runs each of the study's variables against it as the TPP backend does: a
+# temporary table per variable, joined at the end, with derived variables
+# calculated in the join. the time taken by each variable, each family of
+# variables (vaccination, clinical_events, hospital, emergency, death, sgss,
+# demographics) and the whole extraction is written to a report tagged with
+# the git commit, so runs can be compared between commits, e.g.
+#
+#   python analysis/benchmark_cohort.py run --scale 1e4 1e6
+#   python analysis/benchmark_cohort.py compare before.json after.json
+#
+# the database for each scale is kept in output/benchmark/ and only built
+# once (for the same scale and seed). the queries are written for SQLite,
+# so compare timings with each other rather than with the real backend.
+
+BENCHMARK_DIR = "output/benchmark"
+BENCHMARK_FORMAT = 1
+FAMILIES = dict(
+    with_tpp_vaccination_record="vaccination",
+    with_healthcare_worker_flag_on_covid_vaccine_record="vaccination",
+    with_these_clinical_events="clinical_events",
+    admitted_to_hospital="hospital",
+    attended_emergency_care="emergency",
+    with_these_codes_on_death_certificate="death",
+    died_from_any_cause="death",
+    with_test_result_in_sgss="sgss",
+)
+FLAG_QUERY_TYPES = [
+    "registered_with_one_practice_between",
+    "with_healthcare_worker_flag_on_covid_vaccine_record",
+]
+# patients generated and inserted at a time when building a database
+PATIENTS_PER_BATCH = 50000
+PRACTICES = 500
+# dates are YYYY-MM-DD text, as SQLite has no date type
+MISSING_DATE = "9999-12-31"
+DATE_EXPRESSION_RE = re.compile(
+    r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(?:([+-])\s*([0-9]+)\s*(day|month|year)s?)?\s*$"
+)
+EC_DIAGNOSIS_COLUMNS = [f"EC_Diagnosis_{number:02d}" for number in range(1, 25)]
+DEATH_CAUSE_COLUMNS = ["icd10u"] + [f"ICD100{number:02d}" for number in range(1, 16)]
+
+SCHEMA = dict(
+    Patient="Patient_ID INTEGER PRIMARY KEY, DateOfBirth TEXT, Sex TEXT",
+    Organisation="Organisation_ID INTEGER PRIMARY KEY, STPCode TEXT",
+    RegistrationHistory=(
+        "Registration_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, Organisation_ID INTEGER, "
+        "StartDate TEXT, EndDate TEXT"
+    ),
+    PatientAddress=(
+        "PatientAddress_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, StartDate TEXT, "
+        "EndDate TEXT, ImdRankRounded INTEGER, MSOACode TEXT"
+    ),
+    PotentialCareHomeAddress=(
+        "PatientAddress_ID INTEGER PRIMARY KEY, LocationRequiresNursing TEXT, "
+        "LocationDoesNotRequireNursing TEXT"
+    ),
+    CodedEvent=(
+        "CodedEvent_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, CTV3Code TEXT, "
+        "ConsultationDate TEXT"
+    ),
+    CodedEvent_SNOMED=(
+        "CodedEvent_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, ConceptID TEXT, "
+        "ConsultationDate TEXT"
+    ),
+    VaccinationReference=(
+        "VaccinationName_ID INTEGER PRIMARY KEY, VaccinationName TEXT, VaccinationContent TEXT"
+    ),
+    Vaccination=(
+        "Vaccination_ID INTEGER PRIMARY KEY, Patient_ID INTEGER, VaccinationName_ID INTEGER, "
+        "VaccinationDate TEXT"
+    ),
+    # APCS and APCS_Der, joined on APCS_Ident in TPP
+    APCS="APCS_Ident INTEGER PRIMARY KEY, Patient_ID INTEGER, Admission_Date TEXT, Der_Diagnosis_All TEXT",
+    # EC and EC_Diagnosis, joined on EC_Ident in TPP
+    EC=(
+        "EC_Ident INTEGER PRIMARY KEY, Patient_ID INTEGER, Arrival_Date TEXT, "
+        + ", ".join(f"{column} TEXT" for column in EC_DIAGNOSIS_COLUMNS)
+    ),
+    ONS_Deaths="Patient_ID INTEGER, dod TEXT, " + ", ".join(f"{column} TEXT" for column in DEATH_CAUSE_COLUMNS),
+    SGSS_Positive="Patient_ID INTEGER, Earliest_Specimen_Date TEXT",
+    HealthCareWorker="Patient_ID INTEGER, HealthCareWorker TEXT",
+)
+INDEXES = [
+    "RegistrationHistory (Patient_ID)",
+    "PatientAddress (Patient_ID)",
+    "CodedEvent (CTV3Code)",
+    "CodedEvent_SNOMED (ConceptID)",
+    "Vaccination (VaccinationName_ID)",
+    "APCS (Patient_ID)",
+    "EC (Patient_ID)",
+    "ONS_Deaths (Patient_ID)",
+    "SGSS_Positive (Patient_ID)",
+    "HealthCareWorker (Patient_ID)",
+]
+
+
+# SYNTHETIC DATA
+
+
+def study_codes(definitions):
+    # {system: codes} of every codelist used by the study
+    codes = {}
+    for _, query_args in definitions.values():
+        for key in ("codelist", "with_these_diagnoses"):
+            codelist = query_args.get(key)
+            if codelist is not None:
+                codes.setdefault(codelist.system, set()).update(
+                    code[0] if isinstance(code, tuple) else code for code in codelist
+                )
+    return {system: sorted(system_codes) for system, system_codes in codes.items()}
+
+
+def random_dates(rng, size, earliest, latest):
+    start = np.datetime64(earliest, "D")
+    days = rng.integers(0, (np.datetime64(latest, "D") - start).astype(int) + 1, size)
+    return (start + days).astype(str)
+
+
+def random_codes(rng, size, codes, filler, fraction):
+    # codes from the study's codelists for `fraction` of rows, else filler
+    values = rng.choice(np.array(filler, dtype=object), size)
+    if codes:
+        chosen = rng.random(size) < fraction
+        values[chosen] = rng.choice(np.array(codes, dtype=object), chosen.sum())
+    return values
+
+
+def insert(connection, table, columns):
+    names = list(columns)
+    rows = zip(*[column.tolist() if isinstance(column, np.ndarray) else column for column in columns.values()])
+    connection.executemany(
+        f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})", rows
+    )
+
+
+def insert_patients(connection, rng, patients, codes, events_per_patient, codelist_fraction, references):
+    # every patient-level table's rows for one batch of patients
+    size = len(patients)
+    first_id, last_id = int(patients[0]), int(patients[-1])
+    insert(connection, "Patient", dict(
+        Patient_ID=patients,
+        DateOfBirth=random_dates(rng, size, "1920-01-01", "2005-12-31"),
+        Sex=rng.choice(np.array(["M", "F"], dtype=object), size),
+    ))
+    end_dates = np.full(size, MISSING_DATE, dtype=object)
+    deregistered = rng.random(size) < 0.05
+    end_dates[deregistered] = random_dates(rng, deregistered.sum(), "2020-01-01", "2021-12-31")
+    insert(connection, "RegistrationHistory", dict(
+        Patient_ID=patients,
+        Organisation_ID=rng.integers(1, PRACTICES + 1, size),
+        StartDate=random_dates(rng, size, "1990-01-01", "2020-06-30"),
+        EndDate=end_dates,
+    ))
+    insert(connection, "PatientAddress", dict(
+        PatientAddress_ID=patients,
+        Patient_ID=patients,
+        StartDate=np.full(size, "1990-01-01", dtype=object),
+        EndDate=np.full(size, MISSING_DATE, dtype=object),
+        ImdRankRounded=rng.integers(0, 329, size) * 100,
+        MSOACode=np.full(size, "E02000001", dtype=object),
+    ))
+    care_homes = patients[rng.random(size) < 0.02]
+    nursing = rng.random(len(care_homes)) < 0.3
+    insert(connection, "PotentialCareHomeAddress", dict(
+        PatientAddress_ID=care_homes,
+        LocationRequiresNursing=np.where(nursing, "Y", "N").astype(object),
+        LocationDoesNotRequireNursing=np.where(nursing, "N", "Y").astype(object),
+    ))
+
+    for table, code_column, system, rate in (
+        ("CodedEvent", "CTV3Code", "ctv3", events_per_patient),
+        ("CodedEvent_SNOMED", "ConceptID", "snomed", events_per_patient / 4),
+    ):
+        rows = int(size * rate)
+        filler = [f"Y{number:04d}" for number in range(10000)]
+        insert(connection, table, {
+            "Patient_ID": rng.integers(first_id, last_id + 1, rows),
+            code_column: random_codes(rng, rows, codes.get(system), filler, codelist_fraction),
+            "ConsultationDate": random_dates(rng, rows, "2010-01-01", "2021-12-31"),
+        })
+
+    first = patients[rng.random(size) < 0.9]
+    second = first[rng.random(len(first)) < 0.8]
+    first_dates = random_dates(rng, len(first), "2020-12-08", "2021-05-11")
+    second_dates = (
+        first_dates[np.searchsorted(first, second)].astype("datetime64[D]")
+        + rng.integers(21, 85, len(second))
+    ).astype(str)
+    flu = patients[rng.random(size) < 0.5]
+    insert(connection, "Vaccination", dict(
+        Patient_ID=np.concatenate([first, second, flu]),
+        VaccinationName_ID=np.concatenate([
+            rng.integers(2, len(references) + 1, len(first)),
+            rng.integers(2, len(references) + 1, len(second)),
+            np.ones(len(flu), dtype=np.int64),
+        ]),
+        VaccinationDate=np.concatenate([
+            first_dates, second_dates, random_dates(rng, len(flu), "2019-09-01", "2021-12-31")
+        ]),
+    ))
+
+    icd10_filler = [f"{letter}{number:03d}" for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ" for number in range(0, 1000, 7)]
+    rows = int(size * 0.3)
+    diagnoses = [
+        random_codes(rng, rows, codes.get("icd10"), icd10_filler, codelist_fraction)
+        for _ in range(3)
+    ]
+    insert(connection, "APCS", dict(
+        Patient_ID=rng.integers(first_id, last_id + 1, rows),
+        Admission_Date=random_dates(rng, rows, "2010-01-01", "2021-12-31"),
+        Der_Diagnosis_All=["||" + " ,".join(row) for row in zip(*diagnoses)],
+    ))
+    rows = int(size * 0.2)
+    snomed_filler = [str(100000 + number) for number in range(10000)]
+    insert(connection, "EC", dict(
+        Patient_ID=rng.integers(first_id, last_id + 1, rows),
+        Arrival_Date=random_dates(rng, rows, "2010-01-01", "2021-12-31"),
+        **{
+            column: random_codes(rng, rows, codes.get("snomed"), snomed_filler, codelist_fraction)
+            for column in EC_DIAGNOSIS_COLUMNS[:3]
+        },
+    ))
+    died = patients[rng.random(size) < 0.02]
+    insert(connection, "ONS_Deaths", dict(
+        Patient_ID=died,
+        dod=random_dates(rng, len(died), "2019-01-01", "2021-12-31"),
+        **{
+            column: random_codes(rng, len(died), codes.get("icd10"), icd10_filler, codelist_fraction * 10)
+            for column in DEATH_CAUSE_COLUMNS[:4]
+        },
+    ))
+    positive = patients[rng.random(size) < 0.1]
+    insert(connection, "SGSS_Positive", dict(
+        Patient_ID=positive,
+        Earliest_Specimen_Date=random_dates(rng, len(positive), "2020-03-01", "2021-12-31"),
+    ))
+    workers = patients[rng.random(size) < 0.05]
+    insert(connection, "HealthCareWorker", dict(
+        Patient_ID=workers, HealthCareWorker=np.full(len(workers), "Y", dtype=object)
+    ))
+
+
+def build_database(path, definitions, size, seed, events_per_patient, codelist_fraction):
+    rng = np.random.default_rng(seed)
+    codes = study_codes(definitions)
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    for table, columns in SCHEMA.items():
+        connection.execute(f"CREATE TABLE {table} ({columns})")
+
+    insert(connection, "Organisation", dict(
+        Organisation_ID=np.arange(1, PRACTICES + 1),
+        STPCode=np.array([f"STP{number % 10 + 1}" for number in range(PRACTICES)], dtype=object),
+    ))
+    references = [("Influenza vaccine", "INFLUENZA")] + [
+        (product, SARS_COV_2) for product in PRODUCT_IDS
+    ]
+    insert(connection, "VaccinationReference", dict(
+        VaccinationName_ID=np.arange(1, len(references) + 1),
+        VaccinationName=[product for product, _ in references],
+        VaccinationContent=[content for _, content in references],
+    ))
+    # the patients are generated and inserted a batch at a time, with their
+    # events among the patients of their batch, so only one batch's rows are
+    # in memory at once
+    for first_id in range(1, size + 1, PATIENTS_PER_BATCH):
+        patients = np.arange(first_id, min(first_id + PATIENTS_PER_BATCH, size + 1))
+        insert_patients(
+            connection, rng, patients, codes, events_per_patient, codelist_fraction, references
+        )
+
+    for index, columns in enumerate(INDEXES):
+        connection.execute(f"CREATE INDEX ix_{index} ON {columns}")
+    connection.commit()
+    connection.close()
+    os.replace(tmp_path, path)
+
+
+# QUERIES
+
+
+def quote(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def values_sql(values):
+    values = [values] if isinstance(values, str) else values
+    return "(" + ", ".join(quote(value) for value in values) + ")"
+
+
+def date_sql(date, joins):
+    # a date argument as SQL, joining any variable it's relative to
+    if re.match(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$", date):
+        return quote(date)
+    match = DATE_EXPRESSION_RE.match(date)
+    if not match:
+        raise ValueError(f"Unsupported date expression: {date}")
+    name, sign, number, unit = match.groups()
+    joins.add(name)
+    if not sign:
+        return f"v_{name}.value"
+    return f"date(v_{name}.value, '{sign}{number} {unit}s')"
+
+
+def between_sql(column, between, joins):
+    start, end = between if between else (None, None)
+    conditions = []
+    if start:
+        conditions.append(f"{column} >= {date_sql(start, joins)}")
+    if end:
+        conditions.append(f"{column} <= {date_sql(end, joins)}")
+    return " AND ".join(conditions) or "1 = 1"
+
+
+def join_sql(joins, patient_id):
+    return "".join(
+        f" LEFT JOIN v_{name} ON v_{name}.patient_id = {patient_id}" for name in sorted(joins)
+    )
+
+
+def events_sql(table, patient_id, date_column, condition, query_args, extra_from=""):
+    # the first (or last) matching event's date, or a flag
+    joins = set()
+    where = f"{condition} AND {between_sql(date_column, query_args.get('between'), joins)}"
+    aggregate = "MAX" if query_args.get("find_last_match_in_period") else "MIN"
+    value = "1" if query_args.get("returning") == "binary_flag" else f"{aggregate}({date_column})"
+    return (
+        f"SELECT {table}.{patient_id} AS patient_id, {value} AS value "
+        f"FROM {table}{extra_from}{join_sql(joins, f'{table}.{patient_id}')} "
+        f"WHERE {where} GROUP BY {table}.{patient_id}"
+    )
+
+
+def codelist_table(connection, name, codelist):
+    table = f"c_{name}"
+    connection.execute(f"CREATE TEMP TABLE {table} (code TEXT PRIMARY KEY, category TEXT)")
+    connection.executemany(
+        f"INSERT OR IGNORE INTO {table} VALUES (?, ?)",
+        [code if isinstance(code, tuple) else (code, None) for code in codelist],
+    )
+    return table
+
+
+def in_codes(columns, codes):
+    values = ", ".join(quote(code[0] if isinstance(code, tuple) else code) for code in codes)
+    return "(" + " OR ".join(f"{column} IN ({values})" for column in columns) + ")"
+
+
+def variable_sql(connection, name, query_type, query_args):
+    # SQL for a variable's temporary table of patient_id and value (and
+    # date, for include_date_of_match)
+    returning = query_args.get("returning")
+    if query_type == "with_tpp_vaccination_record":
+        conditions = []
+        if query_args.get("target_disease_matches"):
+            conditions.append(f"ref.VaccinationContent IN {values_sql(query_args['target_disease_matches'])}")
+        if query_args.get("product_name_matches"):
+            conditions.append(f"ref.VaccinationName IN {values_sql(query_args['product_name_matches'])}")
+        return events_sql(
+            "Vaccination", "Patient_ID", "VaccinationDate", " AND ".join(conditions) or "1 = 1",
+            query_args,
+            " JOIN VaccinationReference AS ref ON ref.VaccinationName_ID = Vaccination.VaccinationName_ID",
+        )
+    if query_type == "with_these_clinical_events":
+        codelist = query_args["codelist"]
+        table, code_column = (
+            ("CodedEvent_SNOMED", "ConceptID") if codelist.system == "snomed" else ("CodedEvent", "CTV3Code")
+        )
+        codes = codelist_table(connection, name, codelist)
+        if returning == "category":
+            joins = set()
+            order = "DESC" if query_args.get("find_last_match_in_period") else "ASC"
+            return (
+                f"SELECT patient_id, category AS value, date FROM ("
+                f"SELECT {table}.Patient_ID AS patient_id, {codes}.category, ConsultationDate AS date, "
+                f"ROW_NUMBER() OVER (PARTITION BY {table}.Patient_ID "
+                f"ORDER BY ConsultationDate {order}, CodedEvent_ID) AS rownum "
+                f"FROM {table} JOIN {codes} ON {code_column} = {codes}.code"
+                f"{join_sql(joins, f'{table}.Patient_ID')} "
+                f"WHERE {between_sql('ConsultationDate', query_args.get('between'), joins)}"
+                f") t WHERE rownum = 1"
+            )
+        return events_sql(
+            table, "Patient_ID", "ConsultationDate", "1 = 1", query_args,
+            f" JOIN {codes} ON {code_column} = {codes}.code",
+        )
+    if query_type == "admitted_to_hospital":
+        patterns = " OR ".join(
+            f"Der_Diagnosis_All GLOB '*[^A-Za-z0-9]{code}*'"
+            for code in query_args["with_these_diagnoses"]
+        )
+        return events_sql("APCS", "Patient_ID", "Admission_Date", f"({patterns})", query_args)
+    if query_type == "attended_emergency_care":
+        condition = in_codes(EC_DIAGNOSIS_COLUMNS, query_args["with_these_diagnoses"])
+        return events_sql("EC", "Patient_ID", "Arrival_Date", condition, query_args)
+    if query_type == "with_these_codes_on_death_certificate":
+        columns = DEATH_CAUSE_COLUMNS[:1] if query_args.get("match_only_underlying_cause") else DEATH_CAUSE_COLUMNS
+        condition = in_codes(columns, query_args["codelist"])
+        return events_sql("ONS_Deaths", "Patient_ID", "dod", condition, query_args)
+    if query_type == "died_from_any_cause":
+        return events_sql("ONS_Deaths", "Patient_ID", "dod", "1 = 1", query_args)
+    if query_type == "with_test_result_in_sgss":
+        return events_sql(
+            "SGSS_Positive", "Patient_ID", "Earliest_Specimen_Date", "1 = 1", query_args
+        )
+    if query_type == "with_healthcare_worker_flag_on_covid_vaccine_record":
+        return (
+            "SELECT Patient_ID AS patient_id, 1 AS value FROM HealthCareWorker "
+            "WHERE HealthCareWorker = 'Y' GROUP BY Patient_ID"
+        )
+    if query_type == "sex":
+        return "SELECT Patient_ID AS patient_id, Sex AS value FROM Patient"
+    if query_type == "age_as_of":
+        date = quote(query_args["reference_date"])
+        return (
+            f"SELECT Patient_ID AS patient_id, "
+            f"CAST(strftime('%Y', {date}) AS INTEGER) - CAST(strftime('%Y', DateOfBirth) AS INTEGER) "
+            f"- (strftime('%m-%d', {date}) < strftime('%m-%d', DateOfBirth)) AS value FROM Patient"
+        )
+    if query_type == "registered_practice_as_of":
+        date = quote(query_args["date"])
+        return (
+            f"SELECT t.Patient_ID AS patient_id, Organisation.STPCode AS value FROM ("
+            f"SELECT Patient_ID, Organisation_ID, ROW_NUMBER() OVER (PARTITION BY Patient_ID "
+            f"ORDER BY StartDate DESC, EndDate DESC, Registration_ID) AS rownum "
+            f"FROM RegistrationHistory WHERE StartDate <= {date} AND EndDate > {date}) t "
+            f"LEFT JOIN Organisation ON Organisation.Organisation_ID = t.Organisation_ID "
+            f"WHERE t.rownum = 1"
+        )
+    if query_type == "registered_with_one_practice_between":
+        return (
+            f"SELECT DISTINCT Patient_ID AS patient_id, 1 AS value FROM RegistrationHistory "
+            f"WHERE StartDate <= {quote(query_args['start_date'])} "
+            f"AND EndDate > {quote(query_args['end_date'])}"
+        )
+    if query_type == "date_deregistered_from_all_supported_practices":
+        joins = set()
+        return (
+            f"SELECT patient_id, value FROM (SELECT Patient_ID AS patient_id, MAX(EndDate) AS value "
+            f"FROM RegistrationHistory GROUP BY Patient_ID) t "
+            f"WHERE value < {quote(MISSING_DATE)} AND {between_sql('value', query_args.get('between'), joins)}"
+        )
+    if query_type in ("address_as_of", "care_home_status_as_of"):
+        date = quote(query_args["date"])
+        if query_type == "address_as_of":
+            value = "ImdRankRounded"
+        else:
+            columns = dict(
+                IsPotentialCareHome="(PotentialCareHomeAddress.PatientAddress_ID IS NOT NULL)",
+                LocationRequiresNursing="LocationRequiresNursing",
+                LocationDoesNotRequireNursing="LocationDoesNotRequireNursing",
+            )
+            value = case_sql(query_args["categorised_as"], columns)
+        return (
+            f"SELECT patient_id, value FROM (SELECT PatientAddress.Patient_ID AS patient_id, "
+            f"{value} AS value, ROW_NUMBER() OVER (PARTITION BY PatientAddress.Patient_ID "
+            f"ORDER BY StartDate DESC, EndDate DESC, MSOACode = 'NPC', PatientAddress.PatientAddress_ID) AS rownum "
+            f"FROM PatientAddress LEFT JOIN PotentialCareHomeAddress "
+            f"ON PatientAddress.PatientAddress_ID = PotentialCareHomeAddress.PatientAddress_ID "
+            f"WHERE StartDate <= {date} AND EndDate > {date}) t WHERE rownum = 1"
+        )
+    raise ValueError(f"No benchmark query for {query_type} ({name})")
+
+
+def condition_sql(tree, columns):
+    # an expression as a SQL condition, false rather than NULL for missing
+    # values, as in cohortextractor
+    kind = tree[0]
+    if kind in ("and", "or"):
+        return f"({condition_sql(tree[1], columns)} {kind.upper()} {condition_sql(tree[2], columns)})"
+    if kind == "not":
+        return f"(NOT {condition_sql(tree[1], columns)})"
+    if kind == "compare":
+        operator, left, right = tree[1:]
+        left_sql, right_sql = value_sql(left, columns), value_sql(right, columns)
+        # text compared with a number is compared as a number
+        if right[0] == "value" and not isinstance(right[1], str):
+            left_sql = f"CAST({left_sql} AS REAL)"
+        if left[0] == "value" and not isinstance(left[1], str):
+            right_sql = f"CAST({right_sql} AS REAL)"
+        operator = "!=" if operator == "<>" else operator
+        return f"COALESCE({left_sql} {operator} {right_sql}, 0)"
+    value = value_sql(tree, columns)
+    return f"COALESCE({value} != 0 AND {value} != '', 0)"
+
+
+def value_sql(tree, columns):
+    kind = tree[0]
+    if kind == "column":
+        return columns[tree[1]]
+    if kind == "value":
+        return quote(tree[1])
+    if kind == "arithmetic":
+        operator, left, right = tree[1:]
+        if operator == "/":
+            return f"({value_sql(left, columns)} * 1.0 / {value_sql(right, columns)})"
+        return f"({value_sql(left, columns)} {operator} {value_sql(right, columns)})"
+    return condition_sql(tree, columns)
+
+
+def case_sql(category_definitions, columns):
+    default = next(key for key, value in category_definitions.items() if value == "DEFAULT")
+    cases = " ".join(
+        f"WHEN {condition_sql(parse_expression(expression), columns)} THEN {quote(key)}"
+        for key, expression in category_definitions.items()
+        if expression != "DEFAULT"
+    )
+    return f"CASE {cases} ELSE {quote(default)} END"
+
+
+def aggregate_sql(query_args, columns):
+    # MIN/MAX of the columns that aren't missing
+    if query_args["column_type"] == "date":
+        missing = quote(MISSING_DATE) if query_args["aggregate_function"] == "MIN" else "''"
+    else:
+        missing = "1e308" if query_args["aggregate_function"] == "MIN" else "-1e308"
+    values = ", ".join(f"COALESCE({columns[name]}, {missing})" for name in query_args["column_names"])
+    return f"NULLIF({query_args['aggregate_function']}({values}, {missing}), {missing})"
+
+
+def formatted_date(column, query_args):
+    # dates truncated to their date_format, as the TPP backend does
+    if "date_format" not in query_args or query_args.get("returning") in ("binary_flag", "category"):
+        return column
+    length = dict(YYYY=4, YYYY_MM=7).get((query_args["date_format"] or "YYYY").replace("-", "_"))
+    return f"substr({column}, 1, {length})" if length else column
+
+
+def output_sql(definitions, base_variables):
+    # the final join, with derived variables calculated in it as the TPP
+    # backend does
+    columns = {}
+    output_columns = {}
+    for name, (query_type, query_args) in definitions.items():
+        if query_type == "categorised_as":
+            columns[name] = case_sql(query_args["category_definitions"], columns)
+        elif query_type == "aggregate_of":
+            columns[name] = aggregate_sql(query_args, columns)
+        elif query_type == "value_from":
+            columns[name] = f"v_{query_args['source']}.date"
+        elif query_type == "fixed_value":
+            columns[name] = quote(query_args["value"])
+        elif query_args.get("returning") == "binary_flag" or query_type in FLAG_QUERY_TYPES:
+            columns[name] = f"COALESCE(v_{name}.value, 0)"
+        else:
+            columns[name] = f"v_{name}.value"
+        output_columns[name] = formatted_date(columns[name], query_args)
+    output = ", ".join(
+        f"{output_columns[name]} AS {name}"
+        for name, (_, query_args) in definitions.items()
+        if name != "population" and not query_args.get("hidden")
+    )
+    joins = "".join(
+        f" LEFT JOIN v_{name} ON v_{name}.patient_id = Patient.Patient_ID" for name in base_variables
+    )
+    return f"SELECT Patient.Patient_ID AS patient_id, {output} FROM Patient{joins} WHERE {columns['population']} = 1"
+
+
+# RUNNING
+
+
+def run_benchmark(path, definitions):
+    connection = sqlite3.connect(path)
+    variables = {}
+    base_variables = []
+    for name, (query_type, query_args) in definitions.items():
+        if query_type in DERIVED_QUERY_TYPES:
+            continue
+        start = time.perf_counter()
+        sql = variable_sql(connection, name, query_type, query_args)
+        connection.execute(f"CREATE TEMP TABLE v_{name} AS {sql}")
+        connection.execute(f"CREATE INDEX temp.ix_v_{name} ON v_{name} (patient_id)")
+        seconds = time.perf_counter() - start
+        rows = connection.execute(f"SELECT COUNT(*) FROM v_{name}").fetchone()[0]
+        variables[name] = dict(
+            family=FAMILIES.get(query_type, "demographics"), seconds=seconds, rows_returned=rows
+        )
+        base_variables.append(name)
+
+    start = time.perf_counter()
+    output_rows = sum(1 for _ in connection.execute(output_sql(definitions, base_variables)))
+    output_seconds = time.perf_counter() - start
+    connection.close()
+
+    families = {}
+    for variable in variables.values():
+        families[variable["family"]] = families.get(variable["family"], 0.0) + variable["seconds"]
+    families["output"] = output_seconds
+    return variables, families, output_rows
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    study = load_compiled_study(args.study_definition)
+    definitions = study.covariate_definitions
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    for scale in args.scale:
+        size = int(float(scale))
+        path = os.path.join(
+            BENCHMARK_DIR, f"synthetic_{size}_{args.seed}_{args.events_per_patient:g}.sqlite"
+        )
+        if not os.path.exists(path):
+            start = time.perf_counter()
+            build_database(
+                path, definitions, size, args.seed, args.events_per_patient, args.codelist_fraction
+            )
+            print(f"Built {path} in {time.perf_counter() - start:.1f}s")
+
+        variables, families, output_rows = run_benchmark(path, definitions)
+        total_seconds = sum(families.values())
+        report = dict(
+            format=BENCHMARK_FORMAT,
+            commit=git_commit(),
+            started=datetime.datetime.now().isoformat(timespec="seconds"),
+            study_definition=args.study_definition,
+            patients=size,
+            seed=args.seed,
+            events_per_patient=args.events_per_patient,
+            output_rows=output_rows,
+            total_seconds=total_seconds,
+            families=families,
+            variables=variables,
+            costs={name: variable["seconds"] for name, variable in variables.items()},
+        )
+        report_path = args.output or os.path.join(BENCHMARK_DIR, f"benchmark_{size}.json")
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"{size} patients: {total_seconds:.2f}s ({output_rows} in population), written to {report_path}")
+        for family, seconds in sorted(families.items(), key=lambda item: -item[1]):
+            print(f"  {family:20} {seconds:9.3f}s")
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"{before['commit']} -> {after['commit']} ({after['patients']} patients)")
+    rows = [("total", before["total_seconds"], after["total_seconds"])] + [
+        (family, before["families"].get(family), after["families"].get(family))
+        for family in sorted(set(before["families"]) | set(after["families"]))
+    ]
+    for family, old, new in rows:
+        if old is None or new is None:
+            print(f"  {family:20} {old if old is not None else '-':>9} -> {new if new is not None else '-':>9}")
+        else:
+            print(f"  {family:20} {old:9.3f}s -> {new:9.3f}s ({new / old if old else float('inf'):.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--study-definition", default="study_definition_cohort")
+    run_parser.add_argument("--scale", nargs="+", default=["1e4"], help="numbers of patients")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--events-per-patient", type=float, default=10)
+    run_parser.add_argument(
+        "--codelist-fraction",
+        type=float,
+        default=0.01,
+        help="fraction of coded events with a code from the study's codelists",
+    )
+    run_parser.add_argument("--output", help="defaults to output/benchmark/benchmark_<scale>.json")
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
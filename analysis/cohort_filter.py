@@ -0,0 +1,396 @@
+import argparse
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from expressions import parse_expression
+
+try:
+    from pyroaring import BitMap
+except ImportError:
+    # sparse masks are kept as sorted arrays of positions instead
+    BitMap = None
+
+# COMPILED COHORT FILTERS
+# evaluates `satisfying` and `categorised_as` expressions (in the dialect
+# described in expressions.py, with the same results) over the columns of
+# an extracted cohort or of dummy data, as masks of the patients they're
+# true for:
+#
+#   - flags true for under SPARSE_FRACTION of patients (e.g. hiv,
+#     history_any_guillain_barre) are kept as the positions they're true
+#     at, as roaring bitmaps if pyroaring is installed, so AND with them
+#     only looks at those patients
+#   - other conditions are numpy boolean arrays
+#   - categories (stp, age_group, ...) are compared by their codes, with the
+#     literal looked up in the categories once
+#   - dates are compared as days since 1970-01-01, with a "YYYY-MM-DD"
+#     literal converted once
+#
+# a CohortIndex keeps the columns converted and the mask of every condition
+# it has evaluated, so sub-cohorts that share conditions with the population
+# (e.g. the population AND NOT hcw) only evaluate what's new, e.g.
+#
+#   python analysis/cohort_filter.py --where "age >= 65 AND NOT hcw" \
+#       --output output/cohort_65_plus.feather
+
+SPARSE_FRACTION = 0.01
+ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+class Column:
+    # a column's values as a numpy array, with `valid` false where missing.
+    # kind is bool, number, date (days since 1970-01-01), text or category,
+    # for which values are codes into `categories`
+    def __init__(self, kind, values, valid, categories=None):
+        self.kind = kind
+        self.values = values
+        self.valid = valid
+        self.categories = categories
+
+    def decoded(self):
+        # category values as text
+        if self.kind != "category":
+            return self
+        values = np.where(self.valid, self.categories[np.maximum(self.values, 0)], None)
+        return Column("text", values, self.valid)
+
+    def numeric(self):
+        # text compared with a number is compared as a number, as the
+        # database does for e.g. `imd > 0`
+        if self.kind == "category":
+            categories = pd.to_numeric(pd.Series(self.categories, dtype=object), errors="coerce")
+            numbers = categories.to_numpy(dtype=np.float64)[np.maximum(self.values, 0)]
+        elif self.kind == "text":
+            numbers = pd.to_numeric(pd.Series(self.values, dtype=object), errors="coerce").to_numpy(
+                dtype=np.float64
+            )
+        else:
+            return self
+        return Column("number", numbers, self.valid & ~np.isnan(numbers))
+
+
+def arrow_column(values):
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    valid = ~values.is_null().to_numpy(zero_copy_only=False)
+    if pa.types.is_dictionary(values.type):
+        codes = values.indices.fill_null(-1).to_numpy().astype(np.int64)
+        categories = values.dictionary.to_numpy(zero_copy_only=False).astype(object)
+        return Column("category", codes, valid, categories)
+    if pa.types.is_date32(values.type):
+        days = values.cast(pa.int32()).fill_null(0).to_numpy().astype(np.int64)
+        return Column("date", days, valid)
+    if pa.types.is_boolean(values.type):
+        return Column("bool", values.fill_null(False).to_numpy(zero_copy_only=False), valid)
+    if pa.types.is_integer(values.type) or pa.types.is_floating(values.type):
+        return Column("number", values.fill_null(0).to_numpy(), valid)
+    return Column("text", values.to_numpy(zero_copy_only=False).astype(object), valid)
+
+
+def to_column(values):
+    if isinstance(values, Column):
+        return values
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        return arrow_column(values)
+    series = values if isinstance(values, pd.Series) else pd.Series(values)
+    valid = series.notna().to_numpy()
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories.to_numpy().astype(object)
+        return Column("category", series.cat.codes.to_numpy().astype(np.int64), valid, categories)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        days = series.to_numpy().astype("datetime64[D]").view(np.int64)
+        return Column("date", days, valid)
+    if pd.api.types.is_bool_dtype(series):
+        return Column("bool", series.fillna(False).to_numpy(dtype=bool), valid)
+    if pd.api.types.is_numeric_dtype(series):
+        return Column("number", series.to_numpy(dtype=np.float64, na_value=0), valid)
+    return Column("text", series.to_numpy(dtype=object), valid)
+
+
+class Sparse:
+    # the positions a condition is true at
+    def __init__(self, positions):
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+
+def sparse(positions):
+    positions = np.asarray(positions, dtype=np.int64)
+    if BitMap is not None:
+        return Sparse(BitMap(positions.astype(np.uint32)))
+    return Sparse(positions)
+
+
+def positions_array(mask):
+    if isinstance(mask, Sparse):
+        positions = mask.positions
+        if BitMap is not None:
+            return np.asarray(positions.to_array(), dtype=np.int64)
+        return positions
+    return np.flatnonzero(mask)
+
+
+def compact(mask):
+    # a dense mask that's true for few enough patients as a Sparse one
+    if np.count_nonzero(mask) < SPARSE_FRACTION * len(mask):
+        return sparse(np.flatnonzero(mask))
+    return mask
+
+
+def dense(mask, size):
+    if not isinstance(mask, Sparse):
+        return mask
+    values = np.zeros(size, dtype=bool)
+    values[positions_array(mask)] = True
+    return values
+
+
+def mask_and(left, right, size):
+    if isinstance(left, Sparse) and isinstance(right, Sparse):
+        if BitMap is not None:
+            return Sparse(left.positions & right.positions)
+        return Sparse(np.intersect1d(left.positions, right.positions, assume_unique=True))
+    if isinstance(right, Sparse):
+        left, right = right, left
+    if isinstance(left, Sparse):
+        positions = positions_array(left)
+        return sparse(positions[right[positions]])
+    return left & right
+
+
+def mask_or(left, right, size):
+    if isinstance(left, Sparse) and isinstance(right, Sparse):
+        if BitMap is not None:
+            return Sparse(left.positions | right.positions)
+        return Sparse(np.union1d(left.positions, right.positions))
+    if isinstance(right, Sparse):
+        left, right = right, left
+    if isinstance(left, Sparse):
+        values = right.copy()
+        values[positions_array(left)] = True
+        return values
+    return left | right
+
+
+def truth(value, size):
+    # a mask of where a value counts as true when used on its own
+    if isinstance(value, (np.ndarray, Sparse)):
+        return value
+    if not isinstance(value, Column):
+        return np.full(size, bool(value) and not pd.isna(value))
+    if value.kind == "bool":
+        return compact(value.values & value.valid)
+    if value.kind == "number":
+        return compact(value.valid & (value.values != 0))
+    if value.kind == "date":
+        return compact(value.valid)
+    if value.kind == "category":
+        nonempty = np.array([category != "" for category in value.categories], dtype=bool)
+        return compact(value.valid & nonempty[np.maximum(value.values, 0)])
+    return compact(value.valid & (value.values != ""))
+
+
+COMPARE = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<>": np.not_equal,
+    "<": np.less,
+    ">": np.greater,
+    "<=": np.less_equal,
+    ">=": np.greater_equal,
+}
+ARITHMETIC = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.true_divide}
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_date_column(value):
+    return isinstance(value, Column) and value.kind == "date"
+
+
+def day_number(value):
+    # a "YYYY-MM-DD" literal compared with a date column as a day number, as
+    # pandas compares it with datetimes
+    if isinstance(value, str) and ISO_DATE_RE.match(value):
+        return int(np.datetime64(value, "D").astype(np.int64))
+    return value
+
+
+def compare(operator, left, right, size):
+    if isinstance(left, Column) and is_number(right):
+        left = left.numeric()
+    if isinstance(right, Column) and is_number(left):
+        right = right.numeric()
+    if is_date_column(left):
+        right = day_number(right)
+    if is_date_column(right):
+        left = day_number(left)
+    # a category compared for equality with a literal compares the codes
+    for column, literal in ((left, right), (right, left)):
+        if (
+            isinstance(column, Column)
+            and column.kind == "category"
+            and isinstance(literal, str)
+            and operator in ("=", "!=", "<>")
+        ):
+            matches = np.flatnonzero(column.categories == literal)
+            code = matches[0] if len(matches) else -2
+            return compact(COMPARE[operator](column.values, code) & column.valid)
+    if isinstance(left, Column) and isinstance(right, Column):
+        left, right = left.decoded(), right.decoded()
+    elif isinstance(left, Column):
+        left = left.decoded()
+    elif isinstance(right, Column):
+        right = right.decoded()
+    left_values = left.values if isinstance(left, Column) else left
+    right_values = right.values if isinstance(right, Column) else right
+    if not isinstance(left, Column) and not isinstance(right, Column):
+        result = np.full(size, bool(COMPARE[operator](left, right)))
+    else:
+        result = np.asarray(COMPARE[operator](left_values, right_values), dtype=bool)
+    # a comparison with a missing value is never true
+    for value in (left, right):
+        if isinstance(value, Column):
+            result = result & value.valid
+        elif pd.isna(value):
+            result = np.zeros(size, dtype=bool)
+    return compact(result)
+
+
+def arithmetic(operator, left, right):
+    if not isinstance(left, Column) and not isinstance(right, Column):
+        return ARITHMETIC[operator](left, right).item()
+    valid = np.ones(1, dtype=bool)
+    values = []
+    for value in (left, right):
+        if isinstance(value, Column):
+            value = value.numeric() if value.kind in ("text", "category") else value
+            valid = valid & value.valid
+            values.append(value.values)
+        else:
+            values.append(value)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = ARITHMETIC[operator](*values)
+    return Column("number", result, np.broadcast_to(valid, result.shape))
+
+
+class CohortIndex:
+    def __init__(self, columns):
+        # columns is a pyarrow Table, a DataFrame or a {name: values} dict
+        if isinstance(columns, pa.Table):
+            columns = {name: columns.column(name) for name in columns.column_names}
+        elif isinstance(columns, pd.DataFrame):
+            columns = {name: columns[name] for name in columns.columns}
+        self.sources = columns
+        self.size = len(next(iter(columns.values())))
+        self.columns = {}
+        # results of the conditions evaluated so far, by their parsed tree
+        self.results = {}
+
+    def column(self, name):
+        if name not in self.columns:
+            if name not in self.sources:
+                raise KeyError(f"No column {name!r} to evaluate expressions with")
+            self.columns[name] = to_column(self.sources[name])
+        return self.columns[name]
+
+    def evaluate(self, tree):
+        if tree in self.results:
+            return self.results[tree]
+        kind = tree[0]
+        if kind == "column":
+            result = self.column(tree[1])
+        elif kind == "value":
+            return tree[1]
+        elif kind == "not":
+            result = ~dense(self.truth(tree[1]), self.size)
+        elif kind in ("and", "or"):
+            left = self.truth(tree[1])
+            right = self.truth(tree[2])
+            combine = mask_and if kind == "and" else mask_or
+            result = combine(left, right, self.size)
+        elif kind == "arithmetic":
+            result = arithmetic(tree[1], self.evaluate(tree[2]), self.evaluate(tree[3]))
+        else:
+            result = compare(tree[1], self.evaluate(tree[2]), self.evaluate(tree[3]), self.size)
+        self.results[tree] = result
+        return result
+
+    def truth(self, tree):
+        key = ("truth", tree)
+        if key not in self.results:
+            self.results[key] = truth(self.evaluate(tree), self.size)
+        return self.results[key]
+
+    def condition(self, expression):
+        # the mask (a boolean array, or Sparse) of where an expression is true
+        tree = parse_expression(expression) if isinstance(expression, str) else expression
+        return self.truth(tree)
+
+    def mask(self, expression):
+        return dense(self.condition(expression), self.size)
+
+    def positions(self, expression):
+        return positions_array(self.condition(expression))
+
+    def categories(self, category_definitions):
+        # the first category whose expression is true for each row, or the
+        # DEFAULT category, as in categorised_as
+        defaults = [key for key, value in category_definitions.items() if value == "DEFAULT"]
+        if len(defaults) != 1:
+            raise ValueError("Exactly one category must be given the definition 'DEFAULT'")
+        values = np.full(self.size, defaults[0], dtype=object)
+        assigned = np.zeros(self.size, dtype=bool)
+        for key, expression in category_definitions.items():
+            if key == defaults[0]:
+                continue
+            positions = self.positions(expression)
+            positions = positions[~assigned[positions]]
+            values[positions] = key
+            assigned[positions] = True
+        return values
+
+
+def evaluate_categories(category_definitions, columns):
+    # expressions.evaluate_categories, with compiled masks
+    values = CohortIndex(columns).categories(category_definitions)
+    if isinstance(columns, pd.DataFrame):
+        return pd.Series(values, index=columns.index)
+    first = next(iter(columns.values()))
+    return pd.Series(values, index=first.index if isinstance(first, pd.Series) else None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_cohort.feather")
+    parser.add_argument("--where", required=True, help="a satisfying expression")
+    parser.add_argument("--output", help="write the patients it's true for to this feather file")
+    args = parser.parse_args()
+
+    table = feather.read_table(args.input, memory_map=True)
+    index = CohortIndex(table)
+    start = time.perf_counter()
+    positions = index.positions(args.where)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{len(positions)} of {table.num_rows} patients ({elapsed * 1000:.1f}ms, "
+        f"{'roaring' if BitMap is not None else 'array'} sparse masks)"
+    )
+    if args.output:
+        tmp_path = f"{args.output}.tmp"
+        feather.write_feather(table.take(positions), tmp_path, compression="zstd")
+        os.replace(tmp_path, args.output)
+
+
+if __name__ == "__main__":
+    main()
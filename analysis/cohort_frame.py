@@ -0,0 +1,89 @@
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from convert_cohort import combine_parts, study_kinds, write_parts
+
+# LOAD THE EXTRACTED COHORT AS A COMPACT DATAFRAME
+# read with pandas, every column of input_cohort.csv is an object column of
+# strings, at around 50-60 bytes per value. load_cohort() returns the same
+# columns typed by convert_cohort.py, at 1-4 bytes per value:
+#
+#   - dates (YYYY-MM-DD, and YYYY-MM and YYYY as the first of the month or
+#     year) as nullable int32 days since 1970-01-01
+#   - flags as int8
+#   - categories (age_group, stp, imd, ethnicity, ...) as pandas
+#     categoricals, with int8 or int16 codes
+#   - whole numbers (age, ...) in the smallest type that holds them
+#
+# e.g. load_cohort("output/input_cohort.feather", columns=["age", "sex"]).
+# a CSV is converted to feather first, a chunk at a time, with the column
+# types of the study definition it was extracted with. run as a script to
+# print the memory used by each column.
+
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+def compact_column(column):
+    # a pandas series for an arrow column typed by convert_cohort.py
+    if pa.types.is_date32(column.type):
+        days = column.cast(pa.int32())
+        return pd.arrays.IntegerArray(
+            days.fill_null(0).to_numpy(), days.is_null().to_numpy(zero_copy_only=False)
+        )
+    if pa.types.is_boolean(column.type):
+        return column.fill_null(False).cast(pa.int8()).to_numpy()
+    if pa.types.is_dictionary(column.type):
+        return column.to_pandas()
+    if pa.types.is_integer(column.type):
+        values = column.to_pandas()
+        if column.null_count:
+            values = values.astype(pd.Int64Dtype())
+        return pd.to_numeric(values, downcast="integer")
+    return column.to_pandas()
+
+
+def load_cohort(path, columns=None, study_definition="study_definition_cohort"):
+    if path.endswith(".feather"):
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    else:
+        kinds = study_kinds(study_definition)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            feather_path = os.path.join(tmp_dir, "cohort.feather")
+            parts_dir = os.path.join(tmp_dir, "parts")
+            combine_parts(write_parts(path, parts_dir, 64, kinds), feather_path)
+            table = feather.read_table(feather_path, columns=columns)
+    return pd.DataFrame(
+        {name: compact_column(table.column(name)) for name in table.column_names}
+    )
+
+
+def to_dates(days):
+    # int32 days since 1970-01-01 as datetime64, for presentation
+    return pd.Series(EPOCH + days.to_numpy(dtype="float64", na_value=np.nan).astype("timedelta64[D]"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_cohort.feather")
+    parser.add_argument(
+        "--study-definition",
+        default="study_definition_cohort",
+        help="the study definition a CSV input was extracted with, for the column types",
+    )
+    args = parser.parse_args()
+
+    cohort = load_cohort(args.input, study_definition=args.study_definition)
+    usage = cohort.memory_usage(index=False, deep=True)
+    for name, size in usage.items():
+        print(f"{name:50} {str(cohort[name].dtype):20} {size / len(cohort):6.2f} bytes/patient")
+    print(f"{len(cohort)} patients, {usage.sum() / len(cohort):.1f} bytes/patient in total")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import time
+
+import cohortextractor
+from cohortextractor import StudyDefinition
+from cohortextractor.cohortextractor import load_study_definition
+
+from expressions import parse_expression, parsed_expressions
+from study_graph import dependency_graph, levels
+
+# COMPILED STUDY PLAN CACHE
+# importing a study definition builds every variable from the generate_*
+# factories, resolves its date expressions, and (with DATABASE_URL set) has
+# the backend parse each categorised_as/satisfying expression and write the
+# SQL for every query. load_compiled_study() does that once and writes the
+# result to output/study_plans/ as a plan of
+#
+#   - the study's covariate definitions, with dates resolved, and its
+#     expectations
+#   - the backend and its generated queries (without the database URL)
+#   - each variable's dependencies
+#   - the parsed expressions, for dummy data and cohort_filter.py
+#
+# keyed by a hash of the study definition's name and params, the database
+# URL, cohortextractor's version and the contents of analysis/ and
+# codelists/. later loads, e.g. dummy data, --sql dry runs, profiling or
+# repeat extractions with the scripts in analysis/, read the plan instead of
+# importing the study definition. to compile, or see what's in, a plan
+#
+#   python analysis/compiled_study.py --study-definition study_definition_cohort
+#
+# studies run with --param snapshot=<id> aren't cached, as the variables
+# they query depend on what's in the variable cache (see variable_cache.py).
+# neither are studies that read a file of patients (which_exist_in_file or
+# with_value_from_file, e.g. study_definition_indexed): the backend writes
+# the file's rows into its queries, so the plan would hold patient data and
+# go stale when the file changes.
+
+PLAN_DIR = "output/study_plans"
+# bump if the layout of plans changes
+CACHE_FORMAT = 1
+SOURCE_DIRS = ["analysis", "codelists"]
+SKIPPED_DIRS = {"__pycache__"}
+# attributes that are set again when a plan is loaded rather than stored:
+# the database URL (which has the credentials), the connection, and the
+# pandas converters, which are local functions and can't be pickled
+STUDY_UNSTORED = {"backend", "database_url", "temporary_database", "pandas_csv_args"}
+BACKEND_UNSTORED = {"database_url", "_db_connection"}
+FILE_QUERY_TYPES = {"which_exist_in_file", "with_value_from_file"}
+
+
+def sources_hash(key):
+    # adds the path and contents of every source file to the key
+    for source_dir in SOURCE_DIRS:
+        for directory, dirnames, filenames in sorted(os.walk(source_dir)):
+            dirnames[:] = sorted(name for name in dirnames if name not in SKIPPED_DIRS)
+            for filename in sorted(filenames):
+                if filename.endswith((".py", ".csv", ".json")):
+                    path = os.path.join(directory, filename)
+                    with open(path, "rb") as f:
+                        key.update(f"\0{path}\0".encode())
+                        key.update(f.read())
+    return key
+
+
+def plan_path(study_definition, params, plan_dir=PLAN_DIR):
+    key = hashlib.sha256()
+    for part in (
+        CACHE_FORMAT,
+        cohortextractor.__version__,
+        study_definition,
+        json.dumps(dict(params), sort_keys=True),
+        os.environ.get("DATABASE_URL", ""),
+        os.environ.get("TEMP_DATABASE_NAME", ""),
+    ):
+        key.update(f"\0{part}".encode())
+    sources_hash(key)
+    return os.path.join(plan_dir, f"{study_definition}.{key.hexdigest()[:16]}.pickle")
+
+
+def reads_files(study):
+    return any(
+        query_type in FILE_QUERY_TYPES
+        for query_type, _ in study.covariate_definitions.values()
+    )
+
+
+def study_expressions(definitions):
+    # {expression: parsed tree} of every categorised_as expression
+    return {
+        expression: parse_expression(expression)
+        for query_type, query_args in definitions.values()
+        if query_type == "categorised_as"
+        for expression in query_args["category_definitions"].values()
+        if expression != "DEFAULT"
+    }
+
+
+def compile_plan(study_definition, study):
+    backend = None
+    if study.backend is not None:
+        backend = (
+            type(study.backend),
+            {
+                name: value
+                for name, value in vars(study.backend).items()
+                if name not in BACKEND_UNSTORED
+            },
+        )
+    return dict(
+        format=CACHE_FORMAT,
+        study_definition=study_definition,
+        study={name: value for name, value in vars(study).items() if name not in STUDY_UNSTORED},
+        backend=backend,
+        dependencies=dependency_graph(study.covariate_definitions),
+        expressions=study_expressions(study.covariate_definitions),
+    )
+
+
+def restore_study(plan):
+    # a StudyDefinition as it was when the plan was compiled, without
+    # importing the study definition
+    study = StudyDefinition.__new__(StudyDefinition)
+    vars(study).update(plan["study"])
+    study.pandas_csv_args = study.get_pandas_csv_args(study.covariate_definitions)
+    study.database_url = os.environ.get("DATABASE_URL")
+    study.temporary_database = os.environ.get("TEMP_DATABASE_NAME")
+    study.backend = None
+    if plan["backend"] is not None:
+        backend_class, state = plan["backend"]
+        study.backend = backend_class.__new__(backend_class)
+        vars(study.backend).update(state)
+        study.backend.database_url = study.backend.modify_dsn(study.database_url)
+    parsed_expressions.update(plan["expressions"])
+    return study
+
+
+def read_plan(path):
+    try:
+        with open(path, "rb") as f:
+            plan = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    if plan.get("format") != CACHE_FORMAT:
+        return None
+    return plan
+
+
+def write_plan(path, plan):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so a half-written plan is never read
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        # e.g. a read-only checkout; the study is still returned
+        pass
+
+
+def load_compiled_study(study_definition, params=(), plan_dir=PLAN_DIR):
+    # same as cohortextractor's load_study_definition, from the study's
+    # compiled plan when there is one
+    params = dict(params)
+    if params.get("snapshot"):
+        return load_study_definition(study_definition, params=params)
+    path = plan_path(study_definition, params, plan_dir)
+    plan = read_plan(path)
+    if plan is not None:
+        cohortextractor.params.clear()
+        cohortextractor.params.update(params)
+        return restore_study(plan)
+    study = load_study_definition(study_definition, params=params)
+    if not reads_files(study):
+        write_plan(path, compile_plan(study_definition, study))
+    return study
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study-definition", default="study_definition_cohort")
+    parser.add_argument("--param", action="append", default=[], help="KEY=VALUE")
+    parser.add_argument("--plan-dir", default=PLAN_DIR)
+    args = parser.parse_args()
+
+    params = dict(param.split("=", 1) for param in args.param)
+    path = plan_path(args.study_definition, params, args.plan_dir)
+    cached = read_plan(path) is not None
+    start = time.perf_counter()
+    study = load_compiled_study(args.study_definition, params, args.plan_dir)
+    seconds = time.perf_counter() - start
+    plan = read_plan(path)
+    if plan is None:
+        print(f"Loaded {args.study_definition} in {seconds:.2f}s without a plan")
+        return
+    print(f"{'Loaded' if cached else 'Compiled'} {path} in {seconds:.2f}s")
+    queries = len(study.backend.queries) if study.backend is not None else 0
+    print(
+        f"{len(study.covariate_definitions)} variables in "
+        f"{len(levels(plan['dependencies']))} levels, {len(plan['expressions'])} expressions, "
+        f"{queries} queries"
+    )
+
+
+if __name__ == "__main__":
+    main()
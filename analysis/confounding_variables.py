@@ -1,7 +1,35 @@
 from cohortextractor import filter_codes_by_category, patients, combine_codelists
 from codelists import *
+from event_variables import (
+    clinical_event_variables,
+    event_table_variables,
+    history_flag,
+    first_date_on_or_before,
+)
 from datetime import datetime, timedelta
 
+# CLINICAL COMORBIDITIES RECORDED IN PRIMARY CARE
+# variable name: (codelist, column), all relative to the index date
+comorbidity_events = dict(
+    ## cancer
+    ### haematological
+    haem_cancer_date=(haematological_cancer, first_date_on_or_before(date_format="YYYY-MM")),
+    ### non-haematological
+    nonhaem_nonlung_cancer_date=(cancer_excluding_lung_and_haematological, first_date_on_or_before(date_format="YYYY-MM")),
+    ### lung
+    lung_cancer_date=(lung_cancer, first_date_on_or_before(date_format="YYYY-MM")),
+    ## diabetes
+    diabetes=(diabetes, history_flag(return_expectations={"incidence": 0.20})),
+    ## hiv
+    hiv=(hiv, history_flag(return_expectations={"incidence": 0.20})),
+    ## hypertension
+    hypertension=(hypertension, history_flag(return_expectations={"incidence": 0.40})),
+    ## AUTOIMMUNE CONDITIONS
+    antiphospholipid=(antiphospholipid, history_flag(return_expectations={"incidence": 0.20})),
+    rheumatoid_arthritis=(rheumatoid_arthritis, history_flag(return_expectations={"incidence": 0.20})),
+    lupus=(lupus, history_flag(return_expectations={"incidence": 0.20})),
+)
+
 
 def generate_confounding_variables(index_date_variable):
 
@@ -20,11 +48,10 @@ def generate_confounding_variables(index_date_variable):
     ), 
     # CLINICAL COMORBIDITIES 
     ## history of outcome events - for exclusion for each specific analysis 
-    history_bells_palsy_gp=patients.with_these_clinical_events(
+    **clinical_event_variables(
         bells_palsy_primary_care_codes,
-        between=[f"{index_date_variable} - 1 year", f"{index_date_variable}"],
-        returning="binary_flag",
-        return_expectations={"incidence": 0.15},
+        index_date_variable,
+        history_bells_palsy_gp=history_flag("1 year", return_expectations={"incidence": 0.15}),
     ),
     history_bells_palsy_hospital=patients.admitted_to_hospital(
         with_these_diagnoses=bells_palsy_secondary_care_codes,
@@ -40,11 +67,10 @@ def generate_confounding_variables(index_date_variable):
     ), 
     history_any_bells_palsy=patients.satisfying("history_bells_palsy_gp OR history_bells_palsy_hospital OR history_bells_palsy_emergency"),
 
-    history_transverse_myelitis_gp=patients.with_these_clinical_events(
+    **clinical_event_variables(
         transverse_myelitis_primary_care_codes,
-        between=[f"{index_date_variable} - 1 year", f"{index_date_variable}"],
-        returning="binary_flag",
-        return_expectations={"incidence": 0.15},
+        index_date_variable,
+        history_transverse_myelitis_gp=history_flag("1 year", return_expectations={"incidence": 0.15}),
     ),
     history_transverse_myelitis_hospital=patients.admitted_to_hospital(
         with_these_diagnoses=transverse_myelitis_secondary_care_codes,
@@ -54,11 +80,10 @@ def generate_confounding_variables(index_date_variable):
     ),
     history_any_transverse_myelitis=patients.satisfying("history_transverse_myelitis_gp OR history_transverse_myelitis_hospital"), 
 
-    history_guillain_barre_gp=patients.with_these_clinical_events(
+    **clinical_event_variables(
         guillain_barre_primary_care_codes,
-        between=[f"{index_date_variable} - 1 year", f"{index_date_variable}"],
-        returning="binary_flag",
-        return_expectations={"incidence": 0.15},
+        index_date_variable,
+        history_guillain_barre_gp=history_flag("1 year", return_expectations={"incidence": 0.15}),
     ),
     history_guillain_barre_hospital=patients.admitted_to_hospital(
         with_these_diagnoses=guillain_barre_secondary_care_codes,
@@ -68,115 +93,23 @@ def generate_confounding_variables(index_date_variable):
     ),
     history_any_guillain_barre=patients.satisfying("history_guillain_barre_gp OR history_guillain_barre_hospital"), 
 
-    ### MS/NO
-    history_ms_no_gp=patients.with_these_clinical_events(
-        ms_no_primary_care,
-        on_or_before=f"{index_date_variable}",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.01},
-    ),
-
-    fu_ms_no_gp=patients.with_these_clinical_events(
+    ### MS/NO (first date after the index date in followup_variables.py)
+    **clinical_event_variables(
         ms_no_primary_care,
-        on_or_after=f"{index_date_variable}",
-        find_first_match_in_period=True, 
-        returning="date", 
-        date_format="YYYY-MM-DD",
+        index_date_variable,
+        history_ms_no_gp=history_flag(return_expectations={"incidence": 0.01}),
     ),
 
-    ### CIDP
-    history_cidp_gp=patients.with_these_clinical_events(
+    ### CIDP (first date after the index date in followup_variables.py)
+    **clinical_event_variables(
         cidp_primary_care,
-        on_or_before=f"{index_date_variable}",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.01},
+        index_date_variable,
+        history_cidp_gp=history_flag(return_expectations={"incidence": 0.01}),
     ),
 
-    fu_cidp_gp=patients.with_these_clinical_events(
-        cidp_primary_care,
-        on_or_after=f"{index_date_variable}",
-        find_first_match_in_period=True, 
-        returning="date", 
-        date_format="YYYY-MM-DD",
-    ),
+    ## cancer, diabetes, hiv, hypertension and autoimmune conditions
+    **event_table_variables(comorbidity_events, index_date_variable),
 
-    ## cancer 
-    ### haematological 
-    haem_cancer_date=patients.with_these_clinical_events(
-        haematological_cancer,
-        on_or_before=f"{index_date_variable}",
-        find_first_match_in_period=True, 
-        returning="date",
-        date_format="YYYY-MM", 
-    ),
-    ### non-haematological 
-    nonhaem_nonlung_cancer_date=patients.with_these_clinical_events(
-        cancer_excluding_lung_and_haematological,
-        on_or_before=f"{index_date_variable}",
-        find_first_match_in_period=True, 
-        returning="date",
-        date_format="YYYY-MM", 
-    ),
-    ### lung
-    lung_cancer_date=patients.with_these_clinical_events(
-        lung_cancer,
-        on_or_before=f"{index_date_variable}",
-        find_first_match_in_period=True, 
-        returning="date",
-        date_format="YYYY-MM", 
-    ),
-    ## diabetes
-    diabetes=patients.with_these_clinical_events(
-        diabetes,
-        on_or_before=f"{index_date_variable}",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.20},
-    ),
-    ## hiv
-    hiv=patients.with_these_clinical_events(
-        hiv,
-        on_or_before=f"{index_date_variable}",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.20},
-    ),
-    ## COVID test 
-    first_positive_covid_test=patients.with_test_result_in_sgss(
-        pathogen="SARS-CoV-2",
-        test_result="positive",
-        on_or_after="2020-02-01",
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest" : "2020-02-01"},
-        "incidence" : 0.25},
-    ),
-
-    ## hypertension
-    hypertension=patients.with_these_clinical_events(
-        hypertension,
-        on_or_before=f"{index_date_variable}",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.40},
-    ),
-    ## AUTOIMMUNE CONDITIONS
-    antiphospholipid=patients.with_these_clinical_events(
-        antiphospholipid,
-        on_or_before=f"{index_date_variable}",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.20},
-    ),
-    rheumatoid_arthritis=patients.with_these_clinical_events(
-        rheumatoid_arthritis,
-        on_or_before=f"{index_date_variable}",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.20},
-    ),
-    lupus=patients.with_these_clinical_events(
-        lupus,
-        on_or_before=f"{index_date_variable}",
-        returning="binary_flag",
-        return_expectations={"incidence": 0.20},
-    ),
     # OTHER VARIABLES 
     ## Health care worker status 
     hcw=patients.with_healthcare_worker_flag_on_covid_vaccine_record(returning='binary_flag', return_expectations=None), 
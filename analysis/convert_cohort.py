@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+# CONVERT THE EXTRACTED COHORT TO FEATHER, ONE CHUNK AT A TIME
+# cohortextractor streams CSV output to disk in batches of patients, but
+# builds the whole cohort as a dataframe in memory to write any other format.
+# so generate_cohort writes csv.gz and this converts it to a typed feather
+# file while only ever holding one chunk of patients in memory:
+#
+#   1. each chunk of the CSV is written, as strings, to a part file in
+#      <output>.parts/ and the distinct values of its category columns are
+#      recorded in a checkpoint, so a killed job picks up from the last
+#      finished chunk
+#   2. the values seen in every chunk are combined into each category
+#      column's dictionary and the parts are converted and appended to the
+#      feather file in order
+#
+# the kind of each column comes from the study definition, as the backend
+# writes it, so the schema is the same whatever is in the extract: dates are
+# stored as date32 (days since 1970-01-01, with YYYY-MM and YYYY dates as
+# the first day of the month or year), flags as bit-packed booleans, numbers
+# as int64 or float64, and text and categorised_as columns (e.g. sex, imd,
+# ethnicity) as dictionary-encoded categories. with --native-dates, the
+# study definition's date columns are day numbers (see native_dates.py) and
+# are stored as date32 as they are, rather than being read as text.
+
+DATE_KINDS = {"YYYY-MM-DD": "date", "YYYY-MM": "month", "YYYY": "year", None: "year"}
+# columns with more distinct values than this are kept as plain strings. a
+# part with more than this many stops collecting them
+MAX_CATEGORIES = 10000
+
+
+def date_format(definitions, name):
+    # minimum_of/maximum_of dates have the format of the columns they use
+    query_type, query_args = definitions[name]
+    if query_type == "aggregate_of":
+        return date_format(definitions, query_args["column_names"][0])
+    return query_args.get("date_format")
+
+
+def column_kinds(definitions, day_columns=()):
+    # {column: kind} for every column of the extract, from the study's
+    # covariate definitions, with day_columns the columns of day numbers
+    kinds = dict(patient_id="int")
+    for name, (query_type, query_args) in definitions.items():
+        if name == "population" or query_args.get("hidden"):
+            continue
+        column_type = query_args["column_type"]
+        if name in day_columns:
+            kinds[name] = "days"
+        elif column_type == "date":
+            kinds[name] = DATE_KINDS[date_format(definitions, name)]
+        elif column_type == "bool":
+            kinds[name] = "flag"
+        elif column_type == "str" or query_type == "categorised_as":
+            kinds[name] = "category"
+        else:
+            kinds[name] = column_type
+    return kinds
+
+
+def study_kinds(study_definition, native_dates=False):
+    # imported here, so reading a converted cohort (and load_cohort) only
+    # needs pyarrow, not cohortextractor and the codelists
+    from compiled_study import load_compiled_study
+
+    study = load_compiled_study(study_definition)
+    day_columns = set()
+    if native_dates:
+        from native_dates import native_date_columns
+
+        day_columns.update(native_date_columns(study.covariate_definitions))
+    return column_kinds(study.covariate_definitions, day_columns)
+
+
+def convert_column(column, kind, categories):
+    if kind == "flag":
+        return pc.equal(column, "1")
+    if kind == "int":
+        return pc.cast(column, pa.int64())
+    if kind == "float":
+        return pc.cast(column, pa.float64())
+    if kind == "days":
+        return pc.cast(pc.cast(column, pa.int32()), pa.date32())
+    if kind in ("date", "month", "year"):
+        if kind == "month":
+            column = pc.binary_join_element_wise(column, "01", "-")
+        elif kind == "year":
+            column = pc.binary_join_element_wise(column, "01-01", "-")
+        timestamps = pc.strptime(column, format="%Y-%m-%d", unit="s")
+        return pc.cast(timestamps, pa.date32())
+    if categories is not None:
+        indices = pc.index_in(column, value_set=categories)
+        return pa.DictionaryArray.from_arrays(indices, categories)
+    return column
+
+
+def arrow_type(kind, categories):
+    if kind == "category" and categories is not None:
+        return pa.dictionary(pa.int32(), pa.string())
+    return dict(
+        flag=pa.bool_(),
+        int=pa.int64(),
+        float=pa.float64(),
+        date=pa.date32(),
+        month=pa.date32(),
+        year=pa.date32(),
+        days=pa.date32(),
+    ).get(kind, pa.string())
+
+
+def load_checkpoint(path, signature):
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get("signature") != signature:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def write_parts(input_path, parts_dir, chunk_size_mb, kinds):
+    # returns the checkpoint for the finished parts, with kinds the
+    # column_kinds of the extract
+    stat = os.stat(input_path)
+    signature = dict(
+        input=os.path.abspath(input_path),
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        chunk_size_mb=chunk_size_mb,
+        kinds=kinds,
+    )
+    checkpoint_path = os.path.join(parts_dir, "checkpoint.json")
+    checkpoint = load_checkpoint(checkpoint_path, signature)
+    if checkpoint is None:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+        checkpoint = dict(signature=signature, parts=[], complete=False)
+    elif checkpoint["complete"]:
+        return checkpoint
+
+    # read every column as a string, with empty values as nulls
+    header = pacsv.open_csv(input_path).schema.names
+    reader = pacsv.open_csv(
+        input_path,
+        read_options=pacsv.ReadOptions(block_size=chunk_size_mb * 2**20),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in header},
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True,
+        ),
+    )
+    for chunk_number, batch in enumerate(reader):
+        if chunk_number < len(checkpoint["parts"]):
+            # already written before the job was interrupted
+            continue
+        part_path = os.path.join(parts_dir, f"part-{chunk_number:05d}.arrow")
+        with pa.ipc.new_file(part_path, batch.schema) as writer:
+            writer.write_batch(batch)
+        categories = {}
+        for name, column in zip(batch.schema.names, batch.columns):
+            if kinds.get(name) == "category":
+                values = pc.unique(column.drop_null())
+                # None for too many to keep as a category
+                categories[name] = values.to_pylist() if len(values) <= MAX_CATEGORIES else None
+        checkpoint["parts"].append(dict(path=part_path, rows=batch.num_rows, categories=categories))
+        save_checkpoint(checkpoint_path, checkpoint)
+        print(f"Wrote chunk {chunk_number} ({batch.num_rows} rows)")
+
+    checkpoint["complete"] = True
+    checkpoint["columns"] = header
+    save_checkpoint(checkpoint_path, checkpoint)
+    return checkpoint
+
+
+def combine_parts(checkpoint, output_path):
+    parts = checkpoint["parts"]
+    # columns the study doesn't describe are kept as text
+    kinds = {
+        name: checkpoint["signature"]["kinds"].get(name, "text")
+        for name in checkpoint["columns"]
+    }
+    categories = {}
+    for name in checkpoint["columns"]:
+        if kinds[name] != "category":
+            continue
+        values = set()
+        for part in parts:
+            if part["categories"][name] is None:
+                break
+            values.update(part["categories"][name])
+            if len(values) > MAX_CATEGORIES:
+                break
+        else:
+            categories[name] = pa.array(sorted(values), pa.string())
+    schema = pa.schema(
+        [
+            (name, arrow_type(kinds[name], categories.get(name)))
+            for name in checkpoint["columns"]
+        ]
+    )
+
+    tmp_path = f"{output_path}.tmp"
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    with pa.ipc.new_file(tmp_path, schema, options=options) as writer:
+        for part in parts:
+            with pa.memory_map(part["path"]) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i)
+                    columns = [
+                        convert_column(
+                            batch.column(name), kinds[name], categories.get(name)
+                        )
+                        for name in schema.names
+                    ]
+                    writer.write_batch(pa.record_batch(columns, schema=schema))
+    os.replace(tmp_path, output_path)
+    return sum(part["rows"] for part in parts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_cohort.csv.gz")
+    parser.add_argument("--output", default="output/input_cohort.feather")
+    parser.add_argument(
+        "--chunk-size-mb",
+        type=int,
+        default=64,
+        help="size of each chunk of the CSV read into memory",
+    )
+    parser.add_argument(
+        "--native-dates",
+        action="store_true",
+        help="the input was extracted with native_dates.py",
+    )
+    parser.add_argument(
+        "--study-definition",
+        default="study_definition_cohort",
+        help="the study definition the input was extracted with, for the column types",
+    )
+    args = parser.parse_args()
+
+    kinds = study_kinds(args.study_definition, args.native_dates)
+    parts_dir = f"{args.output}.parts"
+    checkpoint = write_parts(args.input, parts_dir, args.chunk_size_mb, kinds)
+    rows = combine_parts(checkpoint, args.output)
+    shutil.rmtree(parts_dir)
+    print(f"Wrote {rows} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
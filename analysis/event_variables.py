@@ -0,0 +1,97 @@
+from cohortextractor import patients
+
+# COLUMNS DERIVED FROM ONE CODELIST
+# each returns a (column_type, arguments) pair, in the same way as the
+# `patients` functions, to be passed by name to clinical_event_variables.
+# with primary_care.SharedClinicalEventScan installed, the columns of one
+# codelist are all taken from the same scan of its events, e.g.
+#
+#   **clinical_event_variables(
+#       ms_no_primary_care,
+#       index_date_variable,
+#       history_ms_no_gp=history_flag(return_expectations={"incidence": 0.01}),
+#       fu_ms_no_gp=first_date_on_or_after(),
+#   )
+
+## any event in the lookback period up to the index date (or ever, if no lookback)
+def history_flag(lookback=None, return_expectations=None):
+    return "history_flag", dict(
+        lookback=lookback,
+        return_expectations=return_expectations,
+    )
+
+
+## first event on or after the index date
+def first_date_on_or_after(date_format="YYYY-MM-DD", return_expectations=None):
+    return "first_date_on_or_after", dict(
+        date_format=date_format,
+        return_expectations=return_expectations,
+    )
+
+
+## first event on or before the index date
+def first_date_on_or_before(date_format="YYYY-MM-DD", return_expectations=None):
+    return "first_date_on_or_before", dict(
+        date_format=date_format,
+        return_expectations=return_expectations,
+    )
+
+
+def clinical_event_variables(codelist, index_date_variable, **columns):
+    # every column requested of the codelist's primary care events,
+    # relative to the index date
+    clinical_event_variables = dict()
+    for name, (column_type, args) in columns.items():
+        if column_type == "history_flag":
+            if args["lookback"] is None:
+                period = dict(on_or_before=f"{index_date_variable}")
+            else:
+                period = dict(
+                    between=[f"{index_date_variable} - {args['lookback']}", f"{index_date_variable}"]
+                )
+            clinical_event_variables[name] = patients.with_these_clinical_events(
+                codelist,
+                **period,
+                returning="binary_flag",
+                return_expectations=args["return_expectations"],
+            )
+        elif column_type == "first_date_on_or_after":
+            clinical_event_variables[name] = patients.with_these_clinical_events(
+                codelist,
+                on_or_after=f"{index_date_variable}",
+                find_first_match_in_period=True,
+                returning="date",
+                date_format=args["date_format"],
+                return_expectations=args["return_expectations"],
+            )
+        elif column_type == "first_date_on_or_before":
+            clinical_event_variables[name] = patients.with_these_clinical_events(
+                codelist,
+                on_or_before=f"{index_date_variable}",
+                find_first_match_in_period=True,
+                returning="date",
+                date_format=args["date_format"],
+                return_expectations=args["return_expectations"],
+            )
+        else:
+            raise ValueError(f"Unknown column type for {name}: {column_type}")
+    return clinical_event_variables
+
+
+# COLUMNS FROM MANY CODELISTS
+# an event table maps each variable name to a (codelist, column) pair, e.g.
+#
+#   comorbidity_events = dict(
+#       diabetes=(diabetes, history_flag(return_expectations={"incidence": 0.20})),
+#       lung_cancer_date=(lung_cancer, first_date_on_or_before(date_format="YYYY-MM")),
+#   )
+
+def event_table_variables(event_table, index_date_variable):
+    # every column in the event table, in the order it is declared
+    event_table_variables = dict()
+    for name, (codelist, column) in event_table.items():
+        event_table_variables.update(
+            clinical_event_variables(codelist, index_date_variable, **{name: column})
+        )
+    return event_table_variables
+
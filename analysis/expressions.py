@@ -0,0 +1,290 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+# VECTORISED STUDY DEFINITION EXPRESSIONS
+# evaluates the expressions used in `satisfying` and `categorised_as` over
+# whole columns at once, e.g.
+#
+#   evaluate_expression('(sex = "M" OR sex = "F") AND NOT has_died', df)
+#
+# the dialect is the one cohortextractor accepts: column names, numbers,
+# quoted strings, comparisons (= != < > <= >=), arithmetic (+ - * /),
+# AND / OR / NOT and brackets. as in cohortextractor, a column used on its
+# own is true when it isn't empty (not 0, "" or a missing date), and a
+# comparison with a missing value is false.
+
+TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<number>[0-9]+(?:\.[0-9]+)?)
+        |(?P<string>'[^']*'|"[^"]*")
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<operator>>=|<=|!=|<>|=|<|>|\+|-|\*|/|\(|\))
+    )""",
+    re.VERBOSE,
+)
+KEYWORDS = {"AND", "OR", "NOT"}
+# parsed expressions by their text, as they're parsed or loaded from a
+# compiled study plan (see compiled_study.py)
+parsed_expressions = {}
+COMPARISONS = {"=", "!=", "<>", "<", ">", "<=", ">="}
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match:
+            raise ValueError(
+                f"Invalid expression at {expression[position:]!r}: {expression}"
+            )
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.upper() in KEYWORDS:
+            kind, value = "keyword", value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+
+class Parser:
+    # recursive descent, loosest binding first:
+    # OR, AND, NOT, comparison, + -, * /
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+
+    def parse(self):
+        tree = self.parse_or()
+        if self.peek() is not None:
+            self.error(f"unexpected {self.peek()[1]!r}")
+        return tree
+
+    def error(self, message):
+        raise ValueError(f"Invalid expression ({message}): {self.expression}")
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def accept(self, *values):
+        token = self.peek()
+        if token is not None and token[0] in ("keyword", "operator") and token[1] in values:
+            self.position += 1
+            return token[1]
+        return None
+
+    def parse_or(self):
+        tree = self.parse_and()
+        while self.accept("OR"):
+            tree = ("or", tree, self.parse_and())
+        return tree
+
+    def parse_and(self):
+        tree = self.parse_not()
+        while self.accept("AND"):
+            tree = ("and", tree, self.parse_not())
+        return tree
+
+    def parse_not(self):
+        if self.accept("NOT"):
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        tree = self.parse_sum()
+        operator = self.accept(*COMPARISONS)
+        if operator:
+            tree = ("compare", operator, tree, self.parse_sum())
+        return tree
+
+    def parse_sum(self):
+        tree = self.parse_product()
+        while True:
+            operator = self.accept("+", "-")
+            if not operator:
+                return tree
+            tree = ("arithmetic", operator, tree, self.parse_product())
+
+    def parse_product(self):
+        tree = self.parse_atom()
+        while True:
+            operator = self.accept("*", "/")
+            if not operator:
+                return tree
+            tree = ("arithmetic", operator, tree, self.parse_atom())
+
+    def parse_atom(self):
+        token = self.peek()
+        if token is None:
+            self.error("unexpected end")
+        kind, value = token
+        self.position += 1
+        if kind == "number":
+            return ("value", float(value) if "." in value else int(value))
+        if kind == "string":
+            return ("value", value[1:-1])
+        if kind == "name":
+            return ("column", value)
+        if value == "(":
+            tree = self.parse_or()
+            if not self.accept(")"):
+                self.error("missing ')'")
+            return tree
+        self.error(f"unexpected {value!r}")
+
+
+def parse_expression(expression):
+    # returns the expression as nested tuples, e.g. ("and", left, right)
+    tree = parsed_expressions.get(expression)
+    if tree is None:
+        tree = parsed_expressions[expression] = Parser(expression).parse()
+    return tree
+
+
+def expression_columns(expression):
+    # names of all the columns referenced in an expression
+    tree = parse_expression(expression) if isinstance(expression, str) else expression
+    if tree[0] == "column":
+        return {tree[1]}
+    if tree[0] == "value":
+        return set()
+    columns = set()
+    for child in tree[1:]:
+        if isinstance(child, tuple):
+            columns |= expression_columns(child)
+    return columns
+
+
+def rename_columns(expression, names):
+    # the expression with the columns in `names` renamed, e.g.
+    # rename_columns("a OR b", {"a": "a_1"}) == "a_1 OR b"
+    return " ".join(
+        names.get(value, value) if kind == "name" else value
+        for kind, value in tokenize(expression)
+    )
+
+
+def definition_columns(query_type, query_args):
+    # columns a derived (categorised_as, satisfying or minimum_of/maximum_of)
+    # variable is calculated from, as processed by cohortextractor
+    if query_type == "categorised_as":
+        columns = set()
+        for definition in query_args["category_definitions"].values():
+            if definition != "DEFAULT":
+                columns |= expression_columns(definition)
+        return columns
+    if query_type == "aggregate_of":
+        return set(query_args["column_names"])
+    return set()
+
+
+def is_missing(values):
+    if isinstance(values, pd.Series):
+        return values.isna()
+    return bool(pd.isna(values))
+
+
+def truthy(values):
+    # whether each value counts as true when a column is used on its own
+    if not isinstance(values, pd.Series):
+        return bool(values) and not pd.isna(values)
+    if pd.api.types.is_bool_dtype(values):
+        return values.fillna(False).astype(bool)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.notna() & (values != 0)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.notna()
+    return values.notna() & (values.astype(str) != "")
+
+
+def coerce_numeric(values, other):
+    # text columns compared with a number are compared as numbers, as the
+    # database does for e.g. `imd > 0`
+    if (
+        isinstance(values, pd.Series)
+        and not pd.api.types.is_numeric_dtype(values)
+        and not pd.api.types.is_datetime64_any_dtype(values)
+        and isinstance(other, (int, float))
+        and not isinstance(other, bool)
+    ):
+        return pd.to_numeric(values.astype(object), errors="coerce")
+    return values
+
+
+def evaluate_tree(tree, columns):
+    kind = tree[0]
+    if kind == "column":
+        return columns[tree[1]]
+    if kind == "value":
+        return tree[1]
+    if kind == "not":
+        values = truthy(evaluate_tree(tree[1], columns))
+        return ~values if isinstance(values, pd.Series) else not values
+    if kind in ("and", "or"):
+        left = truthy(evaluate_tree(tree[1], columns))
+        right = truthy(evaluate_tree(tree[2], columns))
+        return left & right if kind == "and" else left | right
+    operator, left, right = tree[1:]
+    left = evaluate_tree(left, columns)
+    right = evaluate_tree(right, columns)
+    if kind == "arithmetic":
+        if operator == "+":
+            return left + right
+        if operator == "-":
+            return left - right
+        if operator == "*":
+            return left * right
+        return left / right
+    left, right = coerce_numeric(left, right), coerce_numeric(right, left)
+    if operator == "=":
+        result = left == right
+    elif operator in ("!=", "<>"):
+        result = left != right
+    elif operator == "<":
+        result = left < right
+    elif operator == ">":
+        result = left > right
+    elif operator == "<=":
+        result = left <= right
+    else:
+        result = left >= right
+    # a comparison with a missing value is never true
+    for values in (left, right):
+        if isinstance(values, pd.Series):
+            result = result & values.notna()
+        elif is_missing(values):
+            result = False
+    return result
+
+
+def evaluate_expression(expression, columns):
+    # boolean Series with one value per row of `columns` (a DataFrame, or a
+    # dict of Series sharing an index)
+    tree = parse_expression(expression) if isinstance(expression, str) else expression
+    result = truthy(evaluate_tree(tree, columns))
+    if not isinstance(result, pd.Series):
+        index = next(iter(columns.values())).index if isinstance(columns, dict) else columns.index
+        result = pd.Series(result, index=index)
+    return result
+
+
+def evaluate_categories(category_definitions, columns):
+    # the first category whose expression is true for each row, or the
+    # DEFAULT category, as in categorised_as
+    defaults = [key for key, value in category_definitions.items() if value == "DEFAULT"]
+    if len(defaults) != 1:
+        raise ValueError("Exactly one category must be given the definition 'DEFAULT'")
+    categories = [key for key in category_definitions if key != defaults[0]]
+    conditions = [
+        evaluate_expression(category_definitions[key], columns).to_numpy()
+        for key in categories
+    ]
+    values = np.select(conditions, np.array(categories, dtype=object), defaults[0])
+    index = next(iter(columns.values())).index if isinstance(columns, dict) else columns.index
+    return pd.Series(values, index=index)
@@ -0,0 +1,98 @@
+from cohortextractor import filter_codes_by_category, patients, combine_codelists
+from codelists import *
+from event_variables import clinical_event_variables, first_date_on_or_after
+from outcome_variables import generate_outcome_variables
+from vaccine_variables import generate_vaccine_variables
+from datetime import datetime, timedelta
+
+# FOLLOW-UP VARIABLES
+# the variables in the cohort that can change as later events are recorded,
+# all searched for on or after the index date
+
+
+def generate_followup_event_variables(index_date_variable, covid_test_on_or_after):
+    # the follow-up variables that aren't vaccinations or outcomes, as
+    # extracted for the cohort and again by the follow-up extraction.
+    # positive tests are searched for from covid_test_on_or_after
+
+    followup_event_variables = dict(
+    # CONFOUNDING VARIABLES
+    **clinical_event_variables(ms_no_primary_care, index_date_variable, fu_ms_no_gp=first_date_on_or_after()),
+    **clinical_event_variables(cidp_primary_care, index_date_variable, fu_cidp_gp=first_date_on_or_after()),
+    first_positive_covid_test=patients.with_test_result_in_sgss(
+        pathogen="SARS-CoV-2",
+        test_result="positive",
+        on_or_after=covid_test_on_or_after,
+        find_first_match_in_period=True,
+        returning="date",
+        date_format="YYYY-MM-DD",
+        return_expectations={"date": {"earliest" : "2020-02-01"},
+        "incidence" : 0.25},
+    ),
+
+    # SELECTION VARIABLES
+    ### pregnancy
+    pregnancy=patients.with_these_clinical_events(
+        preg,
+        returning="date",
+        find_first_match_in_period=True,
+        on_or_after=f"{index_date_variable}",
+        return_expectations={"incidence": 0.01}
+    ),
+    ### died after index (extracted as used as a matching variable, so needs to exist)
+    death_date=patients.died_from_any_cause(
+        on_or_after=f"{index_date_variable}",
+        returning="date_of_death",
+        date_format="YYYY-MM-DD",
+        return_expectations={
+            "date": {
+                "earliest": "2020-12-08",
+                "latest": "2021-05-11", },
+                "incidence": 0.01 },
+    ),
+    ### deregistered after index (extracted as used as a matching variable, so needs to exist)
+    dereg_date=patients.date_deregistered_from_all_supported_practices(
+        on_or_after=f"{index_date_variable}", date_format="YYYY-MM-DD",
+    ),
+    )
+
+    return followup_event_variables
+
+
+def place_variables(variables, placed_variables, after):
+    # variables with each of placed_variables inserted after the variable
+    # named in after, e.g. after=dict(pregnancy="history_pregnancy"), so a
+    # study's columns can keep their order when variables are shared
+    ordered = {}
+
+    def add(name, definition):
+        ordered[name] = definition
+        for placed_name, after_name in after.items():
+            if after_name == name:
+                add(placed_name, placed_variables[placed_name])
+
+    for name, definition in variables.items():
+        add(name, definition)
+    missing = set(placed_variables) - set(ordered)
+    if missing:
+        raise ValueError(f"No place for {', '.join(sorted(missing))}")
+    return ordered
+
+
+def generate_followup_variables(index_date_variable, first_dose_variable="first_any_vaccine_date"):
+
+    followup_variables = dict(
+    # VACCINATION VARIABLES
+    **generate_vaccine_variables(index_date_variable, first_dose_variable),
+
+    # OUTCOME VARIABLES
+    **generate_outcome_variables(index_date_variable),
+
+    # CONFOUNDING AND SELECTION VARIABLES (anything found before the index
+    # date was found by the previous extraction)
+    **generate_followup_event_variables(
+        index_date_variable, covid_test_on_or_after=f"{index_date_variable}"
+    ),
+    )
+
+    return followup_variables
@@ -0,0 +1,148 @@
+import argparse
+import os
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from cohortextractor.codelistlib import Codelist
+
+import codelists
+
+# MATCH ICD-10 CODELISTS AGAINST DIAGNOSIS STRINGS
+# the TPP backend matches a codelist against APCS's Der_Diagnosis_All (e.g.
+# "||G510 ,I10 ,E119") with a LIKE '%[^A-Za-z0-9]<code>%' per code, i.e. a
+# code matches where it starts a code in the string, and any longer code it's
+# the start of. Icd10Matcher puts the codes of all the codelists in one
+# prefix tree, so a string is scanned once, following the tree from the
+# start of each code in it, and every codelist with a code there is reported,
+# as a bitmask of the codelists in the order given. the time taken depends on
+# the length of the string rather than on how many codes or codelists there
+# are. death certificates (icd10u, ICD10001, ...) have one code per column,
+# matched exactly.
+#
+# prefixes() is the fewest codes that match the same strings, leaving out
+# codes that start with another code, for writing the LIKEs for several
+# codelists at once (see secondary_care.py). run as a script to list the
+# study's ICD-10 codelists and the codes they share, or to match a CSV
+# column, e.g.
+#
+#   python analysis/icd10_matcher.py --input apcs.csv --column Der_Diagnosis_All \
+#       --output apcs_matches.csv
+
+
+def icd10_codelists():
+    # {name: codelist} of every ICD-10 codelist in codelists.py
+    return {
+        name: value
+        for name, value in vars(codelists).items()
+        if isinstance(value, Codelist) and value.system == "icd10"
+    }
+
+
+class Icd10Matcher:
+    def __init__(self, codelists_by_name):
+        self.names = list(codelists_by_name)
+        # the tree as a list of nodes, each a dict of the next character to
+        # the next node, with masks[node] the codelists with a code ending
+        # there
+        self.children = [{}]
+        self.masks = [0]
+        self.exact = {}
+        for index, codelist in enumerate(codelists_by_name.values()):
+            bit = 1 << index
+            for code in codelist:
+                code = code[0] if isinstance(code, tuple) else code
+                node = 0
+                for char in code:
+                    child = self.children[node].get(char)
+                    if child is None:
+                        child = len(self.children)
+                        self.children[node][char] = child
+                        self.children.append({})
+                        self.masks.append(0)
+                    node = child
+                self.masks[node] |= bit
+                self.exact[code] = self.exact.get(code, 0) | bit
+
+    def match(self, diagnoses):
+        # the codelists with a code at the start of any code in the string,
+        # as the backend's LIKE matches them
+        mask = 0
+        previous_is_code = True
+        children, masks = self.children, self.masks
+        length = len(diagnoses)
+        for start, char in enumerate(diagnoses):
+            is_code = char.isascii() and char.isalnum()
+            if is_code and not previous_is_code:
+                node = children[0].get(char)
+                position = start + 1
+                while node is not None:
+                    mask |= masks[node]
+                    if position == length:
+                        break
+                    node = children[node].get(diagnoses[position])
+                    position += 1
+            previous_is_code = is_code
+        return mask
+
+    def match_codes(self, codes):
+        # the codelists with any of the codes, matched exactly
+        mask = 0
+        for code in codes:
+            if code:
+                mask |= self.exact.get(code, 0)
+        return mask
+
+    def codelist_names(self, mask):
+        return [name for index, name in enumerate(self.names) if mask >> index & 1]
+
+    def prefixes(self):
+        # the codes that don't start with another code, which between them
+        # match the same strings as all the codes
+        found = []
+        stack = [(0, "")]
+        while stack:
+            node, code = stack.pop()
+            if self.masks[node] and code:
+                found.append(code)
+                continue
+            for char, child in self.children[node].items():
+                stack.append((child, code + char))
+        return sorted(found)
+
+
+def match_file(matcher, path, column, output):
+    table = pacsv.read_csv(
+        path, convert_options=pacsv.ConvertOptions(column_types={column: pa.string()})
+    )
+    matches = [
+        ";".join(matcher.codelist_names(matcher.match(diagnoses or "")))
+        for diagnoses in table.column(column).to_pylist()
+    ]
+    table = table.append_column("codelists", pa.array(matches, pa.string()))
+    tmp_path = f"{output}.tmp"
+    pacsv.write_csv(table, tmp_path)
+    os.replace(tmp_path, output)
+    print(f"Matched {table.num_rows} rows, {sum(1 for match in matches if match)} with a codelist")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", help="CSV of diagnosis strings to match")
+    parser.add_argument("--column", default="Der_Diagnosis_All")
+    parser.add_argument("--output", default="output/icd10_matches.csv")
+    args = parser.parse_args()
+
+    matcher = Icd10Matcher(icd10_codelists())
+    if args.input:
+        match_file(matcher, args.input, args.column, args.output)
+        return
+    for name in matcher.names:
+        print(f"{name}: {len(getattr(codelists, name))} codes")
+    shared = {code: mask for code, mask in matcher.exact.items() if mask & (mask - 1)}
+    for code, mask in sorted(shared.items()):
+        print(f"  {code} is in {', '.join(matcher.codelist_names(mask))}")
+    print(f"{len(matcher.exact)} codes, matched by {len(matcher.prefixes())} prefixes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from followup_variables import generate_followup_variables
+
+# INCREMENTAL RE-EXTRACTION
+# follow-up variables (outcomes, later doses, deaths, ...) can only change
+# for events after the snapshot the cohort was last extracted from, so on a
+# new snapshot only those events are searched for, and only for patients
+# who are still followed up: those who hadn't died or deregistered by the
+# previous extraction and have a follow-up variable still empty. outcomes are
+# rare, so nearly every such patient has one, and the population isn't
+# narrowed further by which variables are empty; every follow-up variable is
+# extracted for each of them, and merge only uses the ones that were empty.
+#
+#   1. prepare: list the patients still followed up in the previous
+#      extraction, with the date of its snapshot, in
+#      output/followup_patients.csv
+#   2. generate_cohort --study-definition study_definition_followup
+#   3. merge: fill the empty follow-up values in the previous extraction
+#      from the follow-up extraction, and record the new snapshot's date
+#
+# the snapshot date is stored in the feather file's metadata, so each
+# refresh only needs the date of the new snapshot, e.g.
+#
+#   python analysis/incremental_cohort.py prepare --cut-date 2021-07-01
+#   cohortextractor generate_cohort --study-definition study_definition_followup \
+#       --output-format csv.gz
+#   python analysis/incremental_cohort.py merge --cut-date 2021-07-08
+
+CUT_DATE_KEY = b"cut_date"
+# follow-up ends at the first of these, so nothing after them is searched for
+END_COLUMNS = ["death_date", "dereg_date"]
+
+
+def followup_columns(previous_columns):
+    # follow-up variables in the previous extraction
+    return [name for name in generate_followup_variables("last_cut") if name in previous_columns]
+
+
+def is_empty(values):
+    # an empty date or category, or a flag or count of 0
+    if pd.api.types.is_bool_dtype(values):
+        return ~values.fillna(False).astype(bool)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.isna() | (values == 0)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.isna()
+    return values.isna() | (values.astype(str) == "")
+
+
+def read_previous(path):
+    table = feather.read_table(path)
+    metadata = table.schema.metadata or {}
+    cut_date = metadata.get(CUT_DATE_KEY)
+    df = table.to_pandas(date_as_object=False)
+    return table.schema, df, cut_date.decode() if cut_date else None
+
+
+def prepare(args):
+    schema, previous, cut_date = read_previous(args.previous)
+    cut_date = args.cut_date or cut_date
+    if cut_date is None:
+        raise ValueError(
+            f"No snapshot date stored in {args.previous}, pass the date of the "
+            "snapshot it was extracted from with --cut-date"
+        )
+    columns = followup_columns(previous.columns)
+    empty = pd.concat([is_empty(previous[name]) for name in columns], axis=1).any(axis=1)
+    followed_up = empty.copy()
+    for name in END_COLUMNS:
+        if name in previous.columns:
+            followed_up &= is_empty(previous[name])
+    patients = pd.DataFrame(
+        dict(
+            patient_id=previous.loc[followed_up, "patient_id"],
+            last_cut=cut_date,
+            first_any_vaccine_date=previous.loc[
+                followed_up, "first_any_vaccine_date"
+            ].dt.strftime("%Y-%m-%d"),
+        )
+    )
+    patients.to_csv(args.output, index=False)
+    print(
+        f"{len(patients)} of {len(previous)} patients have follow-up to extract after "
+        f"{cut_date} ({empty.sum() - followed_up.sum()} with follow-up ended left out)"
+    )
+
+
+def merge(args):
+    schema, previous, _ = read_previous(args.previous)
+    followup = pd.read_csv(args.followup, dtype=str).set_index("patient_id")
+    followup.index = followup.index.astype(previous["patient_id"].dtype)
+    columns = followup_columns(previous.columns)
+    missing = set(columns) - set(followup.columns)
+    if missing:
+        raise ValueError(f"Columns missing from {args.followup}: {', '.join(sorted(missing))}")
+    followup = followup.reindex(previous["patient_id"])
+
+    for name in columns:
+        values = previous[name]
+        new_values = followup[name].to_numpy()
+        if pd.api.types.is_bool_dtype(values):
+            new_values = new_values == "1"
+        elif pd.api.types.is_numeric_dtype(values):
+            new_values = pd.to_numeric(new_values)
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            new_values = pd.to_datetime(new_values)
+        # values found in an earlier snapshot are kept
+        previous[name] = values.where(~is_empty(values).to_numpy(), new_values)
+
+    # keep the types the previous extraction was stored with
+    table = pa.Table.from_pandas(previous, schema=schema, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**(schema.metadata or {}), CUT_DATE_KEY: args.cut_date.encode()}
+    )
+    tmp_path = f"{args.output}.tmp"
+    feather.write_feather(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, args.output)
+    print(f"Merged follow-up for {followup.notna().any(axis=1).sum()} patients into {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prepare_parser = subparsers.add_parser("prepare")
+    prepare_parser.add_argument("--previous", default="output/input_cohort.feather")
+    prepare_parser.add_argument(
+        "--cut-date",
+        help="date of the snapshot the previous extraction was run on, if not stored with it",
+    )
+    prepare_parser.add_argument("--output", default="output/followup_patients.csv")
+    prepare_parser.set_defaults(function=prepare)
+
+    merge_parser = subparsers.add_parser("merge")
+    merge_parser.add_argument("--previous", default="output/input_cohort.feather")
+    merge_parser.add_argument("--followup", default="output/input_followup.csv.gz")
+    merge_parser.add_argument(
+        "--cut-date", required=True, help="date of the snapshot the follow-up was run on"
+    )
+    merge_parser.add_argument("--output", default="output/input_cohort.feather")
+    merge_parser.set_defaults(function=merge)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
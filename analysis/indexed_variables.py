@@ -0,0 +1,146 @@
+import argparse
+import os
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
+from cohortextractor.codelistlib import Codelist
+from cohortextractor.cohortextractor import load_study_definition
+
+from expressions import rename_columns
+from study_graph import DATE_COLUMN_RE
+
+# VARIABLES AT SEVERAL INDEX DATES IN ONE EXTRACTION
+# evaluates a generate_*_variables factory against each of a set of index
+# dates, each a date column (a per-patient one such as
+# first_known_vaccine_date, or patients.fixed_value() for a calendar date),
+# with each date's variables suffixed by its label, e.g.
+# bells_palsy_gp_vaccination. references between the factory's
+# variables (in minimum_of, satisfying and dates such as
+# "first_any_vaccine_date + 21 days") are renamed to match, so the
+# variables for each index date only use each other.
+#
+# run as a script to reshape the extraction to long format, with one row per
+# patient and index date, e.g.
+#
+#   cohortextractor generate_cohort --study-definition study_definition_indexed \
+#       --param index_dates=2021-01-04,2021-03-01
+#   python analysis/indexed_variables.py --index-dates 2021-01-04,2021-03-01
+
+
+def variable_names(variables):
+    # the variables and any hidden variables nested in them
+    names = set()
+    for name, (_, query_args) in variables.items():
+        names.add(name)
+        names |= variable_names(query_args.get("extra_columns") or {})
+    return names
+
+
+def rename_references(value, names):
+    if isinstance(value, Codelist):
+        return value
+    if isinstance(value, str):
+        match = DATE_COLUMN_RE.match(value)
+        if match and match.group(1) in names:
+            return value[: match.start(1)] + names[match.group(1)] + value[match.end(1) :]
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)(rename_references(item, names) for item in value)
+    if isinstance(value, dict):
+        return {key: rename_references(item, names) for key, item in value.items()}
+    return value
+
+
+def rename_definition(definition, names):
+    query_type, query_args = definition
+    renamed_args = {}
+    for key, value in query_args.items():
+        if key == "category_definitions":
+            value = {
+                category: expression if expression == "DEFAULT" else rename_columns(expression, names)
+                for category, expression in value.items()
+            }
+        elif key == "extra_columns" and value:
+            value = {names[name]: rename_definition(item, names) for name, item in value.items()}
+        elif key != "return_expectations":
+            value = rename_references(value, names)
+        renamed_args[key] = value
+    return query_type, renamed_args
+
+
+def suffix_variables(variables, suffix):
+    # the variables renamed to <name>_<suffix>, along with their references
+    # to each other
+    names = {name: f"{name}_{suffix}" for name in variable_names(variables)}
+    return {
+        names[name]: rename_definition(definition, names)
+        for name, definition in variables.items()
+    }
+
+
+def generate_indexed_variables(factory, index_dates):
+    # index_dates is {label: date column}, e.g.
+    # dict(vaccination="first_known_vaccine_date", jan="index_jan_date")
+    indexed_variables = dict()
+    for label, index_date in index_dates.items():
+        indexed_variables.update(suffix_variables(factory(index_date_variable=index_date), label))
+    return indexed_variables
+
+
+def unsuffixed_name(name, label):
+    # the name of an index date's column without its label, or None if it
+    # isn't one. include_date_of_match columns are named <name>_<label>_date
+    for suffix in (f"_{label}", f"_{label}_date"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)] + suffix[len(label) + 1 :]
+    return None
+
+
+def to_long(table, index_dates):
+    # one row per patient and index date, with the index date's variables
+    # under their unsuffixed names and the other columns repeated
+    shared = [
+        name
+        for name in table.column_names
+        if not any(unsuffixed_name(name, label) for label in index_dates)
+    ]
+    parts = []
+    for label, index_date in index_dates.items():
+        columns = {name: table.column(name) for name in shared}
+        columns["index"] = pa.array([label] * table.num_rows, pa.string())
+        columns["index_date"] = table.column(index_date).cast(pa.date32())
+        for name in table.column_names:
+            if name != index_date and unsuffixed_name(name, label):
+                columns[unsuffixed_name(name, label)] = table.column(name)
+        parts.append(pa.table(columns))
+    # columns missing for some index dates, e.g. all empty, are filled with nulls
+    return pa.concat_tables(parts, promote_options="default")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study-definition", default="study_definition_indexed")
+    parser.add_argument("--input", default="output/input_indexed.csv.gz")
+    parser.add_argument("--output", default="output/input_indexed_long.feather")
+    parser.add_argument(
+        "--index-dates", default="", help="as passed to generate_cohort with --param"
+    )
+    args = parser.parse_args()
+
+    index_dates = load_study_definition(
+        args.study_definition, value="index_dates", params={"index_dates": args.index_dates}
+    )
+    table = pacsv.read_csv(args.input)
+    long_table = to_long(table, index_dates)
+    tmp_path = f"{args.output}.tmp"
+    feather.write_feather(long_table, tmp_path, compression="zstd")
+    os.replace(tmp_path, args.output)
+    print(
+        f"Wrote {long_table.num_rows} rows ({table.num_rows} patients, "
+        f"{len(index_dates)} index dates) to {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+# MATCH UNVACCINATED CONTROLS TO VACCINATED PATIENTS
+# sequential risk-set sampling on the extracted cohort: each vaccinated
+# (exposed) patient, in order of first_known_vaccine_date, is matched to
+# controls with the same age_group, stp and sex who on that date are
+#
+#   - not yet vaccinated (first_known_vaccine_date after it, or none)
+#   - alive (death_date after it, or none)
+#   - registered (dereg_date after it, or none)
+#   - not already a control for someone else
+#
+# a control can go on to be vaccinated and matched as an exposed patient
+# later on. the output has the input columns for each exposed patient and
+# their controls, with
+#
+#   - match_id, the patient_id of the exposed patient
+#   - exposed, whether it is the exposed patient
+#   - index_date, the exposed patient's vaccination date
+#
+# exposed patients no control could be found for are left out.
+#
+# the candidate controls in each stratum are put in a random order, and each
+# exposed patient takes the next ones still eligible. as the exposure dates
+# only go up, a candidate that isn't eligible on one of them is never
+# eligible again, so each candidate is looked at once, and each exposed
+# patient gets a uniformly random choice of the eligible controls left.
+
+DEFAULT_MATCH_ON = ["age_group", "stp", "sex"]
+# days since 1970-01-01 for a missing date, i.e. never
+NEVER = np.iinfo(np.int32).max
+
+
+def day_numbers(column):
+    # date32 column as days since 1970-01-01, with missing dates as NEVER
+    return column.cast(pa.int32()).fill_null(NEVER).to_numpy()
+
+
+def strata(table, match_on):
+    # a number for each patient's combination of values of the columns in
+    # match_on, from 0 to the number of combinations
+    codes = np.zeros(table.num_rows, dtype=np.int64)
+    for name in match_on:
+        column = table.column(name).combine_chunks()
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        encoded = pc.dictionary_encode(column)
+        # missing values are their own category
+        values = encoded.indices.fill_null(len(encoded.dictionary)).to_numpy()
+        codes = codes * (len(encoded.dictionary) + 1) + values
+    _, inverse = np.unique(codes, return_inverse=True)
+    return inverse
+
+
+def match(stratum, exposure_date, end_date, controls, rng):
+    # returns the positions of the exposed patients and their controls, in
+    # pairs. end_date is when a patient stops being eligible as a control
+    order = np.lexsort((rng.random(len(stratum)), stratum))
+    candidate_end = end_date[order].tolist()
+    bounds = np.searchsorted(stratum[order], np.arange(stratum.max(initial=-1) + 2))
+    position = bounds[:-1].tolist()
+    stop = bounds[1:].tolist()
+    order = order.tolist()
+
+    exposed = np.flatnonzero(exposure_date != NEVER)
+    exposed = exposed[np.argsort(exposure_date[exposed], kind="stable")]
+    matched_exposed = []
+    matched_controls = []
+    for patient, patient_stratum, date in zip(
+        exposed.tolist(), stratum[exposed].tolist(), exposure_date[exposed].tolist()
+    ):
+        p = position[patient_stratum]
+        end = stop[patient_stratum]
+        found = 0
+        while found < controls and p < end:
+            if candidate_end[p] > date:
+                matched_exposed.append(patient)
+                matched_controls.append(order[p])
+                found += 1
+            p += 1
+        position[patient_stratum] = p
+    return np.array(matched_exposed, dtype=np.int64), np.array(matched_controls, dtype=np.int64)
+
+
+def matched_table(table, exposed, controls, exposure_date_column):
+    # the exposed patients (once each) followed by their controls
+    exposed_once = np.unique(exposed)
+    positions = np.concatenate([exposed_once, controls])
+    match_positions = np.concatenate([exposed_once, exposed])
+    patient_ids = table.column("patient_id").take(match_positions)
+    index_dates = table.column(exposure_date_column).take(match_positions)
+    matched = table.take(positions)
+    matched = matched.append_column("match_id", patient_ids)
+    matched = matched.append_column(
+        "exposed",
+        pa.array(np.arange(len(positions)) < len(exposed_once), pa.bool_()),
+    )
+    return matched.append_column("index_date", index_dates.cast(pa.date32()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_cohort.feather")
+    parser.add_argument("--output", default="output/matched_cohort.feather")
+    parser.add_argument("--match-on", nargs="+", default=DEFAULT_MATCH_ON)
+    parser.add_argument("--exposure-date", default="first_known_vaccine_date")
+    parser.add_argument(
+        "--censor-dates",
+        nargs="+",
+        default=["death_date", "dereg_date"],
+        help="dates after which a patient can't be a control",
+    )
+    parser.add_argument("--controls", type=int, default=1, help="per exposed patient")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    table = feather.read_table(args.input, memory_map=True)
+    exposure_date = day_numbers(table.column(args.exposure_date))
+    end_date = exposure_date
+    for name in args.censor_dates:
+        end_date = np.minimum(end_date, day_numbers(table.column(name)))
+
+    exposed, controls = match(
+        strata(table, args.match_on),
+        exposure_date,
+        end_date,
+        args.controls,
+        np.random.default_rng(args.seed),
+    )
+    matched = matched_table(table, exposed, controls, args.exposure_date)
+
+    tmp_path = f"{args.output}.tmp"
+    feather.write_feather(matched, tmp_path, compression="zstd")
+    os.replace(tmp_path, args.output)
+    exposed_count = int((exposure_date != NEVER).sum())
+    matched_count = len(np.unique(exposed))
+    print(
+        f"Matched {matched_count} of {exposed_count} exposed patients to "
+        f"{len(controls)} controls, written to {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import argparse
+import datetime
+import time
+
+from cohortextractor.date_expressions import MSSQLDateFormatter
+from cohortextractor.tpp_backend import ColumnExpression, escape_identifer, is_iso_date, quote
+
+from compiled_study import load_compiled_study
+from primary_care import SharedClinicalEventScan
+from secondary_care import SharedSecondaryCareScan, SharedVaccinationScan
+
+# NATIVE DATE COLUMNS
+# the TPP backend turns every date into a string in the database
+# (CONVERT(VARCHAR(10), ..., 23)), so minimum_of compares strings, dates
+# relative to another variable (e.g. "first_any_vaccine_date + 21 days") parse
+# the string back into a date, and convert_cohort.py parses it again. with
+# NativeDates installed on a study's backend, each date column is instead the
+# number of days since 1970-01-01, as an integer, from extraction through to
+# the output:
+#
+#   - a column's date is truncated to its date_format (the first of the month
+#     for YYYY-MM, of the year for YYYY) but not formatted, and missing dates
+#     are NULL, written as empty values
+#   - minimum_of and maximum_of take the MIN or MAX of the day numbers
+#   - date expressions add the day number to 1970-01-01
+#   - categorised_as compares day numbers, with -1 for a missing date, so
+#     "first_known_vaccine_date" on its own is still true for a patient with
+#     the date
+#
+# and convert_cohort.py --native-dates stores the day numbers as date32
+# (which is days since 1970-01-01) without reading them as text. e.g.
+#
+#   python analysis/native_dates.py --study-definition study_definition_cohort \
+#       --output output/input_cohort.csv.gz
+#   python analysis/convert_cohort.py --native-dates --study-definition study_definition_cohort
+#
+# or profile_cohort.py run --native-dates. dates defined with categorised_as
+# are still strings. the output has to be CSV, as cohortextractor parses
+# date strings when it writes other formats itself.
+
+EPOCH = datetime.date(1970, 1, 1)
+EPOCH_SQL = "'19700101'"
+# the value a missing date takes in categorised_as expressions, one of the
+# empty values cohortextractor allows there
+MISSING_DAYS = -1
+
+
+def truncated_date(column, date_format):
+    # SQL for the date, truncated to the date format
+    if date_format == "YYYY-MM":
+        return f"DATEFROMPARTS(YEAR({column}), MONTH({column}), 1)"
+    if date_format == "YYYY" or date_format is None:
+        return f"DATEFROMPARTS(YEAR({column}), 1, 1)"
+    return column
+
+
+def native_column(expression, date_format, source_tables, date=None):
+    # date is the SQL for the (truncated) date the day number is taken from,
+    # if there is one, so date expressions can use it directly
+    column = ColumnExpression(
+        expression,
+        type="date",
+        default_value=MISSING_DAYS,
+        source_tables=source_tables,
+        date_format=date_format,
+    )
+    column.native_date = True
+    column.native_source_date = date
+    return column
+
+
+def is_native(column):
+    return getattr(column, "native_date", False)
+
+
+def native_date_columns(covariate_definitions):
+    # the names of the output columns that are day numbers
+    return [
+        name
+        for name, (query_type, query_args) in covariate_definitions.items()
+        if query_args.get("column_type") == "date"
+        and query_type != "categorised_as"
+        and not query_args.get("hidden")
+    ]
+
+
+class NativeDateFormatter(MSSQLDateFormatter):
+    def get_date_expression(self, date_column):
+        if is_native(date_column):
+            if date_column.native_source_date is not None:
+                return self.cast_as_date(date_column.native_source_date)
+            return f"DATEADD(DAY, {date_column}, CAST({EPOCH_SQL} AS date))"
+        return super().get_date_expression(date_column)
+
+
+class NativeDates:
+    # stands in for the backend's date column expressions, as
+    # secondary_care.SharedSecondaryCareScan does for its queries
+    def __init__(self, backend):
+        self.backend = backend
+        self.get_column_expression = backend.get_column_expression
+        self.get_fixed_value_expression = backend.get_fixed_value_expression
+        self.get_case_expression = backend.get_case_expression
+        self.get_aggregate_expression = backend.get_aggregate_expression
+
+    def install(self):
+        self.backend.get_column_expression = self.native_column_expression
+        self.backend.get_fixed_value_expression = self.native_fixed_value_expression
+        self.backend.get_case_expression = self.native_case_expression
+        self.backend.get_aggregate_expression = self.native_aggregate_expression
+        self.backend.date_ref_to_sql_expr = self.date_ref_to_sql_expr
+        self.backend.next_temp_table_id = 1
+        self.backend.queries = self.backend.get_queries(self.backend.covariate_definitions)
+        return self
+
+    def native_column_expression(self, column_type, source, returning, date_format=None):
+        if column_type != "date":
+            return self.get_column_expression(column_type, source, returning, date_format)
+        date = truncated_date(f"#{source}.{escape_identifer(returning)}", date_format)
+        return native_column(
+            f"DATEDIFF(DAY, {EPOCH_SQL}, {date})", date_format, [f"#{source}"], date=date
+        )
+
+    def native_fixed_value_expression(self, value, column_type, date_format=None):
+        if column_type != "date":
+            return self.get_fixed_value_expression(value, column_type, date_format)
+        days = (datetime.date.fromisoformat(value) - EPOCH).days
+        return native_column(str(days), date_format, [])
+
+    def native_case_expression(self, other_columns, column_type, category_definitions, date_format=None):
+        # missing dates are -1 rather than NULL here, so that NOT and OR
+        # treat them as false, as they do empty strings
+        columns = dict(other_columns)
+        for name, column in other_columns.items():
+            if is_native(column):
+                columns[name] = ColumnExpression(
+                    f"ISNULL({column}, {MISSING_DAYS})",
+                    type=column.type,
+                    default_value=MISSING_DAYS,
+                    source_tables=column.source_tables,
+                    date_format=column.date_format,
+                )
+        return self.get_case_expression(columns, column_type, category_definitions, date_format)
+
+    def native_aggregate_expression(self, other_columns, column_type, column_names, aggregate_function):
+        columns = [other_columns[name] for name in column_names]
+        if column_type != "date" or not all(is_native(column) for column in columns):
+            return self.get_aggregate_expression(other_columns, column_type, column_names, aggregate_function)
+        assert aggregate_function in ("MIN", "MAX")
+        # MIN and MAX leave out NULLs, so a patient's missing dates are
+        # ignored and the result is NULL if they're all missing
+        components = ", ".join(f"({column})" for column in columns)
+        tables_used = set()
+        for column in columns:
+            tables_used.update(column.source_tables)
+        return native_column(
+            f"(SELECT {aggregate_function}(value) FROM (VALUES {components}) AS _table(value))",
+            columns[0].date_format,
+            list(tables_used),
+        )
+
+    def date_ref_to_sql_expr(self, date):
+        # the backend's own, with day numbers added back to a date
+        if date is None:
+            return None, []
+        if is_iso_date(date):
+            return quote(date), []
+        formatter = NativeDateFormatter(self.backend.output_columns)
+        date_expr, column_name = formatter(date)
+        return date_expr, self.backend.output_columns[column_name].source_tables
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study-definition", default="study_definition_cohort")
+    parser.add_argument("--output", default="output/input_cohort.csv.gz")
+    parser.add_argument("--param", action="append", default=[], help="KEY=VALUE")
+    parser.add_argument("--sql", action="store_true", help="print the SQL instead of running it")
+    parser.add_argument(
+        "--shared-scans",
+        action="store_true",
+        help="also share the secondary care, Vaccination and CodedEvent scans "
+        "(see secondary_care.py and primary_care.py)",
+    )
+    args = parser.parse_args()
+
+    if not args.sql and not (args.output.endswith(".csv") or args.output.endswith(".csv.gz")):
+        raise ValueError("native dates can only be written to CSV")
+    params = dict(param.split("=", 1) for param in args.param)
+    study = load_compiled_study(args.study_definition, params)
+    if study.backend is None:
+        raise RuntimeError("DATABASE_URL must be set to extract with native dates")
+    if args.shared_scans:
+        SharedSecondaryCareScan(study.backend).install()
+        SharedVaccinationScan(study.backend).install()
+        SharedClinicalEventScan(study.backend).install()
+    NativeDates(study.backend).install()
+    if args.sql:
+        print(study.to_sql())
+        return
+    start = time.perf_counter()
+    study.to_file(args.output)
+    print(f"Extracted in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from cohortextractor import filter_codes_by_category, patients, combine_codelists
 from codelists import *
+from event_variables import clinical_event_variables, first_date_on_or_after
 from datetime import datetime, timedelta
 
 
@@ -7,13 +8,10 @@ def generate_outcome_variables(index_date_variable):
     outcome_variables = dict(
 
     ## Bells Palsy
-    bells_palsy_gp=patients.with_these_clinical_events(
+    **clinical_event_variables(
         bells_palsy_primary_care_codes,
-        on_or_after=f"{index_date_variable}",
-        find_first_match_in_period=True,
-        returning="date", 
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "index_date"}},
+        index_date_variable,
+        bells_palsy_gp=first_date_on_or_after(return_expectations={"date": {"earliest": "index_date"}}),
     ),
     bells_palsy_hospital=patients.admitted_to_hospital(
         with_these_diagnoses=bells_palsy_secondary_care_codes,
@@ -43,13 +41,10 @@ def generate_outcome_variables(index_date_variable):
     any_bells_palsy=patients.minimum_of("bells_palsy_gp", "bells_palsy_hospital", "bells_palsy_death", "bells_palsy_emergency"), 
 
     ## Transverse Myelitis 
-    transverse_myelitis_gp=patients.with_these_clinical_events(
+    **clinical_event_variables(
         transverse_myelitis_primary_care_codes,
-        on_or_after=f"{index_date_variable}",
-        find_first_match_in_period=True,
-        returning="date", 
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "index_date"}},
+        index_date_variable,
+        transverse_myelitis_gp=first_date_on_or_after(return_expectations={"date": {"earliest": "index_date"}}),
     ),
     transverse_myelitis_hospital=patients.admitted_to_hospital(
         with_these_diagnoses=transverse_myelitis_secondary_care_codes,
@@ -70,13 +65,10 @@ def generate_outcome_variables(index_date_variable):
     any_transverse_myelitis=patients.minimum_of("transverse_myelitis_gp", "transverse_myelitis_hospital", "transverse_myelitis_death"), 
 
     ## Guillain Barre
-    guillain_barre_gp=patients.with_these_clinical_events(
+    **clinical_event_variables(
         guillain_barre_primary_care_codes,
-        on_or_after=f"{index_date_variable}",
-        find_first_match_in_period=True,
-        returning="date", 
-        date_format="YYYY-MM-DD",
-        return_expectations={"date": {"earliest": "index_date"}},
+        index_date_variable,
+        guillain_barre_gp=first_date_on_or_after(return_expectations={"date": {"earliest": "index_date"}}),
     ),
     guillain_barre_hospital=patients.admitted_to_hospital(
         with_these_diagnoses=guillain_barre_secondary_care_codes,
@@ -0,0 +1,447 @@
+import argparse
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from cohortextractor import expectation_generators
+from cohortextractor.study_definition import merge
+
+from cohort_filter import evaluate_categories
+from compiled_study import load_compiled_study
+from study_graph import dependency_closure, dependency_graph, levels
+
+# GENERATE A DUMMY COHORT IN PARALLEL PARTITIONS OF PATIENTS
+# every variable in the study definition is per-patient, so the population
+# is split into disjoint ranges of patient_id and each range is generated by
+# a separate worker process, --chunk-size patients at a time, so each
+# worker holds at most one chunk in memory however large the partitions
+# are. each chunk is seeded from --seed and its partition and chunk number,
+# and the partitions are written as parts and joined in order, so the output
+# doesn't depend on the number of workers, e.g.
+#
+#   python analysis/partitioned_cohort.py --expectations-population 10000000 \
+#       --partitions 64 --processes 32
+#
+# the output is csv.gz in the same layout as generate_cohort's, which can be
+# passed to convert_cohort.py, or feather with the same types as
+# convert_cohort.py writes if --output ends in .feather.
+#
+# dummy data is generated from the study's return_expectations like
+# cohortextractor's make_df_from_expectations, but every column is sampled
+# as a whole numpy array from a seeded generator. the expectations are read
+# as cohortextractor reads them (default expectations, incidence, date
+# ranges and rates, category ratios, int and float distributions, and
+# value_from dates). unlike cohortextractor, which samples every column from
+# its own expectations, derived columns are calculated from the columns they
+# use, so the dummy data is consistent:
+#
+#   - satisfying/categorised_as columns are their expressions evaluated
+#     over the generated columns (e.g. known_care_home is true exactly when
+#     care_home_type isn't empty), and their return_expectations are unused
+#   - minimum_of/maximum_of columns are the earliest/latest of their parts
+#   - a date that must be on or after another column's date (e.g.
+#     "first_any_vaccine_date + 21 days") is empty outside that bound
+#
+# the population is evaluated first: only the variables the population
+# expression depends on are generated for every patient, and the rest of the
+# study is only generated for the patients who satisfy it. pass
+# --all-patients to generate every variable for every patient and write
+# them all, as cohortextractor does.
+#
+# this only covers the dummy data path. the TPP backend builds each variable
+# over every patient before applying the population, so restricting a real
+# extraction to a range of patients wouldn't reduce the work per job.
+
+# rows generated at a time in each partition
+DEFAULT_CHUNK_SIZE = 100000
+# date expressions relative to another column, after cohortextractor has
+# resolved the ones relative to the index date
+DATE_EXPRESSION_RE = re.compile(
+    r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(?:([+-])\s*([0-9]+)\s*days?)?\s*$"
+)
+ISO_DATE_RE = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$")
+DATE_UNITS = {"YYYY-MM-DD": "D", "YYYY-MM": "M", "YYYY": "Y", None: "Y"}
+
+study = None
+age_p = None
+
+
+def age_probabilities(max_age=110):
+    # the UK population shape used by cohortextractor's population_ages
+    path = os.path.join(
+        os.path.dirname(expectation_generators.__file__), "uk_population_bands_2018.csv"
+    )
+    bands = pd.read_csv(path, thousands=",")
+    band_ends = bands["band"].str.split("-").str[1].astype(int).to_numpy()
+    counts = bands["range"].to_numpy()
+    ages = np.arange(max_age)
+    # each band is five years wide
+    p = counts[np.searchsorted(band_ends, ages)] / counts.sum() / 5
+    p[np.argmax(p)] -= p.sum() - 1
+    return p
+
+
+def expectations_for(query_args):
+    return merge(study.default_expectations, query_args.get("return_expectations") or {})
+
+
+def present(rng, size, expectations):
+    # which patients have a value, from the incidence
+    if expectations.get("rate") == "universal":
+        return np.ones(size, dtype=bool)
+    return rng.random(size) < expectations["incidence"]
+
+
+def sample_dates(rng, size, expectations):
+    # dates between the expected earliest and latest, empty for patients
+    # without a value
+    earliest = np.datetime64(expectations["date"]["earliest"], "D")
+    latest = np.datetime64(expectations["date"]["latest"], "D")
+    elapsed_days = (latest - earliest).astype(int)
+    rate = expectations.get("rate", "exponential_increase")
+    if rate == "exponential_increase":
+        # exponential going back from the latest date, cut off at the
+        # earliest, by inverting the truncated distribution's CDF
+        u = rng.random(size) * (1 - np.exp(-10))
+        days_before = (-0.1 * np.log1p(-u) * elapsed_days).astype(int)
+    elif rate in ("uniform", "universal"):
+        days_before = (rng.random(size) * elapsed_days).astype(int)
+    else:
+        raise ValueError(
+            "Only exponential_increase and uniform distributions currently supported"
+        )
+    dates = latest - days_before
+    dates[~present(rng, size, expectations)] = np.datetime64("NaT")
+    return dates
+
+
+def date_bound(value, columns):
+    # the bound given by one end of a `between`, as a date or an array of
+    # dates, or None if there isn't one
+    if value is None:
+        return None
+    if ISO_DATE_RE.match(value):
+        return np.datetime64(value, "D")
+    match = DATE_EXPRESSION_RE.match(value)
+    if not match or match.group(1) not in columns:
+        return None
+    column, sign, days = match.groups()
+    offset = np.timedelta64(int(days or 0), "D")
+    return columns[column] - offset if sign == "-" else columns[column] + offset
+
+
+def apply_date_filters(dates, between, columns):
+    if not between:
+        return dates
+    start, end = (date_bound(value, columns) for value in between)
+    outside = np.zeros(len(dates), dtype=bool)
+    # comparisons with NaT are false, so a missing bound empties the date
+    if start is not None:
+        outside |= ~(dates >= start)
+    if end is not None:
+        outside |= ~(dates <= end)
+    dates = dates.copy()
+    dates[outside] = np.datetime64("NaT")
+    return dates
+
+
+def sample_categories(rng, size, expectations):
+    ratios = expectations["category"]["ratios"]
+    probabilities = np.array(list(ratios.values()), dtype=float)
+    codes = rng.choice(len(ratios), size=size, p=probabilities / probabilities.sum())
+    codes[~present(rng, size, expectations)] = -1
+    return pd.Categorical.from_codes(codes, categories=[str(key) for key in ratios])
+
+
+def sample_numbers(rng, size, expectations, kind):
+    spec = expectations[kind]
+    distribution = spec["distribution"]
+    if distribution == "normal":
+        values = rng.normal(spec["mean"], spec["stddev"], size)
+    elif distribution == "poisson" and kind == "int":
+        values = rng.poisson(spec["mean"], size)
+    elif distribution == "population_ages" and kind == "int":
+        values = rng.choice(len(age_p), size=size, p=age_p)
+    else:
+        raise ValueError(f"Unsupported {kind} distribution '{distribution}'")
+    values = values.astype(np.int64 if kind == "int" else np.float64)
+    # patients without a value get 0, as from the database
+    values[~present(rng, size, expectations)] = 0
+    return values
+
+
+def generation_order(definitions):
+    # variables in dependency order, so dates bounded by other dates and
+    # minimum_of/maximum_of come after the columns they use
+    return [name for level in levels(dependency_graph(definitions)) for name in level]
+
+
+def derive_categories(query_args, columns):
+    # a categorised_as column calculated from the columns it uses
+    category_definitions = query_args["category_definitions"]
+    values = evaluate_categories(category_definitions, columns).to_numpy()
+    column_type = query_args["column_type"]
+    if column_type == "bool":
+        return values == 1
+    if column_type in ("int", "float"):
+        return values.astype(np.int64 if column_type == "int" else np.float64)
+    categories = [str(key) for key in category_definitions]
+    return pd.Categorical(values.astype(str), categories=categories)
+
+
+def output_columns(definitions):
+    return [
+        name
+        for name, (_, query_args) in definitions.items()
+        if name != "population" and not query_args.get("hidden")
+    ]
+
+
+def generate_columns(names, size, rng, columns=None):
+    # {name: array} for the named columns and any hidden columns they're
+    # derived from, adding to the columns already generated for the same
+    # patients
+    definitions = study.covariate_definitions
+    value_from = {
+        query_args["source"]: name
+        for name, (query_type, query_args) in definitions.items()
+        if query_type == "value_from"
+    }
+    columns = dict(columns or {})
+    needed = dependency_closure(dependency_graph(definitions), names) - set(columns)
+
+    for name in generation_order(definitions):
+        query_type, query_args = definitions[name]
+        if name not in needed or query_type == "value_from":
+            # value_from dates are generated along with their source
+            continue
+        column_type = query_args["column_type"]
+        if query_args.get("returning") in (
+            "index_of_multiple_deprivation",
+            "rural_urban_classification",
+        ):
+            # generated as categories, as cohortextractor does
+            column_type = "str"
+        if query_type == "fixed_value":
+            value = query_args["value"]
+            if column_type == "date":
+                columns[name] = np.full(size, np.datetime64(value, "D"))
+            else:
+                columns[name] = np.full(size, value)
+            continue
+        if query_type == "aggregate_of":
+            function = {"MIN": np.fmin, "MAX": np.fmax}[query_args["aggregate_function"]]
+            columns[name] = function.reduce(
+                [columns[column] for column in query_args["column_names"]]
+            )
+            continue
+        if query_type == "categorised_as":
+            columns[name] = derive_categories(query_args, columns)
+            continue
+        if query_type in ("with_value_from_file", "which_exist_in_file"):
+            raise ValueError(f"{query_type} isn't supported for {name}")
+
+        expectations = expectations_for(query_args)
+        kind = dict(date="date", str="category").get(column_type, column_type)
+        if kind != "bool" and kind not in expectations:
+            raise ValueError(f"No `{kind}` expectation defined for {name}")
+        if column_type == "date":
+            dates = sample_dates(rng, size, expectations)
+            columns[name] = apply_date_filters(dates, query_args.get("between"), columns)
+        elif column_type == "bool":
+            columns[name] = present(rng, size, expectations)
+        elif column_type in ("int", "float"):
+            columns[name] = sample_numbers(rng, size, expectations, column_type)
+        else:
+            columns[name] = sample_categories(rng, size, expectations)
+
+        if name in value_from:
+            # the source has a value exactly when its date does
+            date_name = value_from[name]
+            columns[date_name] = sample_dates(rng, size, expectations)
+            missing = np.isnat(columns[date_name])
+            if isinstance(columns[name], pd.Categorical):
+                codes = columns[name].codes.copy()
+                codes[missing] = -1
+                columns[name] = pd.Categorical.from_codes(codes, columns[name].categories)
+            else:
+                columns[name][missing] = 0
+    return columns
+
+
+def date_format(definitions, name):
+    # minimum_of/maximum_of dates have the format of the columns they use
+    query_type, query_args = definitions[name]
+    if query_type == "aggregate_of":
+        return date_format(definitions, query_args["column_names"][0])
+    return query_args.get("date_format")
+
+
+def to_arrow(values, date_format, output_format):
+    # arrays as they'd appear in the extract: dates at the requested
+    # precision, flags as 0/1 in CSV and bool in feather
+    if isinstance(values, pd.Categorical):
+        array = pa.DictionaryArray.from_arrays(
+            pa.array(values.codes, pa.int32(), mask=values.codes == -1),
+            pa.array(list(values.categories), pa.string()),
+        )
+        return array.cast(pa.string()) if output_format == "csv" else array
+    if values.dtype.kind == "M":
+        unit = DATE_UNITS[date_format]
+        if output_format == "csv":
+            strings = np.datetime_as_string(values, unit=unit)
+            return pa.array(strings, pa.string(), mask=np.isnat(values))
+        truncated = values.astype(f"datetime64[{unit}]").astype("datetime64[D]")
+        return pa.array(truncated, pa.date32(), mask=np.isnat(values))
+    if values.dtype == bool and output_format == "csv":
+        return pa.array(values.astype(np.int8))
+    return pa.array(values)
+
+
+def load_study(study_definition):
+    global study, age_p
+    study = load_compiled_study(study_definition)
+    age_p = age_probabilities()
+
+
+def generate_chunk(rng, first_patient_id, size, all_patients, output_format):
+    definitions = study.covariate_definitions
+    names = output_columns(definitions)
+    patient_ids = np.arange(first_patient_id, first_patient_id + size)
+    columns = {}
+    if not all_patients and definitions["population"][0] == "categorised_as":
+        # the rest of the study is only generated for eligible patients
+        columns = generate_columns(["population"], size, rng)
+        eligible = columns["population"]
+        columns = {name: values[eligible] for name, values in columns.items()}
+        patient_ids = patient_ids[eligible]
+    columns = generate_columns(names, len(patient_ids), rng, columns)
+
+    arrays = [pa.array(patient_ids)]
+    for name in names:
+        arrays.append(to_arrow(columns[name], date_format(definitions, name), output_format))
+    return pa.record_batch(arrays, names=["patient_id"] + names)
+
+
+def chunk_sizes(size, chunk_size):
+    # at least one chunk, so an empty partition still writes its columns
+    return [min(chunk_size, size - start) for start in range(0, size, chunk_size)] or [0]
+
+
+def generate_partition(partition, first_patient_id, size, seed, path, all_patients, chunk_size):
+    output_format = "feather" if path.endswith(".feather") else "csv"
+    writer = None
+    sink = None
+    rows = 0
+    try:
+        for chunk, chunk_rows in enumerate(chunk_sizes(size, chunk_size)):
+            rng = np.random.default_rng([seed, partition, chunk])
+            batch = generate_chunk(rng, first_patient_id, chunk_rows, all_patients, output_format)
+            if writer is None:
+                if output_format == "feather":
+                    writer = pa.ipc.new_file(path, batch.schema)
+                else:
+                    compression = "gzip" if path.endswith(".gz") else None
+                    sink = pa.output_stream(path, compression=compression)
+                    options = pacsv.WriteOptions(include_header=(partition == 0))
+                    writer = pacsv.CSVWriter(sink, batch.schema, write_options=options)
+            writer.write_batch(batch)
+            first_patient_id += chunk_rows
+            rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+    return path, rows
+
+
+def partition_sizes(population, partitions):
+    # as equal as possible, with any remainder in the first partitions
+    size, remainder = divmod(population, partitions)
+    return [size + (partition < remainder) for partition in range(partitions)]
+
+
+def join_parts(paths, output):
+    tmp_path = f"{output}.tmp"
+    if output.endswith(".feather"):
+        # every part has the schema, even if none of its patients are in
+        # the population
+        with pa.ipc.open_file(paths[0]) as part:
+            schema = part.schema
+        options = pa.ipc.IpcWriteOptions(compression="zstd")
+        with pa.ipc.new_file(tmp_path, schema, options=options) as writer:
+            for path in paths:
+                with pa.ipc.open_file(path) as part:
+                    for i in range(part.num_record_batches):
+                        writer.write_batch(part.get_batch(i))
+    else:
+        # a series of gzip members is itself a valid gzip file
+        with open(tmp_path, "wb") as joined:
+            for path in paths:
+                with open(path, "rb") as part:
+                    shutil.copyfileobj(part, joined)
+    os.replace(tmp_path, output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study-definition", default="study_definition_cohort")
+    parser.add_argument("--expectations-population", type=int, default=10000)
+    parser.add_argument("--partitions", type=int, default=os.cpu_count())
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--all-patients",
+        action="store_true",
+        help="generate every variable for every patient, ignoring the population",
+    )
+    parser.add_argument("--output", default="output/input_cohort.csv.gz")
+    args = parser.parse_args()
+    if args.partitions < 1 or args.chunk_size < 1:
+        parser.error("--partitions and --chunk-size must be at least 1")
+
+    parts_dir = f"{args.output}.parts"
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+    suffix = ".feather" if args.output.endswith(".feather") else ".csv.gz"
+    if suffix == ".csv.gz" and not args.output.endswith(".gz"):
+        suffix = ".csv"
+
+    sizes = partition_sizes(args.expectations_population, args.partitions)
+    first_patient_ids = np.cumsum([1] + sizes[:-1])
+    with ProcessPoolExecutor(
+        max_workers=args.processes,
+        initializer=load_study,
+        initargs=(args.study_definition,),
+    ) as executor:
+        parts = list(
+            executor.map(
+                generate_partition,
+                range(args.partitions),
+                first_patient_ids.tolist(),
+                sizes,
+                [args.seed] * args.partitions,
+                [
+                    os.path.join(parts_dir, f"part-{partition:05d}{suffix}")
+                    for partition in range(args.partitions)
+                ],
+                [args.all_patients] * args.partitions,
+                [args.chunk_size] * args.partitions,
+            )
+        )
+
+    join_parts([path for path, _ in parts], args.output)
+    shutil.rmtree(parts_dir)
+    rows = sum(rows for _, rows in parts)
+    print(f"Wrote {rows} of {args.expectations_population} patients to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
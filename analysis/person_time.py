@@ -0,0 +1,180 @@
+import argparse
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
+
+from match_cohort import NEVER, day_numbers
+from vaccine_registry import VACCINE_BRANDS
+
+# PERSON-TIME AND OUTCOMES IN RISK WINDOWS
+# for each patient with an index date (first_known_vaccine_date, or
+# index_date in the matched cohort), follow-up ends at the earliest of
+# death_date, dereg_date, second_any_vaccine_date and the study end. a
+# patient who isn't vaccinated on their index date (a matched control) is
+# unexposed, so their follow-up also ends the day before their own
+# first_known_vaccine_date. each risk window, e.g. 0-7 for the index date to
+# 7 days after it, is cut short at the end of follow-up, and each outcome is
+# counted if its date falls in what's left of the window. the person-days,
+# patients and events in each window are summed by age_group, sex, stp and
+# the brand of vaccine given on the index date (none for unvaccinated
+# controls), e.g.
+#
+#   python analysis/person_time.py --windows 0-7 8-21 22-42 --study-end 2021-07-11
+#
+# person-time isn't cut short at the outcomes, so it is the same for each.
+
+DEFAULT_END_DATES = ["death_date", "dereg_date", "second_any_vaccine_date"]
+DEFAULT_OUTCOMES = ["any_bells_palsy", "any_transverse_myelitis", "any_guillain_barre"]
+DEFAULT_GROUP_BY = ["age_group", "sex", "stp"]
+DEFAULT_WINDOWS = ["0-7", "8-21", "22-42"]
+
+
+def day_number(date):
+    # YYYY-MM-DD as days since 1970-01-01
+    return int(np.datetime64(date, "D").astype(np.int64))
+
+
+def parse_window(window):
+    # "8-21" is 8 to 21 days after the index date, inclusive
+    start, end = window.split("-")
+    return int(start), int(end)
+
+
+def vaccine_brand(table, index_date):
+    # the product given on the index date, taking the first in
+    # VACCINE_BRANDS if there is more than one
+    brand = np.full(table.num_rows, "none", dtype=object)
+    for product in reversed(list(VACCINE_BRANDS)):
+        product_date = day_numbers(table.column(f"first_{product}_date"))
+        brand[(product_date == index_date) & (index_date != NEVER)] = product
+    return pa.array(brand, pa.string())
+
+
+def group_column(column):
+    if pa.types.is_dictionary(column.type):
+        return column.cast(column.type.value_type)
+    return column
+
+
+def risk_windows(
+    table, index_column, exposure_column, end_columns, study_end, outcomes, windows
+):
+    # {window: (start, end, outcome events)} for each patient, with start and
+    # end as day numbers and end before start if there's no time at risk
+    index_date = day_numbers(table.column(index_column)).astype(np.int64)
+    followup_end = np.full(table.num_rows, study_end, dtype=np.int64)
+    for name in end_columns:
+        followup_end = np.minimum(followup_end, day_numbers(table.column(name)))
+    # unexposed time stops when the patient is vaccinated
+    exposure_date = day_numbers(table.column(exposure_column)).astype(np.int64)
+    unexposed = (exposure_date > index_date) & (exposure_date != NEVER)
+    followup_end[unexposed] = np.minimum(followup_end[unexposed], exposure_date[unexposed] - 1)
+    followup_end[index_date == NEVER] = -1
+    outcome_dates = {name: day_numbers(table.column(name)) for name in outcomes}
+
+    results = {}
+    for window in windows:
+        first_day, last_day = parse_window(window)
+        start = index_date + first_day
+        end = np.minimum(index_date + last_day, followup_end)
+        events = {
+            name: (dates >= start) & (dates <= end) for name, dates in outcome_dates.items()
+        }
+        results[window] = (start, end, events)
+    return followup_end, results
+
+
+def summarise(table, group_by, brand, windows):
+    # person-days, patients and events for each window and group
+    keys = {name: group_column(table.column(name)) for name in group_by}
+    summaries = []
+    for window, (start, end, events) in windows.items():
+        at_risk = end >= start
+        columns = dict(
+            keys,
+            brand=brand,
+            person_days=np.where(at_risk, end - start + 1, 0),
+            patients=at_risk,
+            **events,
+        )
+        summary = (
+            pa.table(columns)
+            .filter(pa.array(at_risk))
+            .group_by(list(group_by) + ["brand"])
+            .aggregate([(name, "sum") for name in ["person_days", "patients", *events]])
+            .sort_by([(name, "ascending") for name in [*group_by, "brand"]])
+        )
+        summary = summary.rename_columns(
+            [name.removesuffix("_sum") for name in summary.column_names]
+        )
+        summaries.append(
+            summary.add_column(0, "window", pa.array([window] * summary.num_rows, pa.string()))
+        )
+    return pa.concat_tables(summaries)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_cohort.feather")
+    parser.add_argument("--output", default="output/person_time.csv")
+    parser.add_argument(
+        "--patient-output",
+        help="also write each patient's follow-up end and events in each window",
+    )
+    parser.add_argument("--index-date", default="first_known_vaccine_date")
+    parser.add_argument(
+        "--exposure-date",
+        default="first_known_vaccine_date",
+        help="each patient's own vaccination date, ending unexposed follow-up",
+    )
+    parser.add_argument("--end-dates", nargs="+", default=DEFAULT_END_DATES)
+    parser.add_argument("--study-end", help="YYYY-MM-DD, defaults to none")
+    parser.add_argument("--outcomes", nargs="+", default=DEFAULT_OUTCOMES)
+    parser.add_argument("--windows", nargs="+", default=DEFAULT_WINDOWS)
+    parser.add_argument("--group-by", nargs="+", default=DEFAULT_GROUP_BY)
+    args = parser.parse_args()
+
+    table = feather.read_table(args.input, memory_map=True)
+    study_end = day_number(args.study_end) if args.study_end else NEVER
+    followup_end, windows = risk_windows(
+        table,
+        args.index_date,
+        args.exposure_date,
+        args.end_dates,
+        study_end,
+        args.outcomes,
+        args.windows,
+    )
+    index_date = day_numbers(table.column(args.index_date))
+    summary = summarise(table, args.group_by, vaccine_brand(table, index_date), windows)
+
+    tmp_path = f"{args.output}.tmp"
+    pacsv.write_csv(summary, tmp_path)
+    os.replace(tmp_path, args.output)
+    print(f"Wrote {summary.num_rows} rows to {args.output}")
+
+    if args.patient_output:
+        has_index = index_date != NEVER
+        columns = dict(
+            patient_id=table.column("patient_id"),
+            followup_end=pa.array(
+                followup_end.astype(np.int32), pa.int32(), mask=followup_end == NEVER
+            ).cast(pa.date32()),
+        )
+        for window, (start, end, events) in windows.items():
+            label = window.replace("-", "_")
+            columns[f"person_days_{label}"] = np.maximum(end - start + 1, 0)
+            for name, event in events.items():
+                columns[f"{name}_{label}"] = event
+        patients = pa.table(columns).filter(pa.array(has_index))
+        tmp_path = f"{args.patient_output}.tmp"
+        feather.write_feather(patients, tmp_path, compression="zstd")
+        os.replace(tmp_path, args.patient_output)
+        print(f"Wrote {patients.num_rows} patients to {args.patient_output}")
+
+
+if __name__ == "__main__":
+    main()
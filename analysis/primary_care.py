@@ -0,0 +1,186 @@
+from cohortextractor.tpp_backend import make_batches_of_insert_statements, quote
+
+from secondary_care import date_envelope
+
+# SHARED PRIMARY CARE SCAN
+# the TPP backend reads CodedEvent (or CodedEvent_SNOMED) once for every
+# with_these_clinical_events variable, joining it to that variable's
+# codelist. with the scan installed on a study's backend, every codelist the
+# study's variables use is uploaded once, into a temporary table of
+#
+#   code, codelist_id
+#
+# with a row for each code of each distinct codelist, and each event table is
+# read once, joining on the code, into a temporary table of the matching
+# events:
+#
+#   patient_id, event_date, codelist_id
+#
+# each variable's own query then takes its flag, date or count from the
+# events with its codelist's ID, with its own date limits (so dates relative
+# to other variables still work). the columns declared together for one
+# codelist with event_variables.clinical_event_variables (e.g. a history flag
+# and a follow-up date) read the same events, as do all the comorbidities in
+# an event table. e.g.
+#
+#   python analysis/secondary_care.py --shared-clinical-events \
+#       --study-definition study_definition_cohort --output output/input_cohort.csv.gz
+#
+# or profile_cohort.py run --shared-clinical-events. only flags, dates and
+# counts of matches are shared; variables returning categories, codes or
+# values, or ignoring days or missing values, and any event table with just
+# one variable, are queried as before.
+
+SOURCES = dict(
+    ctv3=dict(
+        table="CodedEvent",
+        code="CodedEvent.CTV3Code",
+        codes="#clinical_event_codes_ctv3",
+        extract="#clinical_events_ctv3",
+    ),
+    snomed=dict(
+        table="CodedEvent_SNOMED",
+        code="CodedEvent_SNOMED.ConceptID",
+        codes="#clinical_event_codes_snomed",
+        extract="#clinical_events_snomed",
+    ),
+)
+SHARED_ARGS = {
+    "codelist",
+    "between",
+    "returning",
+    "find_first_match_in_period",
+    "find_last_match_in_period",
+    "include_date_of_match",
+}
+SHARED_RETURNING = {"binary_flag", "date", "number_of_matches_in_period"}
+# arguments get_queries has already taken out, or that don't change the query
+IGNORED_ARGS = {"return_expectations", "hidden", "column_type", "date_format"}
+
+
+def shared_source(query_type, query_args):
+    # the event table a variable can be taken from, or None if it's queried
+    # as before
+    if query_type != "with_these_clinical_events":
+        return None
+    if query_args.get("returning") not in SHARED_RETURNING:
+        return None
+    for key, value in query_args.items():
+        if key not in SHARED_ARGS and key not in IGNORED_ARGS and value:
+            return None
+    return query_args["codelist"].system if query_args["codelist"].system in SOURCES else None
+
+
+def codelist_key(codelist):
+    # categorised codelists hold (code, category) pairs
+    return tuple(sorted({code[0] if isinstance(code, tuple) else code for code in codelist}))
+
+
+def shared_plan(covariate_definitions):
+    # {source: dict(variables, codelists)} for the event tables with more
+    # than one variable to share a scan, with codelists as {codes: ID}
+    plan = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        source = shared_source(query_type, query_args)
+        if source is not None:
+            plan.setdefault(source, dict(variables=[], codelists={}))
+            plan[source]["variables"].append((name, query_type, query_args))
+    plan = {source: shared for source, shared in plan.items() if len(shared["variables"]) > 1}
+    for shared in plan.values():
+        for _, _, query_args in shared["variables"]:
+            key = codelist_key(query_args["codelist"])
+            shared["codelists"].setdefault(key, len(shared["codelists"]) + 1)
+    return plan
+
+
+class SharedClinicalEventScan:
+    # stands in for the backend's get_queries_for_column, as
+    # secondary_care.SharedSecondaryCareScan does
+    def __init__(self, backend):
+        self.backend = backend
+        self.get_queries_for_column = backend.get_queries_for_column
+        self.plan = {}
+
+    def install(self):
+        self.plan = shared_plan(self.backend.covariate_definitions)
+        self.backend.get_queries_for_column = self.shared_get_queries_for_column
+        self.backend.next_temp_table_id = 1
+        self.backend.queries = self.backend.get_queries(self.backend.covariate_definitions)
+        return self
+
+    def shared_get_queries_for_column(self, column_name, query_type, query_args, output_columns):
+        source = shared_source(query_type, query_args)
+        if source not in self.plan:
+            return self.get_queries_for_column(column_name, query_type, query_args, output_columns)
+        queries = []
+        if column_name == self.plan[source]["variables"][0][0]:
+            queries.extend(self.scan_queries(source))
+        self.backend.output_columns = output_columns
+        self.backend._current_column_name = column_name
+        queries.append(self.variable_query(source, query_args))
+        self.backend._current_column_name = None
+        return queries
+
+    def scan_queries(self, source):
+        details = SOURCES[source]
+        shared = self.plan[source]
+        names = ", ".join(name for name, _, _ in shared["variables"])
+        comment = f"-- Clinical event scan of {details['table']} for {names}\n"
+        rows = sorted(
+            (code, codelist_id)
+            for codes, codelist_id in shared["codelists"].items()
+            for code in codes
+        )
+        max_code_len = max(len(code) for code, _ in rows)
+        conditions = ["1 = 1"]
+        start, end = date_envelope(shared["variables"])
+        if start:
+            conditions.append(f"{details['table']}.ConsultationDate >= {quote(start)}")
+        if end:
+            conditions.append(f"{details['table']}.ConsultationDate <= {quote(end)}")
+        return [
+            f"""{comment}
+        CREATE TABLE {details['codes']} (
+          code VARCHAR({max_code_len}) COLLATE Latin1_General_BIN NOT NULL,
+          codelist_id INT NOT NULL,
+          PRIMARY KEY (code, codelist_id)
+        )
+        """,
+            *make_batches_of_insert_statements(details["codes"], ("code", "codelist_id"), rows),
+            f"""{comment}
+        SELECT
+          {details['table']}.Patient_ID AS patient_id,
+          {details['table']}.ConsultationDate AS event_date,
+          codes.codelist_id
+        INTO {details['extract']}
+        FROM {details['table']}
+        INNER JOIN {details['codes']} AS codes
+        ON {details['code']} = codes.code
+        WHERE {' AND '.join(conditions)}
+        """,
+            f"{comment}CREATE CLUSTERED INDEX clinical_events_ix ON {details['extract']} (codelist_id, patient_id)",
+        ]
+
+    def variable_query(self, source, query_args):
+        # the variable's flag or count and date from the scan, as the
+        # backend's own query would return them
+        extract = SOURCES[source]["extract"]
+        codelist_id = self.plan[source]["codelists"][codelist_key(query_args["codelist"])]
+        if query_args["returning"] == "number_of_matches_in_period":
+            column, column_name = "COUNT(*)", "number_of_matches_in_period"
+        else:
+            column, column_name = "1", "binary_flag"
+        date_aggregate = "MIN" if query_args.get("find_first_match_in_period") else "MAX"
+        date_condition, date_joins = self.backend.get_date_condition(
+            extract, f"{extract}.event_date", query_args.get("between")
+        )
+        return f"""
+        SELECT
+          {extract}.patient_id AS patient_id,
+          {column} AS {column_name},
+          {date_aggregate}(event_date) AS date
+        FROM {extract}
+        {date_joins}
+        WHERE {extract}.codelist_id = {codelist_id} AND {date_condition}
+        GROUP BY {extract}.patient_id
+        """
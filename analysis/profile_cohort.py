@@ -0,0 +1,291 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import resource
+import time
+
+
+from compiled_study import load_compiled_study
+from native_dates import NativeDates
+from primary_care import SharedClinicalEventScan
+from secondary_care import SharedSecondaryCareScan, SharedVaccinationScan
+from study_graph import DERIVED_QUERY_TYPES, dependency_closure, dependency_graph
+
+# PROFILE EACH VARIABLE'S QUERIES
+# runs generate_cohort's extraction for a study definition with each query
+# timed, and writes a profile of every variable to <output>.profile.json and
+# logs/, e.g.
+#
+#   python analysis/profile_cohort.py run --study-definition study_definition_cohort \
+#       --output output/input_cohort.csv.gz
+#   python analysis/profile_cohort.py compare logs/profile_old.json logs/profile_new.json
+#
+# for each variable with its own queries (the codelist tables and temporary
+# table it builds), the profile has
+#
+#   - seconds, the wall time of its queries
+#   - rows_returned, the rows in its temporary table
+#   - logical_reads, reads, cpu_ms: the change in the session's counters in
+#     sys.dm_exec_sessions over its queries (the database doesn't count rows
+#     scanned, but logical reads are the 8KB pages scanned)
+#   - server_memory_kb, the session's memory after its queries, and
+#     peak_rss_kb, this process's peak memory so far
+#
+# derived variables (categorised_as, minimum_of, ...) don't have queries of
+# their own, so they're given the base queries they're calculated from and
+# the sum of their times as attributed_seconds. the profile's costs can be
+# passed to study_graph.py --costs to find the critical path. with
+# --shared-secondary-care (see secondary_care.py), the scans of APCS, ECDS and
+# ONS deaths shared by several variables are steps of their own, as is the
+# scan of Vaccination with --shared-vaccinations (see secondary_care.py) and
+# of CodedEvent with --shared-clinical-events (see primary_care.py).
+# --native-dates extracts dates as day numbers (see native_dates.py).
+
+PROFILE_FORMAT = 1
+QUERY_RE = re.compile(r"^\s*--\s*Query for (\w+)\n")
+INDEX_RE = re.compile(r"^CREATE CLUSTERED INDEX patient_id_ix ON #(\w+) ")
+CODELIST_RE = re.compile(r"^\s*--\s*Uploading codelist for (\w+)\n")
+COMMENT_RE = re.compile(r"^\s*--\s*(.+)\n")
+SESSION_COUNTERS = ["cpu_time", "reads", "logical_reads", "memory_usage"]
+
+
+def session_counters(cursor):
+    # this session's counters, or None if they can't be read
+    try:
+        cursor.execute(
+            f"SELECT {', '.join(SESSION_COUNTERS)} FROM sys.dm_exec_sessions "
+            "WHERE session_id = @@SPID"
+        )
+        return dict(zip(SESSION_COUNTERS, cursor.fetchone()))
+    except Exception:
+        return None
+
+
+class QueryProfiler:
+    # stands in for the backend's execute_queries, timing each query and
+    # recording it against the variable it's for
+    def __init__(self, backend):
+        self.backend = backend
+        self.records = []
+        self.pending = []
+
+    def execute_queries(self, queries):
+        connection = self.backend.get_db_connection()
+        cursor = connection.cursor()
+        stats_cursor = connection.cursor()
+        for query in queries:
+            comment = COMMENT_RE.match(query)
+            before = session_counters(stats_cursor)
+            start = time.perf_counter()
+            cursor.execute(query, log_desc=comment.group(1) if comment else None)
+            seconds = time.perf_counter() - start
+            after = session_counters(stats_cursor)
+            record = dict(
+                seconds=seconds,
+                rows=getattr(cursor, "rowcount", -1),
+                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            )
+            if before and after:
+                record.update(
+                    cpu_ms=after["cpu_time"] - before["cpu_time"],
+                    reads=after["reads"] - before["reads"],
+                    logical_reads=after["logical_reads"] - before["logical_reads"],
+                    server_memory_kb=after["memory_usage"] * 8,
+                )
+            self.record(query, comment, record)
+        return cursor
+
+    def record(self, query, comment, record):
+        # queries before a variable's SELECT INTO (e.g. filling its codelist
+        # table) are part of it, as is the index on its table afterwards
+        query_for = QUERY_RE.match(query)
+        for_variable = INDEX_RE.match(query) or CODELIST_RE.match(query)
+        if query_for:
+            record["returns_rows"] = True
+            for pending in self.pending:
+                pending["variable"] = query_for.group(1)
+            record["variable"] = query_for.group(1)
+            self.records.extend(self.pending)
+            self.pending = []
+            self.records.append(record)
+        elif for_variable:
+            record["variable"] = for_variable.group(1)
+            self.records.append(record)
+        elif comment:
+            # the joined output and other steps that aren't one variable's
+            record["step"] = comment.group(1)
+            self.records.extend(self.pending)
+            self.pending = []
+            self.records.append(record)
+        else:
+            self.pending.append(record)
+
+
+def variable_profile(records):
+    profile = dict(seconds=0.0, queries=0, rows_returned=None, peak_rss_kb=0)
+    for record in records:
+        profile["seconds"] += record["seconds"]
+        profile["queries"] += 1
+        profile["peak_rss_kb"] = max(profile["peak_rss_kb"], record["peak_rss_kb"])
+        if record.get("returns_rows"):
+            profile["rows_returned"] = record["rows"]
+        for counter in ("cpu_ms", "reads", "logical_reads"):
+            if counter in record:
+                profile[counter] = profile.get(counter, 0) + record[counter]
+        if "server_memory_kb" in record:
+            profile["server_memory_kb"] = record["server_memory_kb"]
+    return profile
+
+
+def build_profile(study_definition, definitions, records, started, total_seconds):
+    by_variable = {}
+    steps = {}
+    for record in records:
+        if "variable" in record:
+            by_variable.setdefault(record["variable"], []).append(record)
+        else:
+            steps.setdefault(record.get("step", "other"), []).append(record)
+
+    variables = {}
+    for name, (query_type, _) in definitions.items():
+        if name in by_variable:
+            variables[name] = dict(query_type=query_type, **variable_profile(by_variable[name]))
+    graph = dependency_graph(definitions)
+    for name, (query_type, _) in definitions.items():
+        if query_type in DERIVED_QUERY_TYPES:
+            base_queries = sorted(
+                dependency for dependency in dependency_closure(graph, [name])
+                if dependency in by_variable
+            )
+            variables[name] = dict(
+                query_type=query_type,
+                base_queries=base_queries,
+                attributed_seconds=sum(variables[base]["seconds"] for base in base_queries),
+            )
+    return dict(
+        format=PROFILE_FORMAT,
+        study_definition=study_definition,
+        started=started,
+        total_seconds=total_seconds,
+        variables=variables,
+        steps={step: variable_profile(step_records) for step, step_records in steps.items()},
+        costs={
+            name: profile["seconds"] for name, profile in variables.items() if "seconds" in profile
+        },
+    )
+
+
+def write_json(data, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run(args):
+    params = dict(param.split("=", 1) for param in args.param)
+    study = load_compiled_study(args.study_definition, params)
+    if study.backend is None:
+        raise RuntimeError("DATABASE_URL must be set to profile the extraction")
+    if args.shared_secondary_care:
+        SharedSecondaryCareScan(study.backend).install()
+    if args.shared_vaccinations:
+        SharedVaccinationScan(study.backend).install()
+    if args.shared_clinical_events:
+        SharedClinicalEventScan(study.backend).install()
+    if args.native_dates:
+        NativeDates(study.backend).install()
+    profiler = QueryProfiler(study.backend)
+    study.backend.execute_queries = profiler.execute_queries
+
+    started = datetime.datetime.now().isoformat(timespec="seconds")
+    start = time.perf_counter()
+    study.to_file(args.output)
+    total_seconds = time.perf_counter() - start
+    profile = build_profile(
+        args.study_definition,
+        study.covariate_definitions,
+        profiler.records,
+        started,
+        total_seconds,
+    )
+
+    write_json(profile, f"{args.output}.profile.json")
+    stamp = started.replace(":", "").replace("-", "")
+    write_json(profile, os.path.join(args.logs_dir, f"profile_{args.study_definition}_{stamp}.json"))
+    hottest = sorted(profile["costs"].items(), key=lambda item: -item[1])[: args.top]
+    print(f"Extracted in {total_seconds:.1f}s, slowest variables:")
+    for name, seconds in hottest:
+        rows = profile["variables"][name]["rows_returned"]
+        print(f"  {name:50} {seconds:9.1f}s {rows if rows is not None else '':>12} rows")
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)["costs"]
+    with open(args.after) as f:
+        after = json.load(f)["costs"]
+    changes = []
+    for name in sorted(set(before) | set(after)):
+        old, new = before.get(name), after.get(name)
+        if old is None or new is None:
+            changes.append((name, old, new, None))
+        elif new > old * args.threshold and new - old >= args.min_seconds:
+            changes.append((name, old, new, new / old if old else None))
+    for name, old, new, ratio in changes:
+        if old is None:
+            print(f"  {name:50} new, {new:.1f}s")
+        elif new is None:
+            print(f"  {name:50} removed, was {old:.1f}s")
+        else:
+            print(f"  {name:50} {old:9.1f}s -> {new:9.1f}s" + (f" ({ratio:.1f}x)" if ratio else ""))
+    print(f"{len(changes)} variables slower by over {args.threshold}x, added or removed")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--study-definition", default="study_definition_cohort")
+    run_parser.add_argument("--output", default="output/input_cohort.csv.gz")
+    run_parser.add_argument("--param", action="append", default=[], help="KEY=VALUE")
+    run_parser.add_argument("--logs-dir", default="logs")
+    run_parser.add_argument("--top", type=int, default=10)
+    run_parser.add_argument(
+        "--shared-secondary-care",
+        action="store_true",
+        help="read APCS, ECDS and ONS deaths once for all their variables",
+    )
+    run_parser.add_argument(
+        "--shared-vaccinations",
+        action="store_true",
+        help="read the Vaccination table once for all its variables",
+    )
+    run_parser.add_argument(
+        "--shared-clinical-events",
+        action="store_true",
+        help="read CodedEvent once for all the clinical event variables",
+    )
+    run_parser.add_argument(
+        "--native-dates",
+        action="store_true",
+        help="extract dates as day numbers rather than strings (CSV output only)",
+    )
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=1.2)
+    compare_parser.add_argument("--min-seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+import argparse
+import time
+
+from cohortextractor.tpp_backend import codelist_to_like_patterns, codelist_to_sql, is_iso_date, quote
+
+from compiled_study import load_compiled_study
+from icd10_matcher import Icd10Matcher
+from vaccine_registry import PRODUCT_IDS, TARGET_DISEASE_IDS, registered_ids
+
+# SHARED SECONDARY CARE SCAN
+# the TPP backend reads APCS, ECDS (EC) and ONS_Deaths once for every
+# admitted_to_hospital, attended_emergency_care and death certificate
+# variable. with the scan installed on a study's backend, each of these
+# tables is read once, matching all of the study's codelists together, into
+# a temporary table of the matching rows:
+#
+#   patient_id, event_date, match_0, match_1, ...
+#
+# with a match_<n> column per distinct codelist (or set of diagnosis
+# columns). each variable's own query then takes its flag, date or count from
+# that table, with its own date limits (so dates relative to other variables
+# still work). e.g.
+#
+#   python analysis/secondary_care.py --study-definition study_definition_cohort \
+#       --output output/input_cohort.csv.gz
+#
+# or profile_cohort.py run --shared-secondary-care. the scan's filter tests
+# each code once for all the variables together, leaving out ICD-10 codes
+# that start with another code in APCS's diagnoses (see icd10_matcher.py), so
+# it doesn't get more expensive with each variable using the table. only the
+# forms of these queries used in this study's variables are shared
+# (diagnoses and dates, not procedures, admission methods and so on);
+# anything else, and any table with just one variable, is queried as before.
+
+SOURCES = dict(
+    apcs=dict(
+        table="APCS_ARCHIVED",
+        from_sql=(
+            "APCS_ARCHIVED INNER JOIN APCS_Der_ARCHIVED "
+            "ON APCS_ARCHIVED.APCS_Ident = APCS_Der_ARCHIVED.APCS_Ident"
+        ),
+        patient_id="APCS_ARCHIVED.Patient_ID",
+        date="APCS_ARCHIVED.Admission_Date",
+        extract="#secondary_care_apcs",
+    ),
+    ecds=dict(
+        table="EC_ARCHIVED",
+        from_sql=(
+            "EC_ARCHIVED INNER JOIN EC_Diagnosis_ARCHIVED "
+            "ON EC_ARCHIVED.EC_Ident = EC_Diagnosis_ARCHIVED.EC_Ident"
+        ),
+        patient_id="EC_ARCHIVED.Patient_ID",
+        date="EC_ARCHIVED.Arrival_Date",
+        extract="#secondary_care_ecds",
+    ),
+    ons_deaths=dict(
+        table="ONS_Deaths",
+        from_sql="ONS_Deaths",
+        patient_id="ONS_Deaths.Patient_ID",
+        date="ONS_Deaths.dod",
+        extract="#secondary_care_ons_deaths",
+    ),
+)
+SHARED_QUERIES = dict(
+    admitted_to_hospital=dict(
+        source="apcs",
+        args={"between", "returning", "find_first_match_in_period", "find_last_match_in_period", "with_these_diagnoses"},
+        returning={"binary_flag", "date_admitted", "number_of_matches_in_period"},
+    ),
+    attended_emergency_care=dict(
+        source="ecds",
+        args={"between", "returning", "find_first_match_in_period", "find_last_match_in_period", "with_these_diagnoses"},
+        returning={"binary_flag", "date_arrived", "number_of_matches_in_period"},
+    ),
+    with_these_codes_on_death_certificate=dict(
+        source="ons_deaths",
+        args={"between", "returning", "codelist", "match_only_underlying_cause"},
+        returning={"binary_flag", "date_of_death"},
+    ),
+    died_from_any_cause=dict(
+        source="ons_deaths",
+        args={"between", "returning"},
+        returning={"binary_flag", "date_of_death"},
+    ),
+)
+EC_DIAGNOSIS_COLUMNS = [f"EC_Diagnosis_{number:02}" for number in range(1, 25)]
+# arguments get_queries has already taken out, or that don't change the query
+IGNORED_ARGS = {"return_expectations", "hidden", "column_type", "date_format"}
+
+
+def shared_source(query_type, query_args):
+    # the source a variable can be taken from, or None if it's queried as
+    # before
+    shared = SHARED_QUERIES.get(query_type)
+    if shared is None or query_args.get("returning") not in shared["returning"]:
+        return None
+    for key, value in query_args.items():
+        if key not in shared["args"] and key not in IGNORED_ARGS and value:
+            return None
+    if query_type in ("admitted_to_hospital", "attended_emergency_care") and not query_args.get(
+        "with_these_diagnoses"
+    ):
+        return None
+    return shared["source"]
+
+
+def diagnoses_condition(codelists):
+    # APCS rows with any of the codelists' codes in their diagnoses, as the
+    # backend's LIKEs match them
+    prefixes = Icd10Matcher(dict(enumerate(codelists))).prefixes()
+    fragments = [
+        f"Der_Diagnosis_All LIKE {pattern} ESCAPE '!'"
+        for pattern in codelist_to_like_patterns(prefixes, prefix="%[^A-Za-z0-9]", suffix="%")
+    ]
+    return "(" + " OR ".join(fragments) + ")"
+
+
+def codes_condition(columns, codes):
+    return "(" + " OR ".join(f"{column} IN ({codelist_to_sql(codes)})" for column in columns) + ")"
+
+
+def codes_of(codelist):
+    return [code[0] if isinstance(code, tuple) else code for code in codelist]
+
+
+def death_columns(query_args):
+    columns = ["icd10u"]
+    if not query_args.get("match_only_underlying_cause"):
+        columns.extend(f"ICD10{number:03d}" for number in range(1, 16))
+    return columns
+
+
+def match_condition(query_type, query_args):
+    # SQL for a source row matching the variable's codes
+    if query_type == "admitted_to_hospital":
+        assert query_args["with_these_diagnoses"].system == "icd10"
+        return diagnoses_condition([query_args["with_these_diagnoses"]])
+    if query_type == "attended_emergency_care":
+        return codes_condition(EC_DIAGNOSIS_COLUMNS, codes_of(query_args["with_these_diagnoses"]))
+    if query_args.get("codelist") is not None:
+        assert query_args["codelist"].system == "icd10"
+        return codes_condition(death_columns(query_args), codes_of(query_args["codelist"]))
+    return "1 = 1"
+
+
+def scan_condition(source, variables):
+    # SQL for a source row matching any of the variables' codes
+    if source == "apcs":
+        return diagnoses_condition([query_args["with_these_diagnoses"] for _, _, query_args in variables])
+    if source == "ecds":
+        codes = {code for _, _, query_args in variables for code in codes_of(query_args["with_these_diagnoses"])}
+        return codes_condition(EC_DIAGNOSIS_COLUMNS, sorted(codes))
+    if any(query_args.get("codelist") is None for _, _, query_args in variables):
+        return "1 = 1"
+    codes = {code for _, _, query_args in variables for code in codes_of(query_args["codelist"])}
+    columns = max((death_columns(query_args) for _, _, query_args in variables), key=len)
+    return codes_condition(columns, sorted(codes))
+
+
+def date_envelope(variables):
+    # the earliest and latest dates any of the variables look at, or None
+    # where one of them is open-ended or relative to another variable
+    starts, ends = [], []
+    for _, _, query_args in variables:
+        start, end = query_args.get("between") or (None, None)
+        starts.append(start if start and is_iso_date(start) else None)
+        ends.append(end if end and is_iso_date(end) else None)
+    return (
+        min(starts) if None not in starts else None,
+        max(ends) if None not in ends else None,
+    )
+
+
+def shared_plan(covariate_definitions):
+    # {source: dict(variables, matches)} for the sources with more than one
+    # variable to share a scan, with matches as {condition: column}
+    plan = {}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        source = shared_source(query_type, query_args)
+        if source is not None:
+            plan.setdefault(source, dict(variables=[], matches={}))
+            plan[source]["variables"].append((name, query_type, query_args))
+    plan = {source: shared for source, shared in plan.items() if len(shared["variables"]) > 1}
+    for shared in plan.values():
+        for _, query_type, query_args in shared["variables"]:
+            condition = match_condition(query_type, query_args)
+            shared["matches"].setdefault(condition, f"match_{len(shared['matches'])}")
+    return plan
+
+
+class SharedSecondaryCareScan:
+    # stands in for the backend's get_queries_for_column, adding the scan of
+    # each shared table before the first of its variables
+    def __init__(self, backend):
+        self.backend = backend
+        self.get_queries_for_column = backend.get_queries_for_column
+        self.plan = {}
+
+    def install(self):
+        # the backend builds its queries when it's created, so they're built
+        # again with the scan
+        self.plan = shared_plan(self.backend.covariate_definitions)
+        self.backend.get_queries_for_column = self.shared_get_queries_for_column
+        self.backend.next_temp_table_id = 1
+        self.backend.queries = self.backend.get_queries(self.backend.covariate_definitions)
+        return self
+
+    def shared_get_queries_for_column(self, column_name, query_type, query_args, output_columns):
+        source = shared_source(query_type, query_args)
+        if source not in self.plan:
+            return self.get_queries_for_column(column_name, query_type, query_args, output_columns)
+        queries = []
+        if column_name == self.plan[source]["variables"][0][0]:
+            queries.extend(self.scan_queries(source))
+        self.backend.output_columns = output_columns
+        self.backend._current_column_name = column_name
+        queries.append(self.variable_query(source, query_type, query_args))
+        self.backend._current_column_name = None
+        return queries
+
+    def scan_queries(self, source):
+        details = SOURCES[source]
+        shared = self.plan[source]
+        names = ", ".join(name for name, _, _ in shared["variables"])
+        comment = f"-- Secondary care scan of {details['table']} for {names}\n"
+        match_columns = ",\n          ".join(
+            f"CASE WHEN {condition} THEN 1 ELSE 0 END AS {column}"
+            for condition, column in shared["matches"].items()
+        )
+        conditions = [scan_condition(source, shared["variables"])]
+        start, end = date_envelope(shared["variables"])
+        if start:
+            conditions.append(f"{details['date']} >= {quote(start)}")
+        if end:
+            conditions.append(f"{details['date']} <= {quote(end)}")
+        return [
+            f"""{comment}
+        SELECT
+          {details['patient_id']} AS patient_id,
+          {details['date']} AS event_date,
+          {match_columns}
+        INTO {details['extract']}
+        FROM {details['from_sql']}
+        WHERE {' AND '.join(conditions)}
+        """,
+            f"{comment}CREATE CLUSTERED INDEX secondary_care_ix ON {details['extract']} (patient_id)",
+        ]
+
+    def variable_query(self, source, query_type, query_args):
+        # the variable's value from the scan, as the backend's own query
+        # would return it
+        extract = SOURCES[source]["extract"]
+        match_column = self.plan[source]["matches"][match_condition(query_type, query_args)]
+        returning = query_args["returning"]
+        if returning == "binary_flag":
+            column = "1"
+        elif returning == "number_of_matches_in_period":
+            column = "COUNT(*)"
+        elif source == "ons_deaths" or query_args.get("find_first_match_in_period"):
+            column = "MIN(event_date)"
+        else:
+            column = "MAX(event_date)"
+        date_condition, date_joins = self.backend.get_date_condition(
+            extract, f"{extract}.event_date", query_args.get("between")
+        )
+        return f"""
+        SELECT
+          {extract}.patient_id AS patient_id,
+          {column} AS {returning}
+        FROM {extract}
+        {date_joins}
+        WHERE {match_column} = 1 AND {date_condition}
+        GROUP BY {extract}.patient_id
+        """
+
+
+# SHARED VACCINATION SCAN
+# with SharedVaccinationScan installed on a study's backend (see
+# --shared-vaccinations), VaccinationReference is reduced to a temporary
+# table of VaccinationName_ID, product_id and target_id once, using the IDs
+# in vaccine_registry.py, and the Vaccination table is read once, joining on
+# VaccinationName_ID, into a temporary table of
+#
+#   patient_id, vaccination_date, product_id, target_id
+#
+# each with_tpp_vaccination_record variable then compares these IDs, rather
+# than each variable joining the reference table and comparing the product
+# names again. variables matching products or diseases that aren't listed
+# in the registry are queried as before.
+
+PRODUCTS_TABLE = "#vaccine_products"
+VACCINATIONS_TABLE = "#vaccinations"
+
+
+def is_shared_vaccination(query_type, query_args):
+    return (
+        query_type == "with_tpp_vaccination_record"
+        and query_args.get("returning") in ("date", "binary_flag")
+        and not query_args.get("include_date_of_match")
+        and registered_ids(query_args) is not None
+    )
+
+
+def case_ids(column, ids):
+    cases = " ".join(f"WHEN {quote(name)} THEN {number}" for name, number in ids.items())
+    return f"CASE {column} {cases} ELSE 0 END"
+
+
+class SharedVaccinationScan:
+    # stands in for the backend's get_queries_for_column, as
+    # SharedSecondaryCareScan does
+    def __init__(self, backend):
+        self.backend = backend
+        self.get_queries_for_column = backend.get_queries_for_column
+        self.variables = []
+
+    def install(self):
+        self.variables = [
+            (name, query_type, query_args)
+            for name, (query_type, query_args) in self.backend.covariate_definitions.items()
+            if is_shared_vaccination(query_type, query_args)
+        ]
+        if len(self.variables) < 2:
+            return self
+        self.backend.get_queries_for_column = self.shared_get_queries_for_column
+        self.backend.next_temp_table_id = 1
+        self.backend.queries = self.backend.get_queries(self.backend.covariate_definitions)
+        return self
+
+    def shared_get_queries_for_column(self, column_name, query_type, query_args, output_columns):
+        if not is_shared_vaccination(query_type, query_args):
+            return self.get_queries_for_column(column_name, query_type, query_args, output_columns)
+        queries = []
+        if column_name == self.variables[0][0]:
+            queries.extend(self.scan_queries())
+        self.backend.output_columns = output_columns
+        self.backend._current_column_name = column_name
+        queries.append(self.variable_query(query_args))
+        self.backend._current_column_name = None
+        return queries
+
+    def scan_queries(self):
+        names = ", ".join(name for name, _, _ in self.variables)
+        comment = f"-- Vaccination scan for {names}\n"
+        conditions = ["1 = 1"]
+        start, end = date_envelope(self.variables)
+        if start:
+            conditions.append(f"Vaccination.VaccinationDate >= {quote(start)}")
+        if end:
+            conditions.append(f"Vaccination.VaccinationDate <= {quote(end)}")
+        return [
+            f"""{comment}
+        SELECT
+          VaccinationName_ID,
+          {case_ids("VaccinationName", PRODUCT_IDS)} AS product_id,
+          {case_ids("VaccinationContent", TARGET_DISEASE_IDS)} AS target_id
+        INTO {PRODUCTS_TABLE}
+        FROM VaccinationReference
+        WHERE VaccinationName IN ({codelist_to_sql(PRODUCT_IDS)})
+          OR VaccinationContent IN ({codelist_to_sql(TARGET_DISEASE_IDS)})
+        """,
+            f"""{comment}
+        SELECT
+          Vaccination.Patient_ID AS patient_id,
+          Vaccination.VaccinationDate AS vaccination_date,
+          products.product_id,
+          products.target_id
+        INTO {VACCINATIONS_TABLE}
+        FROM Vaccination
+        INNER JOIN {PRODUCTS_TABLE} AS products
+        ON products.VaccinationName_ID = Vaccination.VaccinationName_ID
+        WHERE {' AND '.join(conditions)}
+        """,
+            f"{comment}CREATE CLUSTERED INDEX vaccinations_ix ON {VACCINATIONS_TABLE} (patient_id)",
+        ]
+
+    def variable_query(self, query_args):
+        # the variable's flag and date from the scan, as the backend's own
+        # query would return them
+        product_ids, target_ids = registered_ids(query_args)
+        conditions = []
+        if product_ids:
+            conditions.append(f"product_id IN ({', '.join(map(str, product_ids))})")
+        if target_ids:
+            conditions.append(f"target_id IN ({', '.join(map(str, target_ids))})")
+        date_condition, date_joins = self.backend.get_date_condition(
+            VACCINATIONS_TABLE, f"{VACCINATIONS_TABLE}.vaccination_date", query_args.get("between")
+        )
+        conditions.append(date_condition)
+        date_aggregate = "MIN" if query_args.get("find_first_match_in_period") else "MAX"
+        return f"""
+        SELECT
+          {VACCINATIONS_TABLE}.patient_id AS patient_id,
+          1 AS binary_flag,
+          {date_aggregate}(vaccination_date) AS date
+        FROM {VACCINATIONS_TABLE}
+        {date_joins}
+        WHERE {' AND '.join(conditions)}
+        GROUP BY {VACCINATIONS_TABLE}.patient_id
+        """
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study-definition", default="study_definition_cohort")
+    parser.add_argument("--output", default="output/input_cohort.csv.gz")
+    parser.add_argument("--param", action="append", default=[], help="KEY=VALUE")
+    parser.add_argument("--sql", action="store_true", help="print the SQL instead of running it")
+    parser.add_argument(
+        "--shared-vaccinations",
+        action="store_true",
+        help="also read the Vaccination table once (see SharedVaccinationScan)",
+    )
+    parser.add_argument(
+        "--shared-clinical-events",
+        action="store_true",
+        help="also read CodedEvent once (see primary_care.py)",
+    )
+    args = parser.parse_args()
+
+    params = dict(param.split("=", 1) for param in args.param)
+    study = load_compiled_study(args.study_definition, params)
+    if study.backend is None:
+        raise RuntimeError("DATABASE_URL must be set to extract with a shared scan")
+    SharedSecondaryCareScan(study.backend).install()
+    if args.shared_vaccinations:
+        SharedVaccinationScan(study.backend).install()
+    if args.shared_clinical_events:
+        # imported here, as primary_care imports this module
+        from primary_care import SharedClinicalEventScan
+
+        SharedClinicalEventScan(study.backend).install()
+    if args.sql:
+        print(study.to_sql())
+        return
+    start = time.perf_counter()
+    study.to_file(args.output)
+    print(f"Extracted in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -25,9 +25,26 @@ confounding_variables = generate_confounding_variables(index_date_variable="inde
 from outcome_variables import generate_outcome_variables
 outcome_variables = generate_outcome_variables(index_date_variable="index_date")
 
+## other follow-up variables (shared with study_definition_followup), each
+## after the variable it has always followed in the cohort's columns
+from followup_variables import generate_followup_event_variables, place_variables
+followup_event_variables = generate_followup_event_variables(
+    index_date_variable="index_date", covid_test_on_or_after="2020-02-01",
+)
+followup_event_places = dict(
+    fu_ms_no_gp="history_ms_no_gp",
+    fu_cidp_gp="history_cidp_gp",
+    first_positive_covid_test="hiv",
+    pregnancy="history_pregnancy",
+    death_date="has_died",
+    dereg_date="death_date",
+)
+
 # Specify study definition
+## (also used by study_definition_cohort_cached, which fills in variables
+## already extracted from the same snapshot from output/variable_cache)
 
-study = StudyDefinition(
+cohort_args = place_variables(dict(
     # configure the expectations framework
     default_expectations={
         "date": {"earliest": "1900-01-01", "latest": "today"},
@@ -126,14 +143,6 @@ study = StudyDefinition(
     return_expectations={"incidence": 0.01}
     ),
 
-    pregnancy=patients.with_these_clinical_events(
-    preg,
-    returning="date",
-    find_first_match_in_period=True,
-    on_or_after="index_date",
-    return_expectations={"incidence": 0.01}
-    ),
-
     ### has one year of baseline time
     has_baseline_time=patients.registered_with_one_practice_between(
        start_date="index_date - 1 year",
@@ -147,23 +156,6 @@ study = StudyDefinition(
       returning="binary_flag",
     ),
 
-    ### died after index (extracted as used as a matching variable, so needs to exist)
-    death_date=patients.died_from_any_cause(
-        on_or_after="index_date",
-        returning="date_of_death",
-        date_format="YYYY-MM-DD", 
-        return_expectations={
-            "date": {
-                "earliest": "2020-12-08",  
-                "latest": "2021-05-11", }, 
-                "incidence": 0.01 },
-    ),
-
-    ### deregistered after index (extracted as used as a matching variable, so needs to exist)
-    dereg_date=patients.date_deregistered_from_all_supported_practices(
-        on_or_after="index_date", date_format="YYYY-MM-DD",
-    ),
-
     ## RESIDENTIAL STATUS 
     ### known care home 
     #### type of care home
@@ -209,6 +201,19 @@ study = StudyDefinition(
             "index_date",
             returning="index_of_multiple_deprivation",
             round_to_nearest=100,
+            return_expectations={
+                "rate": "universal",
+                "category": {
+                    "ratios": {
+                        "0": 0.05,
+                        "3200": 0.19,
+                        "9800": 0.19,
+                        "16400": 0.19,
+                        "23000": 0.19,
+                        "29600": 0.19,
+                    }
+                },
+            },
         ),
         return_expectations={
             "rate": "universal",
@@ -225,16 +230,6 @@ study = StudyDefinition(
         },
     ),
 
-) 
-
-
-
-
-
-
-
-
-
-
-
+), followup_event_variables, followup_event_places)
 
+study = StudyDefinition(**cohort_args)
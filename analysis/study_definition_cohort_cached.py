@@ -0,0 +1,13 @@
+# Import necessary functions
+from cohortextractor import params
+
+# The cohort study definition's variables
+from study_definition_cohort import cohort_args
+
+## variables already extracted from this snapshot (--param snapshot=<id>)
+## are filled in from output/variable_cache by analysis/variable_cache.py
+from variable_cache import cached_study
+
+# Specify study definition
+
+study = cached_study(params.get("snapshot"), **cohort_args)
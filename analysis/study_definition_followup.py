@@ -0,0 +1,64 @@
+# Import necessary functions
+from cohortextractor import (
+    StudyDefinition,
+    patients,
+    codelist_from_csv,
+    codelist,
+    filter_codes_by_category,
+    combine_codelists
+)
+
+# Import all codelists
+from codelists import *
+
+# INCREMENTAL FOLLOW-UP
+# re-extracts the cohort's follow-up variables from a new database snapshot
+# for the patients in output/followup_patients.csv (written by
+# analysis/incremental_cohort.py prepare), who are those with a follow-up
+# variable still empty in the previous extraction who hadn't died or
+# deregistered by then. each search starts at
+# last_cut, the date of the snapshot the previous extraction was run on,
+# since anything earlier was already searched for.
+
+followup_patients = "output/followup_patients.csv"
+
+# Import Variables
+
+## follow-up variables (second doses are searched for from the first dose in
+## the previous extraction: one found in this snapshot is too recent to have
+## been followed by a second, and any that has is found by the next refresh)
+from followup_variables import generate_followup_variables
+followup_variables = generate_followup_variables(
+    index_date_variable="last_cut",
+    first_dose_variable="previous_first_any_vaccine_date",
+)
+
+# Specify study definition
+
+study = StudyDefinition(
+    # configure the expectations framework
+    default_expectations={
+        "date": {"earliest": "1900-01-01", "latest": "today"},
+        "rate": "uniform",
+        "incidence" : 0.2
+    },
+
+    # start of observation period (note, needs to be called index date)
+    index_date="2020-07-01",
+
+    # patients with follow-up still to find
+    population=patients.which_exist_in_file(followup_patients),
+
+    # date of the snapshot the previous extraction was run on
+    last_cut=patients.with_value_from_file(
+        followup_patients, returning="last_cut", returning_type="date",
+    ),
+
+    # first dose in the previous extraction
+    previous_first_any_vaccine_date=patients.with_value_from_file(
+        followup_patients, returning="first_any_vaccine_date", returning_type="date",
+    ),
+
+    # FOLLOW-UP VARIABLES
+    **followup_variables,
+)
@@ -0,0 +1,73 @@
+# Import necessary functions
+from cohortextractor import (
+    StudyDefinition,
+    patients,
+    codelist_from_csv,
+    codelist,
+    filter_codes_by_category,
+    combine_codelists,
+    params
+)
+
+# Import all codelists
+from codelists import *
+
+# CONFOUNDERS AND OUTCOMES AT SEVERAL INDEX DATES
+# evaluates the confounding and outcome variables for the extracted cohort
+# relative to each patient's first vaccination, and to any calendar dates
+# passed as --param index_dates=2021-01-04,2021-02-01, in one extraction.
+# analysis/indexed_variables.py reshapes the output to one row per patient
+# and index date.
+
+cohort = "output/input_cohort.csv.gz"
+
+## index dates, by the label their variables are suffixed with. calendar
+## dates get a column each (e.g. index_date_2021_01_04), as date arithmetic
+## such as "2021-01-04 - 1 year" only works on columns
+index_dates = dict(vaccination="first_known_vaccine_date")
+calendar_index_dates = dict()
+for index_date in params.get("index_dates", "").split(","):
+    if index_date:
+        label = index_date.replace("-", "_")
+        index_dates[label] = f"index_date_{label}"
+        calendar_index_dates[f"index_date_{label}"] = patients.fixed_value(index_date)
+
+# Import Variables
+
+## confounding and outcome variables at each index date
+from indexed_variables import generate_indexed_variables
+from confounding_variables import generate_confounding_variables
+from outcome_variables import generate_outcome_variables
+confounding_variables = generate_indexed_variables(generate_confounding_variables, index_dates)
+outcome_variables = generate_indexed_variables(generate_outcome_variables, index_dates)
+
+# Specify study definition
+
+study = StudyDefinition(
+    # configure the expectations framework
+    default_expectations={
+        "date": {"earliest": "1900-01-01", "latest": "today"},
+        "rate": "uniform",
+        "incidence" : 0.2
+    },
+
+    # start of observation period (note, needs to be called index date)
+    index_date="2020-07-01",
+
+    # patients in the extracted cohort
+    population=patients.which_exist_in_file(cohort),
+
+    # CALENDAR INDEX DATES
+    **calendar_index_dates,
+
+    # first vaccination, as extracted for the cohort
+    first_known_vaccine_date=patients.with_value_from_file(
+        cohort, returning="first_known_vaccine_date", returning_type="date",
+    ),
+
+    # CONFOUNDING VARIABLES
+    **confounding_variables,
+
+    # OUTCOME VARIABLES
+    **outcome_variables,
+)
@@ -0,0 +1,189 @@
+import argparse
+import json
+import re
+
+from expressions import definition_columns
+
+# DEPENDENCY GRAPH OF A STUDY DEFINITION
+# each variable depends on the variables its value is calculated from:
+#
+#   - the columns in a satisfying/categorised_as expression
+#     (e.g. history_any_guillain_barre, age_group, imd)
+#   - the columns passed to minimum_of/maximum_of
+#     (e.g. first_known_vaccine_date, any_bells_palsy)
+#   - a column used as a date in another query
+#     (e.g. second_any_vaccine_date on "first_any_vaccine_date + 21 days")
+#
+# variables with no dependencies are base queries, which can all be run at
+# once; every other variable can be run as soon as its dependencies are
+# ready. run as a script to print the plan for a study, e.g.
+#
+#   python analysis/study_graph.py --study-definition study_definition_cohort
+
+DERIVED_QUERY_TYPES = {"categorised_as", "aggregate_of", "fixed_value", "value_from"}
+# relative cost of a variable, used for the critical path when no measured
+# timings are given: base queries scan a table, derived variables don't
+BASE_QUERY_COST = 1.0
+DERIVED_QUERY_COST = 0.0
+DATE_COLUMN_RE = re.compile(r"^\s*([A-Za-z_][A-Za-z0-9_]*)")
+
+
+def date_columns(query_args, names):
+    # variables used as dates in the query's arguments
+    columns = set()
+    pending = [
+        value for key, value in query_args.items() if key not in ("return_expectations", "codelist")
+    ]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, (list, tuple)):
+            pending.extend(value)
+        elif isinstance(value, str):
+            match = DATE_COLUMN_RE.match(value)
+            if match and match.group(1) in names:
+                columns.add(match.group(1))
+    return columns
+
+
+def dependency_graph(definitions):
+    # {variable: set of variables it depends on}
+    names = set(definitions)
+    graph = {}
+    for name, (query_type, query_args) in definitions.items():
+        if query_type in ("categorised_as", "aggregate_of"):
+            graph[name] = definition_columns(query_type, query_args)
+        else:
+            graph[name] = date_columns(query_args, names - {name})
+    return graph
+
+
+def dependency_closure(graph, names):
+    # the named variables and every variable they depend on
+    closure = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in closure:
+            closure.add(name)
+            pending.extend(graph[name])
+    return closure
+
+
+def consumers(graph):
+    # {variable: set of variables that depend on it}
+    consumers = {name: set() for name in graph}
+    for name, dependencies in graph.items():
+        for dependency in dependencies:
+            consumers[dependency].add(name)
+    return consumers
+
+
+def levels(graph):
+    # variables grouped so that each group only depends on earlier groups,
+    # in the order they're declared within each group
+    remaining = dict(graph)
+    done = set()
+    levels = []
+    while remaining:
+        level = [name for name, dependencies in remaining.items() if dependencies <= done]
+        if not level:
+            raise ValueError(f"Circular dependency between: {', '.join(remaining)}")
+        levels.append(level)
+        done.update(level)
+        for name in level:
+            del remaining[name]
+    return levels
+
+
+def single_use_intermediates(definitions, graph):
+    # variables used by exactly one other variable, which could be hidden
+    # inside it if they aren't needed in the output
+    return {
+        name: used_by.pop()
+        for name, used_by in consumers(graph).items()
+        if len(used_by) == 1
+        and name != "population"
+        and not definitions[name][1].get("hidden")
+    }
+
+
+def variable_cost(query_type, name, costs):
+    if name in costs:
+        return costs[name]
+    if query_type in DERIVED_QUERY_TYPES:
+        return DERIVED_QUERY_COST
+    return BASE_QUERY_COST
+
+
+def critical_path(definitions, graph, costs=None):
+    # the chain of dependent variables with the largest total cost, which
+    # bounds how soon the study can finish however many queries run at once
+    costs = costs or {}
+    finish = {}
+    previous = {}
+    for level in levels(graph):
+        for name in level:
+            start = 0.0
+            for dependency in graph[name]:
+                if finish[dependency] > start:
+                    start = finish[dependency]
+                    previous[name] = dependency
+            finish[name] = start + variable_cost(definitions[name][0], name, costs)
+    name = max(finish, key=finish.get)
+    path = [name]
+    while path[-1] in previous:
+        path.append(previous[path[-1]])
+    return list(reversed(path)), finish[name]
+
+
+def study_plan(definitions, costs=None):
+    graph = dependency_graph(definitions)
+    path, total_cost = critical_path(definitions, graph, costs)
+    return dict(
+        dependencies={name: sorted(dependencies) for name, dependencies in graph.items()},
+        levels=levels(graph),
+        single_use_intermediates=single_use_intermediates(definitions, graph),
+        critical_path=path,
+        critical_path_cost=total_cost,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study-definition", default="study_definition_cohort")
+    parser.add_argument(
+        "--costs",
+        help="JSON file of {variable: seconds} to weight the critical path with, "
+        "or a profile from profile_cohort.py",
+    )
+    parser.add_argument("--output", help="write the plan to this JSON file")
+    args = parser.parse_args()
+
+    costs = None
+    if args.costs:
+        with open(args.costs) as f:
+            costs = json.load(f)
+        if "format" in costs and "costs" in costs:
+            costs = costs["costs"]
+    # imported here, as compiled_study imports this module
+    from compiled_study import load_compiled_study
+
+    study = load_compiled_study(args.study_definition)
+    plan = study_plan(study.covariate_definitions, costs)
+
+    for number, level in enumerate(plan["levels"]):
+        print(f"Level {number} ({len(level)} variables): {', '.join(level)}")
+    print("\nUsed by only one other variable:")
+    for name, used_by in plan["single_use_intermediates"].items():
+        print(f"  {name} -> {used_by}")
+    print(
+        f"\nCritical path (cost {plan['critical_path_cost']:g}): "
+        + " -> ".join(plan["critical_path"])
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(plan, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# COVID VACCINE PRODUCT REGISTRY
+# each vaccine brand's products (formulations), as named in TPP's
+# VaccinationReference.VaccinationName, and the target diseases matched in
+# VaccinationContent. products, brands and target diseases are numbered
+# from 1 in the order they're listed here, with 0 for none, so a new
+# formulation (e.g. a booster) is added to its brand's list and matched by
+# every variable for that brand.
+#
+# secondary_care.SharedVaccinationScan reads the Vaccination table once for
+# every variable matching these products. this module has no dependencies,
+# so the study definitions and python:latest actions can use the brand names
+# without importing the backend.
+
+SARS_COV_2 = "SARS-2 CORONAVIRUS"
+TARGET_DISEASES = [SARS_COV_2]
+VACCINE_BRANDS = dict(
+    pfizer=[
+        "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
+    ],
+    az=[
+        "COVID-19 Vac AstraZeneca (ChAdOx1 S recomb) 5x10000000000 viral particles/0.5ml dose sol for inj MDV",
+    ],
+    moderna=[
+        "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
+    ],
+)
+BRAND_IDS = {brand: number for number, brand in enumerate(VACCINE_BRANDS, start=1)}
+PRODUCT_IDS = {
+    product: number
+    for number, product in enumerate(
+        (product for products in VACCINE_BRANDS.values() for product in products), start=1
+    )
+}
+TARGET_DISEASE_IDS = {disease: number for number, disease in enumerate(TARGET_DISEASES, start=1)}
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+
+def registered_ids(query_args):
+    # (product IDs, target disease IDs) a variable matches, with None for
+    # any, or None if it matches something that isn't registered
+    products = as_list(query_args.get("product_name_matches"))
+    diseases = as_list(query_args.get("target_disease_matches"))
+    if any(product not in PRODUCT_IDS for product in products):
+        return None
+    if any(disease not in TARGET_DISEASE_IDS for disease in diseases):
+        return None
+    return (
+        sorted(PRODUCT_IDS[product] for product in products) or None,
+        sorted(TARGET_DISEASE_IDS[disease] for disease in diseases) or None,
+    )
+
+
+def main():
+    for brand, brand_id in BRAND_IDS.items():
+        print(f"{brand_id} {brand}")
+        for product in VACCINE_BRANDS[brand]:
+            print(f"  {PRODUCT_IDS[product]} {product}")
+    for disease, disease_id in TARGET_DISEASE_IDS.items():
+        print(f"{disease_id} target disease {disease}")
+
+
+if __name__ == "__main__":
+    main()
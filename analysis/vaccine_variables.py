@@ -1,147 +1,83 @@
 from cohortextractor import filter_codes_by_category, patients, combine_codelists
 from codelists import *
 from datetime import datetime, timedelta
+from vaccine_registry import SARS_COV_2, VACCINE_BRANDS
 
-
-def generate_vaccine_variables(index_date_variable):
-    vaccine_variables = dict(
-    # COVID VACCINATION VARIABLES  
-    # any COVID vaccination (first dose)
-    first_any_vaccine_date=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        on_or_after=f"{index_date_variable}",
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {
-                "earliest": "2020-12-08",  # first vaccine administered on the 8/12
-                "latest": "2021-05-11",
-            }, 
-            "incidence": 0.95
-        },
+# COVID VACCINE PRODUCTS
+# how each brand is matched in the TPP vaccination record, keyed by the
+# short name used in the variable names (e.g. first_pfizer_date). the
+# products of each brand are listed in vaccine_registry.py
+vaccine_products = dict(
+    pfizer=dict(
+        target_disease_matches=SARS_COV_2,
+        product_name_matches=VACCINE_BRANDS["pfizer"],
     ),
-    # pfizer (first dose) 
-    first_pfizer_date=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        product_name_matches="COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
-        on_or_after=f"{index_date_variable}",
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {
-                "earliest": "2020-12-08",  # first vaccine administered on the 8/12
-                "latest": "2021-05-11",
-            }, 
-            "incidence": 0.95
-        },
+    az=dict(
+        target_disease_matches=SARS_COV_2,
+        product_name_matches=VACCINE_BRANDS["az"],
     ),
-    # az (first dose)
-    first_az_date=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        product_name_matches="COVID-19 Vac AstraZeneca (ChAdOx1 S recomb) 5x10000000000 viral particles/0.5ml dose sol for inj MDV",
-        on_or_after=f"{index_date_variable}",
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {
-                "earliest": "2020-12-08",  # first vaccine administered on the 8/12
-                "latest": "2021-05-11",
-            }, 
-            "incidence": 0.95
-        },
+    moderna=dict(
+        product_name_matches=VACCINE_BRANDS["moderna"],
     ),
+)
 
-    # moderna (first dose)
-    first_moderna_date=patients.with_tpp_vaccination_record(
-        product_name_matches="COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
-        on_or_after=f"{index_date_variable}",
+
+def vaccination_date(on_or_after, earliest, latest, **product):
+    # first vaccination record matching the product on or after the given date
+    return patients.with_tpp_vaccination_record(
+        **product,
+        on_or_after=on_or_after,
         find_first_match_in_period=True,
         returning="date",
         date_format="YYYY-MM-DD",
         return_expectations={
             "date": {
-                "earliest": "2020-12-08",  
-                "latest": "2021-05-11",
+                "earliest": earliest,
+                "latest": latest,
             },
             "incidence": 0.95
         },
-    ),
+    )
 
-    # first ever vaccine date 
-    first_known_vaccine_date=patients.minimum_of("first_moderna_date", "first_az_date", "first_pfizer_date"), 
 
-    # ever vaccinated yes or no
-    has_first_known_vaccine=patients.satisfying(
-        """first_known_vaccine_date""",
-        return_expectations={"incidence": 0.99},
-    ),
+def generate_vaccine_variables(index_date_variable, first_dose_variable="first_any_vaccine_date"):
+    # the window searched for each dose, and the date range of its dummy data.
+    # the second dose is searched for from 21 days after first_dose_variable
+    doses = dict(
+        first=dict(
+            on_or_after=f"{index_date_variable}",
+            earliest="2020-12-08",  # first vaccine administered on the 8/12
+            latest="2021-05-11",
+        ),
+        second=dict(
+            on_or_after=f"{first_dose_variable} + 21 days",
+            earliest="2021-03-01",
+            latest="2021-07-11",
+        ),
+    )
 
-    # any COVID vaccination (second dose)
-    second_any_vaccine_date=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        on_or_after="first_any_vaccine_date + 21 days",  
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {
-                "earliest": "2021-03-01",  # first vaccine administered on the 8/12
-                "latest": "2021-07-11",
-            }, 
-            "incidence": 0.95
-        },
-    ),
-    # pfizer (second dose) 
-    second_pfizer_date=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        product_name_matches="COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
-        on_or_after="first_any_vaccine_date + 21 days",  
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {
-                "earliest": "2021-03-01",  # first vaccine administered on the 8/12
-                "latest": "2021-07-11",
-            }, 
-            "incidence": 0.95
-        },
-    ),
-    # az (second dose)
-    second_az_date=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        product_name_matches="COVID-19 Vac AstraZeneca (ChAdOx1 S recomb) 5x10000000000 viral particles/0.5ml dose sol for inj MDV",
-        on_or_after="first_any_vaccine_date + 21 days",  
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {
-                "earliest": "2021-03-01",  # first vaccine administered on the 8/12
-                "latest": "2021-07-11",
-            }, 
-            "incidence": 0.95
-        },
-    ),
-    second_moderna_date=patients.with_tpp_vaccination_record(
-        product_name_matches="COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
-        on_or_after="first_any_vaccine_date + 21 days",  
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {
-                "earliest": "2021-03-01",  
-                "latest": "2021-07-11",
-            },
-            "incidence": 0.95
-        },
-    ),
+    vaccine_variables = dict()
+    for dose, window in doses.items():
+        # COVID VACCINATION VARIABLES
+        # any COVID vaccination (e.g. first_any_vaccine_date)
+        vaccine_variables[f"{dose}_any_vaccine_date"] = vaccination_date(
+            target_disease_matches=SARS_COV_2,
+            **window,
+        )
+        # each product (e.g. first_pfizer_date, second_az_date)
+        for product, matches in vaccine_products.items():
+            vaccine_variables[f"{dose}_{product}_date"] = vaccination_date(**matches, **window)
+
+        # earliest known product (e.g. first_known_vaccine_date)
+        vaccine_variables[f"{dose}_known_vaccine_date"] = patients.minimum_of(
+            *[f"{dose}_{product}_date" for product in reversed(vaccine_products)]
+        )
+
+        if dose == "first":
+            # ever vaccinated yes or no
+            vaccine_variables["has_first_known_vaccine"] = patients.satisfying(
+                """first_known_vaccine_date""",
+                return_expectations={"incidence": 0.99},
+            )
 
-    second_known_vaccine_date = patients.minimum_of("second_moderna_date", "second_az_date", "second_pfizer_date"), 
-     
-    )
     return vaccine_variables
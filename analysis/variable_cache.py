@@ -0,0 +1,257 @@
+import argparse
+import copy
+import hashlib
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import structlog
+from cohortextractor import StudyDefinition
+from cohortextractor.codelistlib import Codelist
+from cohortextractor.cohortextractor import load_study_definition
+from cohortextractor.date_expressions import evaluate_date_expressions_in_covariate_definitions
+from cohortextractor.process_covariate_definitions import process_covariate_definitions
+
+from study_graph import dependency_closure, dependency_graph, levels
+
+# PER-VARIABLE RESULT CACHE
+# keeps the extracted values of each variable, per patient, keyed by a hash
+# of everything its values depend on:
+#
+#   - the query and its arguments, with dates resolved against the index
+#     date and codelists by their codes (so an edited codelist CSV is a
+#     different key)
+#   - the contents of any file it reads
+#   - the keys of the variables it's derived from or dated relative to
+#   - the population's key, so the same patients are covered
+#   - the database snapshot it was extracted from
+#
+# a study definition built with cached_study() instead of StudyDefinition
+# (study_definition_cohort_cached, the cohort's variables) leaves out the
+# variables already in the cache when run with --param snapshot=<id>. after
+# generate_cohort (and convert_cohort), update stores the new columns in the
+# cache and writes the extract with the cached ones put back, e.g.
+#
+#   cohortextractor generate_cohort \
+#       --study-definition study_definition_cohort_cached --param snapshot=2021-07-01
+#   python analysis/convert_cohort.py --input output/input_cohort_cached.csv.gz \
+#       --output output/input_cohort_cached.feather
+#   python analysis/variable_cache.py update --snapshot 2021-07-01
+#
+# as the generate_cohort_cached, convert_cohort_cached and
+# update_variable_cache actions in project.yaml do. study_definition_cohort
+# itself never reads the cache.
+#
+# each entry is a feather file of patient_id and the variable's values. the
+# least recently used entries are removed when the cache is over its size.
+
+CACHE_DIR = "output/variable_cache"
+DEFAULT_MAX_SIZE_MB = 10240
+# bump if the keys or the layout of entries change
+CACHE_FORMAT = 1
+# arguments that don't change the values extracted
+IGNORED_ARGS = {"return_expectations", "hidden"}
+
+logger = structlog.get_logger()
+
+
+def spec_json(value):
+    # a JSON-able form of a query argument
+    if isinstance(value, Codelist):
+        return dict(
+            system=value.system,
+            codes=sorted((spec_json(code) for code in value), key=json.dumps),
+        )
+    if isinstance(value, dict):
+        return {str(key): spec_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [spec_json(item) for item in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def variable_keys(definitions, index_date, snapshot):
+    # {variable: key} for every variable in the covariate definitions (as a
+    # StudyDefinition processes them) but the population
+    graph = dependency_graph(definitions)
+    keys = {}
+    for level in levels(graph):
+        for name in level:
+            query_type, query_args = definitions[name]
+            spec = dict(
+                format=CACHE_FORMAT,
+                snapshot=snapshot,
+                index_date=index_date,
+                query_type=query_type,
+                args={
+                    key: spec_json(value)
+                    for key, value in query_args.items()
+                    if key not in IGNORED_ARGS
+                },
+                dependencies={
+                    dependency: keys[dependency] for dependency in sorted(graph[name])
+                },
+            )
+            if "f_path" in query_args:
+                spec["file"] = file_hash(query_args["f_path"])
+            keys[name] = hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+    population_key = keys.pop("population")
+    return {
+        name: hashlib.sha256(f"{key}\0{population_key}".encode()).hexdigest()
+        for name, key in keys.items()
+    }
+
+
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], f"{key}.feather")
+
+
+def covariate_definitions(covariates, index_date):
+    # the covariate definitions as a StudyDefinition would hold them, without
+    # building its queries
+    definitions = process_covariate_definitions(copy.deepcopy(covariates))
+    return evaluate_date_expressions_in_covariate_definitions(definitions, index_date)
+
+
+def cached_study(
+    snapshot, population, default_expectations=None, index_date=None, **covariates
+):
+    # a StudyDefinition without the variables whose values for this snapshot
+    # are already in the cache. variables that are still queried keep the
+    # variables they use, cached or not
+    study_args = dict(
+        population=population, default_expectations=default_expectations, index_date=index_date
+    )
+    if not snapshot:
+        return StudyDefinition(**study_args, **covariates)
+
+    definitions = covariate_definitions(dict(covariates, population=population), index_date)
+    keys = variable_keys(definitions, index_date, snapshot)
+    output_columns = [
+        name
+        for name, (_, query_args) in definitions.items()
+        if name != "population" and not query_args.get("hidden")
+    ]
+    if os.environ.get("DATABASE_URL"):
+        queried = {
+            name for name in covariates if not os.path.exists(entry_path(CACHE_DIR, keys[name]))
+        }
+    else:
+        # dummy data has different patients each time, so nothing is cached
+        queried = set(covariates)
+    needed = dependency_closure(dependency_graph(definitions), queried | {"population"})
+    cached = [name for name in covariates if name not in needed]
+    study = StudyDefinition(
+        **study_args,
+        **{name: definition for name, definition in covariates.items() if name not in cached},
+    )
+    study.snapshot = snapshot
+    study.cache_keys = {name: keys[name] for name in output_columns}
+    logger.info(
+        "variable-cache", cached_variables=len(cached), output_columns=len(output_columns)
+    )
+    return study
+
+
+def read_entry(path, patient_ids):
+    # the cached values for the given patients, in their order
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    # mark it as recently used
+    os.utime(path)
+    positions = pc.index_in(patient_ids, value_set=table.column("patient_id"))
+    if positions.null_count:
+        raise ValueError(f"Cache entry {path} doesn't cover every patient")
+    return table.column("value").take(positions)
+
+
+def write_entry(path, patient_ids, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.table(dict(patient_id=patient_ids, value=values))
+    # write to a temporary file first so a half-written entry is never read
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    feather.write_feather(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+
+def evict(cache_dir, max_size):
+    # remove the least recently used entries until the cache fits
+    entries = []
+    for directory, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.endswith(".feather"):
+                stat = os.stat(os.path.join(directory, filename))
+                entries.append(
+                    (stat.st_mtime, stat.st_size, os.path.join(directory, filename))
+                )
+    size = sum(entry_size for _, entry_size, _ in entries)
+    removed = 0
+    for _, entry_size, path in sorted(entries):
+        if size <= max_size:
+            break
+        os.remove(path)
+        size -= entry_size
+        removed += 1
+    return removed
+
+
+def update(study, extract_path, output_path, max_size):
+    # store the extracted variables and fill in the cached ones. the variables
+    # left out of the extract are the ones generate_cohort found in the cache
+    extract = feather.read_table(extract_path)
+    patient_ids = extract.column("patient_id")
+    cached = set(study.cache_keys) - set(extract.column_names)
+    columns = dict(patient_id=patient_ids)
+    stored = 0
+    for name, key in study.cache_keys.items():
+        path = entry_path(CACHE_DIR, key)
+        if name in cached:
+            if not os.path.exists(path):
+                raise ValueError(f"{name} is neither in {extract_path} nor in the cache")
+            columns[name] = read_entry(path, patient_ids)
+        else:
+            columns[name] = extract.column(name)
+            if not os.path.exists(path):
+                write_entry(path, patient_ids, columns[name])
+                stored += 1
+
+    tmp_path = f"{output_path}.tmp"
+    feather.write_feather(pa.table(columns), tmp_path, compression="zstd")
+    os.replace(tmp_path, output_path)
+    removed = evict(CACHE_DIR, max_size)
+    print(
+        f"Filled {len(cached)} variables from the cache, stored {stored}, "
+        f"removed {removed} old entries"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser("update")
+    update_parser.add_argument(
+        "--study-definition", default="study_definition_cohort_cached"
+    )
+    update_parser.add_argument("--snapshot", required=True)
+    update_parser.add_argument("--extract", default="output/input_cohort_cached.feather")
+    update_parser.add_argument("--output", help="defaults to replacing the extract")
+    update_parser.add_argument("--max-size-mb", type=int, default=DEFAULT_MAX_SIZE_MB)
+    args = parser.parse_args()
+
+    # loaded as generate_cohort loaded it, so the same variables are cached
+    study = load_study_definition(args.study_definition, params={"snapshot": args.snapshot})
+    if getattr(study, "snapshot", None) != args.snapshot:
+        raise ValueError(f"{args.study_definition} doesn't use cached_study()")
+    update(study, args.extract, args.output or args.extract, args.max_size_mb * 2**20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the analysis scripts import each other as top-level modules, as they do
+# when run from the project's actions
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "analysis"))
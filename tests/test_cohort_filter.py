@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from cohort_filter import CohortIndex
+from expressions import evaluate_expression
+
+
+@pytest.fixture
+def cohort():
+    rng = np.random.default_rng(0)
+    size = 1000
+    dates = pd.Series(
+        np.datetime64("2020-12-08") + rng.integers(0, 150, size).astype("timedelta64[D]")
+    )
+    age = pd.Series(rng.integers(10, 110, size), dtype="float64")
+    return pd.DataFrame(
+        dict(
+            first_known_vaccine_date=dates.where(rng.random(size) < 0.8),
+            death_date=dates.where(rng.random(size) < 0.02),
+            sex=pd.Categorical(rng.choice(["M", "F", "U"], size)),
+            stp=pd.Categorical(rng.choice(["STP1", "STP2", "STP3"], size)),
+            age=age.where(rng.random(size) < 0.95),
+            imd=rng.choice(["0", "1", "2", "3", "4", "5"], size),
+            hiv=rng.random(size) < 0.005,
+        )
+    )
+
+
+def feather_table(df):
+    # as convert_cohort.py stores the extract, with dates as date32
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for position, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(position, field.name, table.column(position).cast(pa.date32()))
+    return table
+
+
+EXPRESSIONS = [
+    # dates
+    'first_known_vaccine_date >= "2021-01-04"',
+    '"2021-03-01" > first_known_vaccine_date',
+    'first_known_vaccine_date = "2021-01-04" OR death_date < "2021-02-01"',
+    "first_known_vaccine_date AND NOT death_date",
+    # categories
+    'sex = "M" OR sex = "F"',
+    'stp != "STP2" AND sex <> "U"',
+    'sex = "X"',
+    # numbers, and text compared as numbers
+    "age >= 18 AND age < 105",
+    "imd > 0 AND age * 2 > 130",
+    "hiv OR age >= 80",
+    # all three
+    '(age >= 65 AND sex = "F") AND first_known_vaccine_date < "2021-02-15" AND NOT hiv',
+]
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+@pytest.mark.parametrize("source", ["dataframe", "arrow"])
+def test_matches_evaluate_expression(cohort, expression, source):
+    expected = evaluate_expression(expression, cohort).to_numpy(dtype=bool)
+    columns = cohort if source == "dataframe" else feather_table(cohort)
+    index = CohortIndex(columns)
+    np.testing.assert_array_equal(index.mask(expression), expected)
+    np.testing.assert_array_equal(index.positions(expression), np.flatnonzero(expected))